@@ -1,12 +1,17 @@
-import json
-import pandas as pd
-import numpy as np
 import requests
-from datetime import datetime, timedelta, date
 import send_msg as msgapp
-import schedule
+import inventory_store
+import spoilage
+import households
+import scheduler
+import metrics
 import time
 import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # This is the non-LLM agent that manages stored inventory data
@@ -16,26 +21,111 @@ from dotenv import load_dotenv
 # If that exceeds a certain threshold, the expiry date is adjusted for
 # counter items only. It is assumed refridgerated ones will not be affected by
 # high temperature
-# schedule library is used to make it os agnostic
+# The jobs run on scheduler.Scheduler, inside the Flask app or standalone
+# with python agent.py
 
 load_dotenv()
-base_url = 'https://api.openweathermap.org/data/2.5/forecast?lat=22.5744&lon=88.3629&appid='
+base_url = os.getenv("WEATHER_URL", 'https://api.openweathermap.org/data/2.5/forecast')
 api = os.getenv("WEATHER_API_KEY")
-api_url = base_url+api
+LAT, LON = households.HOME_LAT, households.HOME_LON
+# the forecast only changes every 3 hours
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", str(3 * 3600)))
+WEATHER_TIMEOUT = (3.05, 10) # connect, read seconds
 csv_file = "sample_inventory.csv"
 threshold_temp = 20
+# "forecast": counter items lose life by the forecast's temperature-hours
+# (spoilage.py); "legacy": one day off the counter when the average is hot
+SPOILAGE_MODEL = os.getenv("SPOILAGE_MODEL", "forecast")
 EXECUTION_TIME = "11:00" # set to run at 11 am system time
+COMPACT_EVERY_HOURS = 6
+# routine across households: worker processes (default one per core) and
+# threads fetching the forecasts of the grid cells
+ROUTINE_PROCESSES = int(os.getenv("ROUTINE_PROCESSES", "0")) or None
+FORECAST_THREADS = int(os.getenv("FORECAST_THREADS", "8"))
 
-def fetch_weather():
+class ForecastCache:
+    """ Forecasts cached per coordinates for ttl seconds. Requests go through
+        one pooled session with timeouts and retries, and when the API is down
+        the last forecast is served marked as stale """
+    def __init__(self, url=base_url, api_key=api, ttl=WEATHER_CACHE_TTL,
+                 timeout=WEATHER_TIMEOUT, session=None):
+        self.url = url
+        self.api_key = api_key
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = session or self._make_session()
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_session():
+        session = requests.Session()
+        retries = Retry(total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                        allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @staticmethod
+    def key(lat, lon):
+        return (round(float(lat), 4), round(float(lon), 4))
+
+    @metrics.timed("weather_api")
+    def _download(self, lat, lon):
+        params = {"lat": lat, "lon": lon, "appid": self.api_key}
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        if response.status_code != 200:
+            return {"success":False, "error":response.status_code}
+        return {"success":True, "w_data":response.json()}
+
+    def get(self, lat=LAT, lon=LON):
+        """ {"success", "w_data", "stale"} like fetch_weather always returned"""
+        key = self.key(lat, lon)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                return {"success":True, "w_data":entry[1], "stale":False}
+            # one download per location at a time, other callers wait for it
+            try:
+                result = self._download(*key)
+            except Exception as e:
+                result = {"success":False, "error":e}
+            if result["success"]:
+                self._entries[key] = (time.monotonic(), result["w_data"])
+                result["stale"] = False
+                return result
+            if entry:
+                # exceptions carry the url with the api key, log only the type
+                reason = result["error"] if isinstance(result["error"], int) else type(result["error"]).__name__
+                print(f"Weather API failed with {reason}, serving cached forecast")
+                return {"success":True, "w_data":entry[1], "stale":True}
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# built on first use, assign a ForecastCache here to point it elsewhere
+forecast_cache = None
+_forecast_lock = threading.Lock()
+
+def get_forecast_cache():
+    global forecast_cache
+    if forecast_cache is None:
+        with _forecast_lock:
+            if forecast_cache is None:
+                forecast_cache = ForecastCache()
+    return forecast_cache
+
+@metrics.timed("fetch_weather")
+def fetch_weather(lat=LAT, lon=LON):
     """ fetches weather data and sends the data as python dictionary """
     try:
-        
-        response = requests.get(api_url)
-        if response.status_code == 200:
-            pydict = json.loads(response.text)
-        else:
-            return {"success":False, "error":response.status_code}
-        return {"success":True, "w_data":pydict}
+        return get_forecast_cache().get(lat, lon)
     except Exception as e:
         return {"success":False, "error" : e}
 
@@ -49,118 +139,170 @@ def get_avg(pydict):
     avg_max_temp = sum(max_temp_list)/len(max_temp_list)
     return avg_max_temp
 
-def update_expiry():
-    """ decreases the expiry date by one day. Called when a certain condition
-        is met """
-    try:
+def alert_user(checklist, condition=False, to=None, block=False):
+    """ whatsapp message sending """
+    if condition:
+        msg = f"Attention from your Pantry! Due to upcoming bad weather, {checklist} are getting spoiled"
+    else:
+        msg = f"Attention from your Pantry! {checklist} are getting spoiled by next 2 days"
         
-        df = pd.read_csv(csv_file)
-        df["expiry_dt"] = pd.to_datetime(df["expiry_dt"], format = "%d-%m-%Y")
-        condition = (df["storage"]=="counter")
-        df.loc[condition, "expiry_dt"] = df.loc[condition, "expiry_dt"] - timedelta(days=1)
-        df["expiry_dt"] = df["expiry_dt"].dt.strftime("%d-%m-%Y")
-        df.to_csv(csv_file, index=False)
-        return {"success":True, "msg": "Expiry dates updated"}
-    except Exception as e:
-        return {"success":False, "error":e}
-def check_stocks():
-    """ gets the list of items expiring by next 2 days"""
-    try:
-        df = pd.read_csv(csv_file)
-        df["expiry_dt_dt"] = pd.to_datetime(df["expiry_dt"], format="%d-%m-%Y")
-        curr_date = datetime.today()
-        condition = ((df["expiry_dt_dt"]-curr_date).dt.days < 3)
-        if condition.any():
-            
-            df.loc[condition, "status"] = "flagged"
-            df.drop(columns = ["expiry_dt_dt"], inplace=True)
-            df.to_csv(csv_file, index=False)
-            check_food_list = df.loc[condition, "name"].tolist()
-            check_food = ",".join(check_food_list)
-            return {"success":True, "inventory_update":True, "check_list":check_food}
-        else:
-            return {"success":True, "inventory_update":False}
-    except Exception as e:
-        return {"success":False, "error":e}
-    
         
+    # alerts fired close together reach the user as one digest
+    msgapp.send_message(msg, to=to, coalesce=True, block=block)
 
-def check_spoilage():
-    """ calls appropriate sub routines to analyze stock info based on weather"""
-    get_weather = fetch_weather()
-    if get_weather["success"]:
-        avg_temp = get_avg(get_weather["w_data"])
-        if avg_temp>threshold_temp:
-            inv_update = update_expiry()
-            stock_check = check_stocks()
-            if stock_check["success"] and stock_check["inventory_update"]:
-                #alert_user(stock_check["check_list"], condition=True)
-                return {"success":True, "inventory_update":True, "msg": "Inventory updated"}
-            else:
-                return {"success":True, "inventory_update":False, "msg": "No Inventory update needed"}
-            
-        else:
-            return {"success":True, "inventory_update":False, "msg": "No Inventory update needed"}
-        
-    else:
-        return get_weather
+def apply_routine(df, hot, today):
+    """ the expiry shift and flagging of one routine run, done in memory on a
+        day_frame. Returns the new expiry days, statuses and changed rows """
+    old_expiry = df["expiry_dt"].to_numpy()
+    old_status = df["status"].to_numpy()
+    expiry = old_expiry.copy()
+    status = old_status.copy()
+    if hot:
+        # the counter items a day closer, then flag what expires within 3 days
+        expiry[(df["storage"] == "counter").to_numpy()] -= 1
+        status[expiry <= today + 3] = "flagged"
+    changed = (expiry != old_expiry) | (status != old_status)
+    return expiry, status, changed
+
+def refresh_inventory(store, w_data, today):
+    """ one read, the shift and flagging in memory, one write of the changed
+        rows. Returns the names of the flagged items """
+    if SPOILAGE_MODEL == "forecast":
+        return spoilage.refresh(store, w_data, today)
+    df = store.day_frame()
+    expiry, status, changed = apply_routine(df, get_avg(w_data) > threshold_temp, today)
+    store.update_rows(df["id"].to_numpy()[changed], expiry[changed], status[changed])
+    return df["name"].to_numpy()[status == "flagged"].tolist()
 
-def routine_msg():
-    """ finds the items flagged and calls function to send user whatsapp msg"""
+def run_routine(store=None, today=None, household=None):
+    """ fused daily routine of one household: the inventory refresh then the
+        alert. With SPOILAGE_MODEL=legacy gives the same result as the old
+        routine kept in bench/reference_routine.py """
+    store = store or households.store_for(household)
+    if today is None:
+        today = inventory_store.today_number()
+    get_weather = fetch_weather(household.lat, household.lon) if household else fetch_weather()
+    if not get_weather["success"]:
+        return get_weather
+    check_food_list = ",".join(refresh_inventory(store, get_weather["w_data"], today))
     try:
-        df = pd.read_csv(csv_file)
-        condition = (df["status"] == "flagged")
-        mylist = df.loc[condition, "name"].tolist()
-        check_food_list = ",".join(mylist)
-        alert_user(check_food_list)
-        return {"success":True, "msg": "Inventory refreshed successfully"}
+        alert_user(check_food_list, to=(household.phone or None) if household else None)
     except Exception as e:
         print(f"Cannot be alerted for condition {e}")
         return {"success":False, "error": e}
-               
-    
+    return {"success":True, "msg": "Inventory refreshed successfully"}
 
-def alert_user(checklist, condition=False):
-    """ whatsapp message sending """
-    if condition:
-        msg = f"Attention from your Pantry! Due to upcoming bad weather, {checklist} are getting spoiled"
+def _init_routine_worker(household_dir, backend, spoilage_model):
+    """ a spawned worker starts from a fresh import, these are the parent's
+        settings it would otherwise read from the environment again """
+    global SPOILAGE_MODEL
+    households.household_dir = household_dir
+    inventory_store.backend = backend
+    SPOILAGE_MODEL = spoilage_model
+
+def _household_routine(job):
+    """ runs in a pool worker: refreshes one household's inventory.
+        Alerts are sent by the parent, queued messages die with a worker """
+    household, w_data, today = job
+    try:
+        return household.id, refresh_inventory(households.store_for(household), w_data, today), None
+    except Exception as e:
+        return household.id, None, str(e)
+
+def run_all_households(today=None, processes=ROUTINE_PROCESSES):
+    """ daily routine for every household. One forecast per grid cell, fetched
+        in parallel threads, then the inventories refreshed in a process pool """
+    if today is None:
+        today = inventory_store.today_number()
+    members = households.get_registry().all()
+    cells = households.by_grid_cell(members)
+    with ThreadPoolExecutor(FORECAST_THREADS) as pool:
+        forecasts = dict(zip(cells, pool.map(lambda cell: fetch_weather(*cell), cells)))
+    work = []
+    failed = []
+    for cell, group in cells.items():
+        if not forecasts[cell]["success"]:
+            print(f"No forecast for grid cell {cell}: {forecasts[cell]['error']}")
+            failed.extend(member.id for member in group)
+            continue
+        work.extend((member, forecasts[cell]["w_data"], today) for member in group)
+    workers = processes or os.cpu_count() or 1
+    if len(work) < 2 or workers == 1:
+        results = [_household_routine(job) for job in work]
     else:
-        msg = f"Attention from your Pantry! {checklist} are getting spoiled by next 2 days"
-        
-        
-    msgapp.send_message(msg)
+        # spawned, not forked: a fork inside the threaded web process copies
+        # locks other threads hold (a store's write lock, the metrics lock)
+        # and the child waits on them forever
+        with ProcessPoolExecutor(min(workers, len(work)),
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_routine_worker,
+                                 initargs=(households.household_dir, inventory_store.backend,
+                                           SPOILAGE_MODEL)) as pool:
+            # a few chunks per worker keeps the pickling overhead low
+            results = list(pool.map(_household_routine, work,
+                                    chunksize=max(1, len(work) // (workers * 4))))
+    phones = {member.id: member.phone for member in members}
+    for household_id, names, error in results:
+        if error is not None:
+            print(f"Routine failed for household {household_id}: {error}")
+            failed.append(household_id)
+            continue
+        try:
+            # thousands of alerts at once, wait for room in the outbox
+            alert_user(",".join(names), to=phones[household_id] or None, block=True)
+        except Exception as e:
+            print(f"Cannot be alerted for condition {e}")
+            failed.append(household_id)
+    summary = {"success": not failed, "households": len(members), "grid_cells": len(cells),
+               "failed": failed}
+    if failed:
+        summary["error"] = f"Routine failed for {len(failed)} of {len(members)} households"
+    else:
+        summary["msg"] = "Inventory refreshed successfully"
+    return summary
 
 def routine_agent():
     try:
-
-        cond = check_spoilage()
-        if cond["success"]:
-            cond2 = routine_msg()
-            return cond2
-        else: 
-            return cond
+        if households.get_registry().single:
+            return run_routine()
+        return run_all_households()
     except Exception as e:
         return {"success": False, "error": e}
             
 
     
 
+def compact_households():
+    """ compacts every household's inventory: folds its journal into a snapshot
+        or checkpoints its WAL, and drops expired flagged items """
+    members = households.get_registry().all()
+    removed = 0
+    failed = []
+    for member in members:
+        try:
+            removed += households.store_for(member).compact()
+        except Exception as e:
+            print(f"Compaction failed for household {member.id}: {e}")
+            failed.append(member.id)
+    summary = {"success": not failed, "households": len(members), "removed": removed,
+               "failed": failed}
+    if failed:
+        summary["error"] = f"Compaction failed for {len(failed)} of {len(members)} households"
+    return summary
+
+def make_scheduler(path=scheduler.state_file):
+    """ scheduler with the daily routine and the inventory compaction"""
+    sched = scheduler.Scheduler(path)
+    sched.add("routine", routine_agent, at=EXECUTION_TIME)
+    sched.add("compact", compact_households, every=COMPACT_EVERY_HOURS * 3600)
+    print(f"Scheduler initialized. Routine is set to run daily at {EXECUTION_TIME} (local time).")
+    return sched
+
 def run_scheduler():
     """
-    This loop continuously checks if a scheduled job is due to run.
+    Runs the scheduled jobs in the foreground, sleeping until the next one is due.
     """
-    while True:
-        try:
-            # Check for any pending jobs
-            schedule.run_pending()
-        except Exception as e:
-            # Simple error handling for robustness
-            print(f"An error occurred in the scheduler loop: {e}")
-            
-        # The scheduler checks every 60 seconds (adjust as needed, 1 second is fine)
-        time.sleep(1)
-schedule.every().day.at(EXECUTION_TIME).do(routine_agent) 
-print(f"Scheduler initialized. Routine is set to run daily at {EXECUTION_TIME} (local time).")
+    make_scheduler().run_forever()
 
 
 if __name__ == "__main__":
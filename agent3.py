@@ -1,8 +1,13 @@
-import requests
 import json
+import re
 import time
 import os
+import threading
+from typing import Callable, List, Optional
 from dotenv import load_dotenv
+from fileio import atomic_write, flock
+import households
+import metrics
 
 # the third Agent (LLM) that checks for nearby centers, NGOs for donation
 # Gets into work if the user sends a whatsapp message Donate.
@@ -12,13 +17,40 @@ load_dotenv()
 
 API_KEY = os.getenv("API_KEY")
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent"
-# Have used my home location.
-location = "Dhakuria area of Kolkata in India"
+# location of the default household, others pass their own
+location = households.HOME_LOCATION
+donation_cache_file = os.getenv("DONATION_CACHE_FILE", "donation_cache.json")
+# food banks near a fixed location rarely change
+DONATION_CACHE_TTL = float(os.getenv("DONATION_CACHE_TTL", str(7 * 24 * 3600)))
+# older than this the answer is not served at all and the user waits for a new search
+DONATION_CACHE_MAX_STALE = float(os.getenv("DONATION_CACHE_MAX_STALE", str(60 * 24 * 3600)))
 
+# Donation centers accept broad kinds of food, so the search and its cache key
+# use these categories instead of the exact flagged item names. Keywords are
+# whole words, the longest one found in a name decides ("peanut butter").
+FOOD_CATEGORIES = {
+    "fruits": ["apple", "banana", "guava", "pear", "mango", "orange", "grape", "grapefruit",
+               "berry", "blueberry", "strawberry", "cherry", "papaya", "pineapple", "watermelon",
+               "lemon", "lime"],
+    "vegetables": ["gourd", "carrot", "bean", "beet", "okra", "cauliflower", "cabbage",
+                   "potato", "onion", "tomato", "cucumber", "celery", "spinach", "leafy green",
+                   "brinjal", "eggplant", "pepper", "capsicum", "pumpkin", "radish"],
+    "dairy": ["milk", "buttermilk", "curd", "yogurt", "cheese", "butter", "paneer", "cream", "ghee"],
+    "bakery": ["bread", "bun", "cake", "biscuit", "cookie"],
+    "grains and pulses": ["rice", "wheat", "flour", "atta", "dal", "lentil", "pasta",
+                          "noodle", "oat"],
+    "sauces and spreads": ["ketchup", "sauce", "harissa", "jam", "pickle", "honey",
+                           "peanut butter"],
+    "snacks": ["chips", "lays", "chocolate", "namkeen", "cracker"],
+    }
+
+# error answers are returned as text starting with "Agent 3:"
+@metrics.timed("find_donation_centers", failed=lambda text: text.startswith("Agent 3:"))
 def find_donation_centers(item_to_donate: str, location=location) -> str:
     """
     Uses the Gemini API with Google Search grounding to find local food donation centers.
     """
+    import requests
     print(f"Agent 3: Initiating search for donation centers accepting '{item_to_donate}' in '{location}'.")
 
     # The prompt directs the LLM to use the search tool and structure the output.
@@ -75,6 +107,136 @@ def find_donation_centers(item_to_donate: str, location=location) -> str:
             print(f"An unexpected error occurred: {e}")
             return "Agent 3: An internal processing error occurred."
 
+def _has_words(words: List[set], keyword: List[str]) -> bool:
+    """ keyword words found in a row among the name's words (and their singulars)"""
+    return any(all(part in words[start + i] for i, part in enumerate(keyword))
+               for start in range(len(words) - len(keyword) + 1))
+
+def food_categories(checklist: str) -> List[str]:
+    """
+    Maps the comma separated fetch_list checklist to a sorted, de-duplicated
+    list of food categories. Unknown items count as packaged food.
+    """
+    # names are normalized like the shelf life lookup; mytools (pandas) is
+    # already loaded by the Donate handler that gets here
+    from mytools import ShelfLifeIndex
+    categories = set()
+    for item in checklist.split(","):
+        words = [set(ShelfLifeIndex.variants(word))
+                 for word in re.findall(r"[a-z]+", ShelfLifeIndex.normalize(item))]
+        if not words:
+            continue
+        best, best_length = "packaged food", 0
+        for category, keywords in FOOD_CATEGORIES.items():
+            for keyword in keywords:
+                parts = keyword.split()
+                if len(parts) > best_length and _has_words(words, parts):
+                    best, best_length = category, len(parts)
+        categories.add(best)
+    return sorted(categories)
+
+class DonationCache:
+    """
+    Persistent cache of donation center searches keyed by location and food
+    categories. A fresh entry is returned straight away. An entry past its TTL
+    is still returned straight away while a background thread runs the search
+    again. Only a missing or very old entry makes the caller wait for Gemini.
+    """
+    def __init__(self, path: str = donation_cache_file, ttl: float = DONATION_CACHE_TTL,
+                 max_stale: float = DONATION_CACHE_MAX_STALE,
+                 search: Optional[Callable[[str, str], str]] = None):
+        self.path = path
+        self.ttl = ttl
+        self.max_stale = max_stale
+        # looked up at call time so a replaced find_donation_centers is used
+        self.search = search or (lambda items, place: find_donation_centers(items, place))
+        self.counters = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fl:
+                return json.load(fl)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        """ atomic rewrite, caller holds the lock. Other processes share the
+            file, their entries stored since it was read are merged in first"""
+        with flock(self.path + ".lock"):
+            for key, entry in self._load().items():
+                if key not in self._entries or entry["fetched"] > self._entries[key]["fetched"]:
+                    self._entries[key] = entry
+            with atomic_write(self.path, prefix=".donation-", suffix=".json") as fl:
+                json.dump(self._entries, fl)
+
+    @staticmethod
+    def key(place: str, categories: List[str]) -> str:
+        return " ".join(place.lower().split()) + "|" + ",".join(categories)
+
+    def _search_and_store(self, key: str, place: str, categories: List[str]) -> str:
+        text = self.search(", ".join(categories), place)
+        # error answers from find_donation_centers are not worth keeping
+        if not text.startswith("Agent 3:"):
+            with self._lock:
+                self._entries[key] = {"text": text, "fetched": time.time()}
+                self._save()
+        return text
+
+    def _refresh(self, key: str, place: str, categories: List[str]):
+        try:
+            self._search_and_store(key, place, categories)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, checklist: str, place: str = location) -> str:
+        categories = food_categories(checklist)
+        key = self.key(place, categories)
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.time() - entry["fetched"] if entry else None
+            if entry and age < self.ttl:
+                self.counters["hits"] += 1
+                return entry["text"]
+            if entry and age < self.max_stale:
+                self.counters["stale_hits"] += 1
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    self.counters["refreshes"] += 1
+                    threading.Thread(target=self._refresh, args=(key, place, categories),
+                                     daemon=True).start()
+                return entry["text"]
+            self.counters["misses"] += 1
+        return self._search_and_store(key, place, categories)
+
+_donation_cache = None
+_donation_cache_lock = threading.Lock()
+
+def get_donation_cache() -> DonationCache:
+    global _donation_cache
+    if _donation_cache is None:
+        with _donation_cache_lock:
+            if _donation_cache is None:
+                _donation_cache = DonationCache()
+    return _donation_cache
+
+@metrics.register_collector
+def _donation_metrics():
+    if _donation_cache is None:
+        return
+    yield ("pantry_donation_cache_lookups_total", "counter", "Donation searches by cache outcome",
+           [({"outcome": outcome}, count) for outcome, count in _donation_cache.counters.items()])
+
+def find_donation_centers_cached(checklist: str, location=location) -> str:
+    """
+    find_donation_centers for the categories of the flagged items, answered
+    from the donation cache when possible.
+    """
+    return get_donation_cache().get(checklist, location)
+
 # driver code
 if __name__ == '__main__':
     
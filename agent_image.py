@@ -1,27 +1,231 @@
-import google.generativeai as genai
 import io
 import asyncio
-import base64
-from typing import Dict, List, Optional, Any
-from PIL import Image
-from dataclasses import dataclass
+import math
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Any, Tuple
+from PIL import Image, ImageOps
+from dataclasses import dataclass, field
 import mytools
+import ocr_cache
+import metrics
 import json
 import os
 from dotenv import load_dotenv
 # Image processing agent. Uses Gemini OCR to detect and extract image info 
+# google.generativeai takes over a second to import, it is imported and
+# configured when the first model is built, not when this module loads
+# By default the model answers in JSON constrained by EXTRACTION_SCHEMA, so
+# the prompt no longer spells out the format and the reply is parsed as is.
+# The prompt is a system instruction, kept in a context cache on the Gemini
+# side when the API accepts it (it needs a versioned model and a minimum
+# prompt size). Token counts and latency of every call are added to
+# processor.usage and to the metrics.
 
 load_dotenv()
 api_key = os.getenv("API_KEY")
-genai.configure(api_key = api_key)
+_genai = None
+_genai_lock = threading.Lock()
+
+MAX_CONCURRENT_IMAGES = int(os.getenv("MAX_CONCURRENT_IMAGES", "8"))
+# OCR_STRUCTURED=0 goes back to a free text reply searched for a JSON object
+STRUCTURED_OUTPUT = os.getenv("OCR_STRUCTURED", "1") != "0"
+# seconds the prompt cache lives, renewed while in use. Off by default: the
+# extraction prompt is under the API's minimum size for a context cache and
+# every create call would be refused
+PROMPT_CACHE_TTL = int(os.getenv("OCR_PROMPT_CACHE_TTL", "0"))
+
+# the items shape mytools.fresh_stocks_format consumes
+EXTRACTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "success": {"type": "BOOLEAN"},
+        "items": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "type": {"type": "STRING", "enum": ["grocery", "packaged"]},
+                    "name": {"type": "STRING"},
+                    "expiry_date": {"type": "STRING", "nullable": True},
+                    "mfg_date": {"type": "STRING", "nullable": True},
+                    "time_remaining": {"type": "INTEGER", "nullable": True},
+                    "time_denom": {"type": "STRING", "enum": ["d", "m"], "nullable": True},
+                    },
+                "required": ["type", "name"],
+                },
+            },
+        "error": {"type": "STRING", "nullable": True},
+        "confidence_score": {"type": "NUMBER"},
+        },
+    "required": ["success", "items", "confidence_score"],
+    }
+
+gemini_tokens = metrics.registry.counter(
+    "pantry_gemini_tokens_total", "Tokens of the image extraction calls", ["kind"])
+# preprocessing latency is the image_preprocess stage histogram
+preprocess_bytes = metrics.registry.counter(
+    "pantry_image_preprocess_bytes_total", "Encoded image bytes before and after preprocessing",
+    ["direction"])
+
+def _crop_from_env() -> Optional[Tuple[float, float, float, float]]:
+    value = os.getenv("IMG_CROP_BOX")
+    return tuple(float(v) for v in value.split(",")) if value else None
+
+@dataclass
+class PreprocessConfig:
+    """Settings for the image preprocessing stage, defaults from the env"""
+    enabled: bool = os.getenv("IMG_PREPROCESS", "1") != "0"
+    max_edge: int = int(os.getenv("IMG_MAX_EDGE", "1600"))
+    jpeg_quality: int = int(os.getenv("IMG_JPEG_QUALITY", "85"))
+    # label region as fractions of width and height (left, top, right, bottom)
+    crop_box: Optional[Tuple[float, float, float, float]] = field(default_factory=_crop_from_env)
+
+class ImagePreprocessor:
+    """Shrinks uploads before OCR: applies EXIF orientation, optionally crops
+        to the label region, downscales to max_edge and re-encodes as JPEG
+        without metadata. Label reading does not need 12 MP phone photos."""
+    def __init__(self, config:Optional[PreprocessConfig] = None):
+        self.config = config or PreprocessConfig()
+    def _open(self, image_data:Any) -> Tuple[Image.Image, int]:
+        """PIL image and the size of the encoded input in bytes"""
+        if isinstance(image_data, str):
+            return Image.open(image_data), os.path.getsize(image_data)
+        if isinstance(image_data, bytes):
+            return Image.open(io.BytesIO(image_data)), len(image_data)
+        return image_data, 0
+    @metrics.timed("image_preprocess")
+    def process(self, image_data:Any) -> Tuple[Any, Dict]:
+        """Returns the model input (a JPEG blob) and stats for this image.
+            Decoding is CPU bound, call it off the event loop"""
+        start = time.perf_counter()
+        image, bytes_in = self._open(image_data)
+        original_size = image.size
+        if image.format == "JPEG":
+            # let the decoder scale down by powers of two while decoding. The
+            # box keeps the aspect ratio: draft only reduces while both sides
+            # stay above it, a square box never reduces a 4:3 photo
+            width, height = image.size
+            if self.config.crop_box:
+                left, top, right, bottom = self.config.crop_box
+                width, height = width * (right - left), height * (bottom - top)
+            scale = self.config.max_edge / max(width, height)
+            if scale < 1:
+                image.draft("RGB", (math.ceil(image.size[0] * scale), math.ceil(image.size[1] * scale)))
+        image = ImageOps.exif_transpose(image)
+        if self.config.crop_box:
+            left, top, right, bottom = self.config.crop_box
+            width, height = image.size
+            image = image.crop((int(left * width), int(top * height),
+                                int(right * width), int(bottom * height)))
+        image.thumbnail((self.config.max_edge, self.config.max_edge), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        # no exif or icc data is passed on, so metadata is stripped
+        image.save(out, format="JPEG", quality=self.config.jpeg_quality, optimize=True)
+        data = out.getvalue()
+        elapsed = time.perf_counter() - start
+        stats = {
+            "bytes_in": bytes_in,
+            "bytes_out": len(data),
+            "bytes_saved": max(bytes_in - len(data), 0),
+            "original_size": original_size,
+            "final_size": image.size,
+            "latency_ms": round(elapsed * 1000, 1),
+            }
+        preprocess_bytes.inc("in", amount=bytes_in)
+        preprocess_bytes.inc("out", amount=len(data))
+        print(f"Preprocessed image {original_size} -> {image.size}, "
+              f"{bytes_in} -> {len(data)} bytes in {stats['latency_ms']} ms")
+        return {"mime_type": "image/jpeg", "data": data}, stats
+
+def get_genai():
+    """google.generativeai, imported and configured with API_KEY on first use"""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai
+                genai.configure(api_key = api_key)
+                _genai = genai
+    return _genai
 
 class GeminiReceiptProcessor:
     """Handles receipt image processing using Gemini API"""
-    def __init__(self, model_name:str = "gemini-flash-latest"):
-        self.model = genai.GenerativeModel(model_name)
+    def __init__(self, model_name:str = "gemini-flash-latest", model:Any = None,
+                 preprocessor:Optional[ImagePreprocessor] = None, cache:Any = None,
+                 structured:bool = STRUCTURED_OUTPUT, prompt_cache_ttl:int = PROMPT_CACHE_TTL,
+                 genai:Any = None):
+        self.model_name = model_name
+        self.structured = structured
+        self.prompt_cache_ttl = prompt_cache_ttl
+        self.generation_config = {"response_mime_type": "application/json",
+                                  "response_schema": EXTRACTION_SCHEMA} if structured else None
         self.extraction_prompt = self._create_extraction_prompt()
+        self.usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                      "output_tokens": 0, "seconds": 0.0}
+        self._usage_lock = threading.Lock()
+        self._genai = genai
+        self._prompt_cache = None
+        self._prompt_cache_expires = 0.0
+        self._prompt_cache_lock = threading.Lock()
+        # True when the model was built with the prompt and the config
+        self._model_has_prompt = False
+        # model can be injected, anything with generate_content(_async) works
+        self.model = model if model is not None else self._build_model()
+        self.preprocessor = preprocessor or ImagePreprocessor()
+        # None uses the shared OCR cache, False turns caching off
+        self.cache = ocr_cache.get_cache() if cache is None else (cache or None)
+    def _build_model(self) -> Any:
+        """GenerativeModel for model_name. In structured mode the prompt and
+            schema go into the model, the prompt through a context cache if
+            one can be created"""
+        genai = self._genai or get_genai()
+        if not self.structured:
+            return genai.GenerativeModel(self.model_name)
+        self._model_has_prompt = True
+        # only with OCR_PROMPT_CACHE_TTL set: the extraction prompt is about 530
+        # tokens, under the API's 1024 token minimum for a context cache, so
+        # create is refused until the prompt grows. Explicit caching may also
+        # need a pinned model version rather than gemini-flash-latest
+        if self.prompt_cache_ttl > 0:
+            try:
+                self._prompt_cache = genai.caching.CachedContent.create(
+                    model=self.model_name, system_instruction=self.extraction_prompt,
+                    ttl=timedelta(seconds=self.prompt_cache_ttl))
+                self._prompt_cache_expires = time.monotonic() + self.prompt_cache_ttl
+                return genai.GenerativeModel.from_cached_content(
+                    self._prompt_cache, generation_config=self.generation_config)
+            except Exception as e:
+                print(f"Prompt cache not available, sending the prompt with every call : {e}")
+                self._prompt_cache = None
+        return genai.GenerativeModel(self.model_name, system_instruction=self.extraction_prompt,
+                                     generation_config=self.generation_config)
+    def _renew_prompt_cache(self):
+        """Extends the cache before it expires, builds the model again if it is gone"""
+        with self._prompt_cache_lock:
+            if time.monotonic() < self._prompt_cache_expires - 60:
+                return
+            try:
+                self._prompt_cache.update(ttl=timedelta(seconds=self.prompt_cache_ttl))
+                self._prompt_cache_expires = time.monotonic() + self.prompt_cache_ttl
+            except Exception as e:
+                print(f"Prompt cache could not be renewed, creating it again : {e}")
+                self.model = self._build_model()
     def _create_extraction_prompt(self) -> str:
         """Create a comprehensive prompt for data extraction from image"""
+        if self.structured:
+            # the reply format is enforced by the response schema
+            return self._extraction_rules() + """
+        Fill every item with its type, name, expiry_date and mfg_date as
+        DD-MM-YYYY or null, time_remaining and time_denom or null.
+        If you cannot extract food information or the image is unclear,
+        set success to false, items to an empty list and give the reason in error.
+            """
+        return self._extraction_rules() + self._response_format()
+    def _extraction_rules(self) -> str:
         return """
         You are a food image data extraction expert.
         Analyze the uploaded image and
@@ -50,6 +254,9 @@ class GeminiReceiptProcessor:
         date, then the full date or the month that comes later than the other
         is going to be the expiry date. 
         5. Ignore all the non food items in the image.
+        """
+    def _response_format(self) -> str:
+        return """
         RESPONSE FORMAT:
         Return a JSON object with this exact structure:
         {
@@ -96,6 +303,7 @@ class GeminiReceiptProcessor:
             }
             ANALYZE THE IMAGE NOW:
             """
+    @metrics.timed("ocr")
     async def process_receipt_image(self, image_data:Any) -> Dict:
         """
             Process receipt image and extract medicine information
@@ -105,29 +313,101 @@ class GeminiReceiptProcessor:
                 Dictionary with extrcated medicine data
                 """
         try:
-            if isinstance(image_data, str):
+            key = phash = preprocess = None
+            if self.cache is not None:
+                key = await asyncio.to_thread(ocr_cache.content_key, image_data)
+                cached = await asyncio.to_thread(self.cache.get, key)
+                if cached is not None:
+                    print("Extraction served from OCR cache")
+                    return {"success" : True, "extracted_data" : cached, "cached" : True}
+            if self.preprocessor.config.enabled:
+                # decoding and re-encoding runs off the event loop
+                image, preprocess = await asyncio.to_thread(self.preprocessor.process, image_data)
+            elif isinstance(image_data, str):
                 # For file path
                 image = Image.open(image_data)
             elif isinstance(image_data, bytes):
                 image = Image.open(io.BytesIO(image_data))
             else:
                 image = image_data
+            if self.cache is not None and self.cache.near_duplicates:
+                phash = await asyncio.to_thread(ocr_cache.perceptual_hash, image)
+                cached = await asyncio.to_thread(self.cache.get_near, phash)
+                if cached is not None:
+                    print("Extraction served from OCR cache (near duplicate)")
+                    await asyncio.to_thread(self.cache.put, key, cached, phash)
+                    return {"success" : True, "extracted_data" : cached, "cached" : True}
             # Now content generation to be placed here.
-            response = self.model.generate_content([self.extraction_prompt, image])
+            if self._model_has_prompt:
+                contents = [image]
+            else:
+                contents = [self.extraction_prompt, image]
+            response = await self._generate(contents)
             print(response.text)
             # Parse and check if json there
             extracted_data = self._parse_gemini_response(response.text)
-            return {"success" : True, "extracted_data" : extracted_data}
+            if self.cache is not None and extracted_data.get("success"):
+                await asyncio.to_thread(self.cache.put, key, extracted_data, phash)
+            result = {"success" : True, "extracted_data" : extracted_data}
+            if preprocess is not None:
+                # bytes saved and latency of this image
+                result["preprocess"] = preprocess
+            return result
         except Exception as e:
             return {
                 "success" : False,
                 "error" : f"Error processing image : {str(e)}",
                 "confidence_score" : 0.0
                 }
+    @metrics.timed("gemini_generate")
+    async def _generate(self, contents:List) -> Any:
+        """Awaits the model without blocking the event loop"""
+        if self._prompt_cache is not None and time.monotonic() > self._prompt_cache_expires - 60:
+            await asyncio.to_thread(self._renew_prompt_cache)
+        kwargs = {}
+        if self.generation_config and not self._model_has_prompt:
+            kwargs["generation_config"] = self.generation_config
+        start = time.perf_counter()
+        if hasattr(self.model, "generate_content_async"):
+            response = await self.model.generate_content_async(contents, **kwargs)
+        else:
+            response = await asyncio.to_thread(self.model.generate_content, contents, **kwargs)
+        self._record_usage(response, time.perf_counter() - start)
+        return response
+    def _record_usage(self, response:Any, seconds:float):
+        """Adds the token counts the API reports for one call to usage"""
+        usage = getattr(response, "usage_metadata", None)
+        # prompt_token_count includes the cached part
+        counts = {
+            "prompt_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+            "cached_tokens": getattr(usage, "cached_content_token_count", 0) or 0,
+            "output_tokens": getattr(usage, "candidates_token_count", 0) or 0,
+            }
+        with self._usage_lock:
+            self.usage["calls"] += 1
+            self.usage["seconds"] += seconds
+            for key, value in counts.items():
+                self.usage[key] += value
+        for key, value in counts.items():
+            if value:
+                gemini_tokens.inc(key[:-len("_tokens")], amount=value)
+    async def process_images(self, images:List[Any], concurrency:int = MAX_CONCURRENT_IMAGES) -> List[Dict]:
+        """Processes several images at once, at most concurrency model calls in flight"""
+        semaphore = asyncio.Semaphore(concurrency)
+        async def limited(image_data):
+            async with semaphore:
+                return await self.process_receipt_image(image_data)
+        return await asyncio.gather(*(limited(image) for image in images))
     def _parse_gemini_response(self, response_text : str) ->Dict:
         """Check and parse Json data from gemini reponse"""
         try:
             response_text = response_text.strip()
+            if self.structured:
+                try:
+                    # schema constrained replies are the JSON object and nothing else
+                    return self._checked(json.loads(response_text))
+                except json.JSONDecodeError:
+                    pass
             start_idx = response_text.find('{')
             end_idx = response_text.rfind('}')
             if start_idx == -1 or end_idx == -1:
@@ -138,40 +418,147 @@ class GeminiReceiptProcessor:
                     }
             json_str = response_text[start_idx:end_idx+1]
             extracted_data = json.loads(json_str) # dict conversion
-            # Validate the data extracted in json
-            if not self._validate_extracted_data(extracted_data):
-                return {
-                    "success" : False,
-                    "error" : "Invalid data structure returned",
-                    "confidence_score" : 0.0
-                    }
-            return extracted_data
+            return self._checked(extracted_data)
         except json.JSONDecodeError as e:
             return {
                 "success" : False,
                 "error" : f"Failed to parse JSON for error : {str(e)}",
                 "confidence_score" : 0.0
                 }
+    def _checked(self, extracted_data:Any) -> Dict:
+        """Validated data with unusable items dropped, or a failure dict"""
+        if not self._validate_extracted_data(extracted_data):
+            return {
+                "success" : False,
+                "error" : "Invalid data structure returned",
+                "confidence_score" : 0.0
+                }
+        items = extracted_data["items"]
+        if isinstance(items, dict):
+            items = [items]
+        usable = [item for item in items if self._validate_item(item)]
+        if len(usable) < len(items):
+            print(f"Dropped {len(items) - len(usable)} extracted items without a type or name")
+        if items and not usable:
+            return {
+                "success" : False,
+                "error" : "No usable items in the extracted data",
+                "confidence_score" : 0.0
+                }
+        extracted_data["items"] = usable
+        return extracted_data
     def _validate_extracted_data(self, data:Dict) -> bool:
         """Validate if essential fields are there"""
-        invalids = [None, "null", "", " "]
         required_fields = ["success", "items"]
-        for field in required_fields:
-            if field not in data:
+        if not isinstance(data, dict):
+            return False
+        for required in required_fields:
+            if required not in data:
+                return False
+        return isinstance(data["items"], (list, dict))
+    def _validate_item(self, item:Any) -> bool:
+        """An item fresh_stocks_format can turn into a stock row"""
+        invalids = [None, "null", "", " "]
+        if not isinstance(item, dict) or item.get("name") in invalids:
+            return False
+        if item.get("type") == "grocery":
+            return True
+        if item.get("type") != "packaged":
+            return False
+        if item.get("expiry_date") in invalids and item.get("mfg_date") not in invalids:
+            # mfg date plus a duration, the duration has to be a number
+            try:
+                int(item.get("time_remaining"))
+            except (TypeError, ValueError):
                 return False
         return True
-async def img_process(image_fl):
+_processor = None
+_processor_lock = threading.Lock()
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_processor() -> GeminiReceiptProcessor:
+    """One processor (model handle and prompt) per process, built on first use"""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = GeminiReceiptProcessor()
+    return _processor
+
+def set_processor(processor:Optional[GeminiReceiptProcessor]):
+    """Replaces the shared processor, e.g. with one wrapping a fake model"""
+    global _processor
+    _processor = processor
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Event loop running in a daemon thread, shared by every request thread.
+        The async model client stays bound to this one loop instead of a new
+        loop per upload from asyncio.run"""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="image-agent-loop",
+                                 daemon=True).start()
+                _loop = loop
+    return _loop
+
+def run_async(coro):
+    """Runs a coroutine on the shared loop and waits for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+async def img_process(image_fl, store=None):
     #image_file = "med_image.jpg"
-    image_agent = GeminiReceiptProcessor()
+    image_agent = get_processor()
     response = await image_agent.process_receipt_image(image_fl)
     if response["success"]:
-        updated = mytools.update_stock(response["extracted_data"])
+        # inventory writes are blocking, keep them off the event loop
+        updated = await asyncio.to_thread(mytools.update_stock, response["extracted_data"], store)
         return updated
     else:
         return {"success" : False, "message" : response["error"]}
-def upload_image(image_fl):
-    response = asyncio.run(img_process(image_fl))
+def upload_image(image_fl, store=None):
+    response = run_async(img_process(image_fl, store))
     return response
+def _stock_rows_per_image(responses:List[Dict]):
+    """Stock rows of every image, formatted one image at a time so an item
+        the formatting rejects (a malformed date) fails only its own image"""
+    frames = []
+    per_image = []
+    count = 0
+    for response in responses:
+        extracted = response.get("extracted_data") or {}
+        if not (response["success"] and extracted.get("success")):
+            error = response.get("error") or extracted.get("error", "No food items found")
+            per_image.append({"success" : False, "message" : error})
+            continue
+        items = extracted.get("items") or []
+        if isinstance(items, dict):
+            items = [items]
+        formatted = mytools.fresh_stocks_format({"success" : True, "items" : items})
+        if not formatted["success"]:
+            per_image.append({"success" : False, "message" : f"Unusable item data: {formatted['error']}"})
+            continue
+        frames.append(formatted["data"])
+        per_image.append({"success" : True, "items" : len(items)})
+        count += len(items)
+    return frames, per_image, count
+async def batch_process(images:List[Any], concurrency:int = MAX_CONCURRENT_IMAGES, store:Any = None) -> Dict:
+    """Extracts several images in parallel and adds the items of every image
+        that extracted and formatted cleanly to the inventory in one write.
+        Reports results per image"""
+    responses = await get_processor().process_images(images, concurrency)
+    frames, per_image, count = await asyncio.to_thread(_stock_rows_per_image, responses)
+    if not frames:
+        return {"success" : False, "message" : "No food items extracted from any image", "images" : per_image}
+    updated = await asyncio.to_thread(mytools.add_stock_rows, frames, store)
+    updated["images"] = per_image
+    updated["items"] = count
+    return updated
+def upload_images(images:List[Any], store:Any = None) -> Dict:
+    return run_async(batch_process(images, store=store))
     
     
 # python ImageAgent.py
@@ -1,14 +1,74 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, url_for, g, Response
 #import json
 from datetime import datetime
+import os
+import threading
+import time
 from werkzeug.utils import secure_filename
 import send_msg as msgapp
 import agent3
-import agent_image as ImageAgent
-import agent
-import mytools
+import jobs
+import households
+import metrics
+import uploads
+# agent, agent_image and mytools pull in pandas, numpy, PIL and the Gemini
+# client, they are imported by the handlers that need them so the app starts fast
 
 app = Flask(__name__)
+# uploads are streamed to temp files as they arrive, see uploads.py
+app.request_class = uploads.UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = uploads.MAX_CONTENT_LENGTH
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "20"))
+# the daily routine runs on a background thread of the web process, started
+# by start_scheduler() when the app is run as a script; set RUN_SCHEDULER=0
+# when python agent.py runs it standalone instead. Importing the app (a WSGI
+# server, the benches) starts nothing. Processes share the scheduler state
+# file, so a due run still happens only once.
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """The routine scheduler, built on first use"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                import agent
+                _scheduler = agent.make_scheduler()
+    return _scheduler
+
+def start_scheduler():
+    """Starts the scheduler thread unless RUN_SCHEDULER=0. Call it once per
+    server process, e.g. from a WSGI server's post-fork hook"""
+    if os.getenv("RUN_SCHEDULER", "1") == "0":
+        return
+    # started from a thread, the agent imports do not hold up the first request
+    threading.Thread(target=lambda: get_scheduler().start(), name="scheduler-start",
+                     daemon=True).start()
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Latency of every request by route, method and status for /metrics"""
+    started = g.pop("started", None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.http_seconds.observe(time.perf_counter() - started, endpoint, request.method,
+                                     str(response.status_code))
+    return response
+
+@metrics.register_collector
+def _inventory_metrics():
+    """Row counts of the inventories this process has open, a scrape opens none"""
+    stores = households.open_stores().values()
+    yield ("pantry_inventory_rows", "gauge", "Items in the open inventories by status",
+           [({"status": "all"}, sum(store.count() for store in stores)),
+            ({"status": "flagged"}, sum(store.count_status("flagged") for store in stores))])
+    yield ("pantry_households", "gauge", "Households served",
+           [({}, len(households.get_registry().all()))])
 
 @app.route('/')
 def index():
@@ -16,11 +76,44 @@ def index():
     return render_template('index.html')
 
 
+def handle_message(whatsapp_num, body):
+    """Runs on a message worker, the reply goes out through send_msg"""
+    household = households.get_registry().by_phone(whatsapp_num)
+    if household is None:
+        print(f"Message from unknown number {whatsapp_num} ignored")
+        return {"success": False, "message": "Unknown household"}
+    if body == 'Donate':
+        import mytools
+        items = mytools.fetch_list(households.store_for(household))
+        if items["success"]:
+            print(f"Sending the RAG response to this number: {whatsapp_num}")
+            msg = agent3.find_donation_centers_cached(items["checklist"], household.location)
+    
+            message = f"Thank You for choosing to donate. You can consider the following centers\n"+msg
+            msgapp.send_message(message, to=household.phone or None)
+            return {"success": True, "message": "Donation centers sent"}
+        else:
+            print(f"Sorry system has encountered an error {items['error']}")
+            return {"success": False, "message": str(items["error"])}
+    return {"success": True, "message": "Nothing to do"}
+
+def first_delivery(message_sid):
+    """False if this MessageSid was already accepted, Twilio retries slow webhooks"""
+    if not message_sid:
+        return True
+    return jobs.seen_messages.first(message_sid)
+
+def forget_delivery(message_sid):
+    if message_sid:
+        jobs.seen_messages.forget(message_sid)
+
 @app.route("/message", methods=['POST'])
 def reply():
     """
     Handles incoming messages (e.g., from WhatsApp/Twilio webhook) and sends a
     RAG-generated response back to the user.
+    The webhook is acknowledged at once, the search and the reply happen on a
+    background worker.
     """
     try:
         # Access data synchronously
@@ -33,23 +126,64 @@ def reply():
         if not whatsapp_num or not body:
              print("Error: Missing 'From' or 'Body' in webhook data.")
              return "Missing data", 400
-        if body == 'Donate':
-            items = mytools.fetch_list()
-            if items["success"]:
-                print(f"Sending the RAG response to this number: {whatsapp_num}")
-                msg = agent3.find_donation_centers(items["checklist"])
-        
-                message = f"Thank You for choosing to donate. You can consider the following centers\n"+msg
-                msgapp.send_message(message)
-                return ""
-            else:
-                print(f"Sorry system has encountered an error {items['error']}")
+        message_sid = form_data.get('MessageSid', '')
+        if not first_delivery(message_sid):
+            print(f"Duplicate delivery of {message_sid} ignored")
+            return ""
+        try:
+            jobs.message_jobs.submit(handle_message, whatsapp_num, body)
+        except jobs.QueueFull as e:
+            # let Twilio retry this one later
+            forget_delivery(message_sid)
+            print(f"Message rejected, queue full: {e}")
+            return "Busy", 503
+        return ""
             
     except Exception as e:
         print(f"An error occurred during message processing: {e}")
         # Return a non-200 status code to signal failure 
         return "Internal Server Error", 500
     
+def household_store():
+    """Inventory partition named by the 'household' form field, default one if absent"""
+    household = households.get_registry().get(request.form.get('household'))
+    if household is None:
+        raise LookupError(f"Unknown household {request.form.get('household')}")
+    return households.store_for(household)
+
+def process_upload(filename, upload, store=None):
+    """Runs on an upload worker: OCR, then the inventory update"""
+    import agent_image as ImageAgent
+    try:
+        result = ImageAgent.upload_image(upload.source(), store)
+    finally:
+        upload.discard()
+    print("Upload result:", result)
+    if result["success"]:
+        message = f"File '{filename}' uploaded successfully and inventory updated"
+        return {"success": True, "message": message, "plan": result.get("msg", "Inventory updated")}
+    else:
+        message = f'Upload failed: {result.get("error", result.get("message", "Unknown error"))}'
+        return {"success": False, "message": message}
+
+def process_batch(filenames, files, store=None):
+    """Runs on an upload worker: parallel OCR, then one inventory update"""
+    import agent_image as ImageAgent
+    try:
+        result = ImageAgent.upload_images([upload.source() for upload in files], store)
+    finally:
+        for upload in files:
+            upload.discard()
+    print("Batch upload result:", result)
+    images = [dict(image, file=name) for name, image in zip(filenames, result["images"])]
+    failed = sum(1 for image in images if not image["success"])
+    if result["success"]:
+        message = f"{len(filenames) - failed} of {len(filenames)} files processed and inventory updated with {result['items']} items"
+        return {"success": True, "message": message, "plan": result.get("msg", "Inventory updated"), "images": images}
+    else:
+        message = f'Upload failed: {result.get("error", result.get("message", "Unknown error"))}'
+        return {"success": False, "message": message, "images": images}
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     #Checking if image file key is in the request.files dictionary
@@ -63,33 +197,112 @@ def upload_file():
         return jsonify({"success":False, "message": "No selected file"}), 400
     # 4. If a file is present and has a filename proceed
     if file:
+        upload = None
         try:
             # Sanitize file name
             filename = secure_filename(file.filename)
-            # read file bytes
-            file_bytes = file.read()
-            result = ImageAgent.upload_image(file_bytes)
-            print("Upload result:", result)
-            if result["success"]:
-                message = f"File '{filename}' uploaded successfully and inventory updated"
-                return jsonify({"success": True, "message": message, "plan": result.get("msg", "Inventory updated")})
-            else:
-                message = f'Upload failed: {result.get("error", result.get("message", "Unknown error"))}'
-                return jsonify({"success": False, "message": message}), 500
+            store = household_store()
+            # the file is already spooled, only its header is checked here
+            upload = uploads.accept(file)
+            # the model call and inventory update run on an upload worker
+            job_id = jobs.upload_jobs.submit(process_upload, filename, upload, store)
+            return jsonify({
+                "success": True,
+                "message": f"File '{filename}' received, processing",
+                "job_id": job_id,
+                "status_url": url_for("job_status", job_id=job_id)
+                }), 202
+        except LookupError as e:
+            return jsonify({"success": False, "message": str(e)}), 404
+        except uploads.InvalidImage as e:
+            return jsonify({"success": False, "message": e.description}), 400
+        except jobs.QueueFull as e:
+            print(f"Upload rejected, queue full: {e}")
+            upload.discard()
+            return jsonify({"success": False, "message": "Server busy, please retry shortly"}), 503, {"Retry-After": "5"}
         except Exception as e:
             print(f"Error occured {e}")
+            if upload is not None:
+                upload.discard()
             return jsonify({"success": False, "message": "An error occurred during file processing."}), 500
      # This is a fallback, though the checks above should cover most cases
     return jsonify({"success": False, "message": "Unknown error occurred"}), 500
 
+@app.route('/upload-batch', methods=['POST'])
+def upload_batch():
+    """Several images in one request, extracted in parallel"""
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({"success":False, "message":"No files in the request"}), 400
+    if len(files) > MAX_BATCH_IMAGES:
+        return jsonify({"success":False, "message":f"At most {MAX_BATCH_IMAGES} files per batch"}), 400
+    accepted = []
+    try:
+        filenames = [secure_filename(file.filename) for file in files]
+        store = household_store()
+        for file in files:
+            accepted.append(uploads.accept(file))
+        job_id = jobs.upload_jobs.submit(process_batch, filenames, accepted, store)
+        return jsonify({
+            "success": True,
+            "message": f"{len(files)} files received, processing",
+            "job_id": job_id,
+            "status_url": url_for("job_status", job_id=job_id)
+            }), 202
+    except LookupError as e:
+        return jsonify({"success": False, "message": str(e)}), 404
+    except uploads.InvalidImage as e:
+        for upload in accepted:
+            upload.discard()
+        return jsonify({"success": False, "message": f"{secure_filename(file.filename)}: {e.description}"}), 400
+    except jobs.QueueFull as e:
+        print(f"Batch upload rejected, queue full: {e}")
+        for upload in accepted:
+            upload.discard()
+        return jsonify({"success": False, "message": "Server busy, please retry shortly"}), 503, {"Retry-After": "5"}
+    except Exception as e:
+        print(f"Error occured {e}")
+        for upload in accepted:
+            upload.discard()
+        return jsonify({"success": False, "message": "An error occurred during file processing."}), 500
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    """Request over MAX_CONTENT_LENGTH or a file over MAX_UPLOAD_BYTES"""
+    if isinstance(e, uploads.UploadTooLarge):
+        message = e.description
+    else:
+        message = f"Requests are limited to {uploads.MAX_CONTENT_LENGTH // (1024 * 1024)} MB"
+    return jsonify({"success": False, "message": message}), 413
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status of a queued upload: queued, running, done or failed"""
+    job = jobs.upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "Unknown job"}), 404
+    body = {"success": job["status"] != "failed", "job_id": job_id, "status": job["status"]}
+    if job["result"] is not None:
+        body.update(job["result"])
+    return jsonify(body)
+
 @app.route('/update-inventory', methods=['POST'])
 def update_inventory():
-    """Update pantry inventory using the routine agent"""
+    """Refresh the inventory of the household named by the 'household' form
+    field, the default one if absent. The scheduled routine covers them all"""
     try:
-        # Call the routine agent function
-        result = agent.routine_agent()
+        household = households.get_registry().get(request.form.get('household'))
+        if household is None:
+            return jsonify({"success": False,
+                            "message": f"Unknown household {request.form.get('household')}"}), 404
+        import agent
+        # never alongside a scheduled run
+        with get_scheduler().exclusive("routine") as free:
+            if not free:
+                return jsonify({"success": False, "message": "The routine is already running"}), 409
+            result = agent.run_routine(household=household)
         
-        if result:
+        if result.get("success"):
             return jsonify({
                 "success": True, 
                 "message": "Inventory updated successfully",
@@ -98,7 +311,7 @@ def update_inventory():
         else:
             return jsonify({
                 "success": False,
-                "message": result["error"]
+                "message": str(result["error"])
             }), 500
             
     except Exception as e:
@@ -109,5 +322,20 @@ def update_inventory():
         }), 500
     
     
+@app.route('/scheduler', methods=['GET'])
+def scheduler_status():
+    """Next run, last duration and outcome of every scheduled job"""
+    return jsonify({"success": True, "jobs": get_scheduler().stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Stage timings, error counts, queue depths and row counts for Prometheus"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
+        from werkzeug.serving import is_running_from_reloader
+        # in debug the parent process only watches for changes, the scheduler
+        # runs in the child that serves requests
+        if is_running_from_reloader():
+            start_scheduler()
         app.run(debug=True)
@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent3
+
+# Donation search cache against a fake grounded search that takes --latency
+# seconds: the first request waits for the search, repeats and requests for
+# other items of the same categories answer in milliseconds, and an expired
+# entry is answered at once while the search runs again in the background.
+# Two processes sharing the file keep each other's entries.
+# python bench/bench_donation.py --latency 2
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Donation cache benchmark")
+    parser.add_argument("--latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    searches = []
+
+    def slow_search(items, place):
+        searches.append(items)
+        time.sleep(args.latency)
+        return f"1. Food Bank for {items}, Some Street, 0000"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "donation_cache.json")
+        cache = agent3.DonationCache(path=path, ttl=60, search=slow_search)
+        for checklist in ["bananas,yogurt", "banana,yogurt", "Apple, curd", "bananas,yogurt"]:
+            start = time.perf_counter()
+            cache.get(checklist)
+            print(f"{checklist!r:>18}: {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+        # a new process reads the same file
+        cache = agent3.DonationCache(path=path, ttl=0, search=slow_search)
+        start = time.perf_counter()
+        text = cache.get("guava,milk")
+        print(f"expired entry served in {(time.perf_counter() - start) * 1000:.1f} ms: {text}")
+        time.sleep(args.latency + 0.2)
+        print(f"{len(searches)} searches run, counters {cache.counters}")
+        assert len(searches) == 2
+
+        # two processes that opened the file before either stored anything
+        first = agent3.DonationCache(path=path, ttl=60, search=slow_search)
+        second = agent3.DonationCache(path=path, ttl=60, search=slow_search)
+        first.get("bread", "Pune")
+        second.get("rice", "Pune")
+        entries = agent3.DonationCache(path=path)._entries
+        for categories in (["bakery"], ["grains and pulses"]):
+            assert first.key("Pune", categories) in entries, \
+                f"an entry was overwritten, {sorted(entries)} on disk"
+        print(f"{len(entries)} entries on disk after two processes stored one each")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory_store
+
+# Expiry range queries on the journal backend, ExpiryIndex against a full scan
+# of the rows. Every query is also checked against the scan, after
+# adds, shifts, flags and updates have been applied through the journal.
+# python bench/bench_expiry_index.py --rows 200000 --queries 200
+
+
+def scan_until(store, until_day):
+    df = store.day_frame()
+    return sorted(df["id"][df["expiry_dt"] <= until_day].tolist())
+
+
+def scan_flagged(store):
+    df = store.day_frame()
+    return sorted(df["id"][df["status"] == "flagged"].tolist())
+
+
+def indexed(ids):
+    return np.sort(ids).tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expiry index benchmark")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    today = inventory_store.today_number()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench")
+        store = inventory_store.JournalStore(path + ".journal", path + ".snapshot",
+                                             seed_csv=None, fsync=False)
+        storages = ["counter", "fridge", "freezer", "NA"]
+        days = [today + rng.randint(-30, 400) for _ in range(args.rows)]
+        store.add_items(pd.DataFrame({
+            "name": [f"item-{i}" for i in range(args.rows)],
+            "expiry_dt": inventory_store.from_day_numbers(np.array(days)),
+            "status": "none",
+            "storage": [rng.choice(storages) for _ in range(args.rows)],
+            }))
+        store.shift_expiry("counter", -1)
+        names = store.flag_expiring(today + 3)
+        df = store.frame()
+        ids = df["id"].tolist()[:1000]
+        store.update_rows(ids, [today + 10] * len(ids), ["none"] * len(ids))
+        store.shift_expiry("fridge", 2)
+
+        assert indexed(store._index.expiring_until(today + 3)) == scan_until(store, today + 3)
+        assert indexed(store._index.flagged()) == scan_flagged(store)
+        status = store.day_frame().set_index("id")["status"]
+        assert names and all(status[row_id] == "flagged"
+                             for row_id in indexed(store._index.expiring_until(today + 3))
+                             if row_id not in set(ids))
+
+        days = [today + rng.randint(0, 14) for _ in range(args.queries)]
+        start = time.perf_counter()
+        for day in days:
+            scanned = scan_until(store, day)
+        scan_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for day in days:
+            found = indexed(store._index.expiring_until(day))
+        index_time = time.perf_counter() - start
+        assert found == scanned
+
+        start = time.perf_counter()
+        for _ in range(args.queries):
+            store.shift_expiry("counter", 0)
+        shift_time = time.perf_counter() - start
+        store.compact()
+
+    per_scan = scan_time / args.queries * 1000
+    per_index = index_time / args.queries * 1000
+    print(f"{args.rows} rows, {args.queries} 'expiring within N days' queries")
+    print(f"full scan   {per_scan:8.3f} ms/query")
+    print(f"index       {per_index:8.3f} ms/query ({per_scan / per_index:.1f}x)")
+    print(f"shift       {shift_time / args.queries * 1000:8.3f} ms/call including the journal append")
+    print("OK: index matches the scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent
+import households
+import inventory_store
+import send_msg
+from fakes import FakeTransport, FakeWeatherServer
+
+# Daily routine across many households against a local OpenWeather stand-in
+# and a fake Twilio transport. Checks that every grid cell is fetched once,
+# every household gets its own alert with its own items, and times the run
+# with one worker process and with one per core. Then runs it while another
+# thread holds a lock the workers take, which hangs forked workers.
+# python bench/bench_households.py --households 1000 --cells 25
+
+
+def make_registry(tmp, count, cells, items):
+    path = os.path.join(tmp, "households.csv")
+    today = inventory_store.today_number()
+    rows = []
+    for i in range(count):
+        cell = i % cells
+        rows.append({"id": f"h{i}", "phone": f"+9100000{i:05d}",
+                     "lat": 10 + cell * 0.5 + 0.01, "lon": 70 + 0.02, "location": f"Area {cell}"})
+    pd.DataFrame(rows).to_csv(path, index=False)
+    households.household_dir = os.path.join(tmp, "households")
+    households._registry = households.HouseholdRegistry(path)
+    for member in households.get_registry().all():
+        # the first item of every household is close to expiry
+        days = np.array([today + 2] + [today + 30] * (items - 1))
+        households.store_for(member).add_items(pd.DataFrame({
+            "name": [f"{member.id}-item-{j}" for j in range(items)],
+            "expiry_dt": inventory_store.from_day_numbers(days),
+            "status": "none", "storage": "counter"}))
+
+
+def check_held_lock(timeout):
+    """ another thread of the parent holds households._stores_lock while the
+        pool starts, a forked worker would wait for it forever"""
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with households._stores_lock:
+            held.set()
+            release.wait()
+
+    threading.Thread(target=hold, daemon=True).start()
+    held.wait()
+    results = []
+    runner = threading.Thread(target=lambda: results.append(agent.run_all_households(processes=2)),
+                              daemon=True)
+    start = time.perf_counter()
+    runner.start()
+    runner.join(timeout)
+    release.set()
+    if not results:
+        print("FAILED: routine hung with a lock held during the pool start")
+        # the stuck workers would keep the interpreter alive
+        os._exit(1)
+    assert results[0]["success"], results[0]
+    print(f"routine with a lock held by another thread: {time.perf_counter() - start:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-household routine benchmark")
+    parser.add_argument("--households", type=int, default=1000)
+    parser.add_argument("--cells", type=int, default=25)
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=120.0,
+                        help="seconds before the held lock run counts as hung")
+    args = parser.parse_args()
+
+    transport = FakeTransport()
+    send_msg.set_transport(transport)
+    send_msg.get_dispatcher().coalesce_window = 0
+    with tempfile.TemporaryDirectory() as tmp, FakeWeatherServer(latency=args.latency) as server:
+        make_registry(tmp, args.households, args.cells, args.items)
+        agent.forecast_cache = agent.ForecastCache(url=server.url, api_key="test", ttl=0)
+        for processes in sorted({1, 2, os.cpu_count() or 1}):
+            server.requests = 0
+            transport.sent.clear()
+            start = time.perf_counter()
+            result = agent.run_all_households(processes=processes)
+            elapsed = time.perf_counter() - start
+            send_msg.flush()
+            assert result["success"], result
+            assert server.requests == args.cells, f"{server.requests} forecast fetches"
+            alerts = dict(transport.sent)
+            assert len(alerts) == args.households, f"{len(alerts)} households alerted"
+            assert "h7-item-0" in alerts["+910000000007"] and "h8-item" not in alerts["+910000000007"]
+            print(f"{args.households} households in {args.cells} grid cells, {processes} process(es): "
+                  f"{elapsed:.2f}s, {server.requests} forecast fetches, {len(alerts)} alerts")
+        check_held_lock(args.timeout)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchutil import export_revision
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import time of the app, measured with python -X importtime in fresh
+# interpreters. Fails when a module that should load lazily (the Gemini SDK,
+# pandas, numpy, PIL, Twilio) is imported by `import app`, or when the import
+# takes longer than --budget-ms. --compare REV measures the same import in
+# that git revision to show the difference.
+# The current tree is imported without any credentials in the environment.
+# python bench/bench_import.py
+# python bench/bench_import.py --compare HEAD~1 --runs 5
+
+LAZY = ["google.generativeai", "pandas", "numpy", "PIL", "twilio"]
+SECRETS = ["API_KEY", "WEATHER_API_KEY", "TWILIO_SID", "TWILIO_TOKEN", "TWILIO_NUMBER", "TO_NUMBER"]
+
+
+def import_profile(tree, module, env):
+    """ {module: cumulative microseconds} for one cold interpreter"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=tree, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"import {module} failed in {tree}:\n{result.stderr[-2000:]}")
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            profile[name.strip()] = int(cumulative)
+    return profile
+
+
+def measure(tree, module, env, runs):
+    # the first run writes the bytecode caches
+    import_profile(tree, module, env)
+    profiles = [import_profile(tree, module, env) for _ in range(runs)]
+    total = statistics.median(profile[module] for profile in profiles) / 1000
+    return total, profiles[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time benchmark")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=500)
+    parser.add_argument("--compare", help="git revision to measure as well")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    env = {key: value for key, value in os.environ.items() if key not in SECRETS}
+    env["RUN_SCHEDULER"] = "0"
+    with tempfile.TemporaryDirectory() as tmp:
+        total, profile = measure(ROOT, args.module, env, args.runs)
+        print(f"import {args.module}: {total:.0f} ms (median of {args.runs})")
+        children = sorted(((us, name) for name, us in profile.items()
+                           if "." not in name and name != args.module), reverse=True)
+        for us, name in children[:args.top]:
+            print(f"  {us / 1000:8.1f} ms  {name}")
+
+        if args.compare:
+            os.makedirs(os.path.join(tmp, "old"))
+            old_tree = export_revision(args.compare, os.path.join(tmp, "old"))
+            # older revisions need credentials at import time
+            old_env = dict(env, **{key: "x" for key in SECRETS})
+            old_env["TWILIO_SID"] = "ACx"
+            old_total, _ = measure(old_tree, args.module, old_env, args.runs)
+            print(f"import {args.module} at {args.compare}: {old_total:.0f} ms, "
+                  f"{old_total - total:.0f} ms ({(old_total - total) / old_total:.0%}) saved")
+
+    loaded = [name for name in LAZY if name in profile]
+    if loaded:
+        print(f"FAILED: import {args.module} loads {', '.join(loaded)}")
+        sys.exit(1)
+    if total > args.budget_ms:
+        print(f"FAILED: {total:.0f} ms is over the {args.budget_ms:.0f} ms budget")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
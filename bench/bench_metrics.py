@@ -0,0 +1,126 @@
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+from fakes import FakeGeminiModel, FakeTransport, FakeWeatherServer
+
+# Cost of the instrumentation and a check of GET /metrics. Times a no-op
+# function with and without metrics.timed, then drives /upload, /message and
+# /update-inventory against the local fakes and checks that every stage shows
+# up in the Prometheus output with the right counts. A scrape before any
+# request must not open an inventory store (pantry.db, pandas).
+# python bench/bench_metrics.py
+
+
+def overhead_ns(calls=200000):
+    def noop():
+        return {"success": True}
+    wrapped = metrics.timed("bench_noop")(noop)
+    best = {}
+    for name, fn in (("plain", noop), ("timed", wrapped)):
+        runs = []
+        for _ in range(5):
+            start = time.perf_counter_ns()
+            for _ in range(calls):
+                fn()
+            runs.append((time.perf_counter_ns() - start) / calls)
+        best[name] = min(runs)
+    return best["timed"] - best["plain"]
+
+
+def sample(text, name, **labels):
+    """ value of one sample in the exposition text, None if absent"""
+    wanted = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    prefix = f"{name}{{{wanted}}} " if labels else f"{name} "
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return None
+
+
+def main():
+    cost = overhead_ns()
+    print(f"metrics.timed overhead: {cost:.0f} ns per call")
+
+    with tempfile.TemporaryDirectory() as tmp, FakeWeatherServer() as weather:
+        os.chdir(tmp)
+        os.environ["RUN_SCHEDULER"] = "0"
+        import app as webapp
+        text = webapp.app.test_client().get("/metrics").get_data(as_text=True)
+        assert sample(text, "pantry_inventory_rows", status="all") == 0
+        assert "pandas" not in sys.modules and not os.path.exists("pantry.db"), \
+            "a scrape opened the inventory store"
+        print("scrape before any request opens no store")
+
+        import agent
+        import agent3
+        import agent_image
+        import jobs
+        import send_msg
+        from PIL import Image
+
+        transport = FakeTransport()
+        send_msg.set_transport(transport)
+        send_msg.get_dispatcher().coalesce_window = 0
+        agent.forecast_cache = agent.ForecastCache(url=weather.url, api_key="bench", ttl=0)
+        agent_image.set_processor(agent_image.GeminiReceiptProcessor(
+            model=FakeGeminiModel(latency=0.01), cache=False))
+        agent3._donation_cache = agent3.DonationCache(
+            path=os.path.join(tmp, "donation_cache.json"),
+            search=lambda checklist, place: "1. Food Bank, Some Street, 0000")
+        image = io.BytesIO()
+        Image.new("RGB", (800, 600), (120, 160, 90)).save(image, "JPEG")
+
+        client = webapp.app.test_client()
+        for i in range(3):
+            job_id = client.post("/upload", data={"file": (io.BytesIO(image.getvalue()), "a.jpg")}
+                                 ).get_json()["job_id"]
+            while jobs.upload_jobs.get(job_id)["status"] not in ("done", "failed"):
+                time.sleep(0.005)
+        client.post("/message", data={"From": "whatsapp:+1", "Body": "Donate", "MessageSid": "m1"})
+        client.post("/update-inventory")
+        weather_fail = agent.ForecastCache(url=weather.url, api_key="bench", ttl=0)
+        weather.fail = True
+        agent.forecast_cache = weather_fail
+        client.post("/update-inventory")
+        weather.fail = False
+        deadline = time.monotonic() + 5
+        while len(transport.sent) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        send_msg.flush()
+
+        response = client.get("/metrics")
+        text = response.get_data(as_text=True)
+        assert response.status_code == 200 and response.content_type.startswith("text/plain")
+
+    stage = "pantry_stage_duration_seconds_count"
+    checks = {
+        "ocr": 3, "gemini_generate": 3, "image_preprocess": 3, "update_stock": 3,
+        "fresh_stocks_format": 3, "fetch_weather": 2, "weather_api": 2, "send_message": 2,
+        }
+    for name, expected in checks.items():
+        value = sample(text, stage, stage=name)
+        assert value == expected, f"{name}: {value} calls recorded, {expected} expected"
+    assert sample(text, "pantry_stage_errors_total", stage="fetch_weather") == 1
+    assert sample(text, "pantry_stage_duration_seconds_count", stage="twilio_send") >= 2
+    assert sample(text, "pantry_stage_duration_seconds_count", stage="inventory_write") >= 4
+    assert sample(text, "pantry_inventory_rows", status="all") > 0
+    assert sample(text, "pantry_gemini_tokens_total", kind="prompt") > 0
+    assert sample(text, "pantry_image_preprocess_bytes_total", direction="out") > 0
+    assert sample(text, "pantry_http_request_duration_seconds_count",
+                  endpoint="/upload", method="POST", status="202") == 3
+    assert sample(text, "pantry_outbox_messages_total", outcome="sent") >= 2
+    print(f"/metrics: {len(text.splitlines())} lines, every stage recorded")
+    for line in text.splitlines():
+        if line.startswith(stage):
+            print("  " + line)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import agent_image
+from benchutil import open_store
+from fakes import FakeGeminiModel
+
+# Throughput of GeminiReceiptProcessor against a fake model with a fixed
+# latency. With a non-blocking model call the images per second should grow
+# roughly linearly with the concurrency limit until it reaches --images.
+# Then checks that a batch where one image has a malformed date stores the
+# items of the others and reports only that image as failed.
+# python bench/bench_ocr_concurrency.py --latency 0.2 --images 32
+
+
+class CannedProcessor:
+    """ process_images answering with fixed extractions, one per image"""
+    def __init__(self, extractions):
+        self.extractions = extractions
+
+    async def process_images(self, images, concurrency):
+        return [{"success": True, "extracted_data": extracted} for extracted in self.extractions]
+
+
+def check_bad_date_in_batch():
+    def item(name, expiry):
+        return {"type": "packaged", "name": name, "expiry_date": expiry, "mfg_date": None,
+                "time_remaining": None, "time_denom": None}
+    extractions = [
+        {"success": True, "items": [item("jam", "01-01-2099"), item("ghee", "02-01-2099")]},
+        {"success": True, "items": [item("curd", "14.09.2025")]},
+        {"success": True, "items": [item("bread", "03-01-2099")]},
+        ]
+    agent_image.set_processor(CannedProcessor(extractions))
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        store = open_store("sqlite", os.path.join(tmp, "pantry.db"))
+        result = agent_image.upload_images([None] * len(extractions), store)
+        names = sorted(store.frame()["name"])
+    agent_image.set_processor(None)
+    assert result["success"], result
+    assert [image["success"] for image in result["images"]] == [True, False, True], result["images"]
+    assert names == ["bread", "ghee", "jam"], names
+    print(f"batch with a malformed date: {len(names)} items stored, "
+          f"image 2 failed: {result['images'][1]['message'].splitlines()[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR concurrency benchmark")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    model = FakeGeminiModel(latency=args.latency)
+    # identical test images, the OCR cache would answer all but the first
+    processor = agent_image.GeminiReceiptProcessor(model=model, cache=False)
+    images = [Image.new("RGB", (64, 64), "yellow") for _ in range(args.images)]
+
+    print(f"{args.images} images, fake model latency {args.latency * 1000:.0f} ms")
+    baseline = None
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        results = agent_image.run_async(processor.process_images(images, concurrency))
+        elapsed = time.perf_counter() - start
+        ok = sum(1 for result in results if result["success"])
+        throughput = args.images / elapsed
+        baseline = baseline or throughput
+        print(f"concurrency {concurrency:>3}: {throughput:7.1f} images/s "
+              f"({throughput / baseline:4.1f}x), {ok}/{args.images} ok, {elapsed:.2f}s")
+    check_bad_date_in_batch()
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
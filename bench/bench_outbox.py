@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import send_msg
+from fakes import FakeTransport
+
+# Outbound queue against a fake Twilio that takes --latency seconds and fails
+# the first attempt: callers return at once, alerts for one recipient within
+# the coalescing window arrive as one digest, and the failed send is retried.
+# python bench/bench_outbox.py
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Outbound message queue check")
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    transport = FakeTransport(latency=args.latency, failures=1)
+    dispatcher = send_msg.MessageDispatcher(transport, backoff=0.1, coalesce_window=0.3)
+    start = time.perf_counter()
+    for name in ["banana", "yogurt", "celery"]:
+        dispatcher.send(f"Attention from your Pantry! {name} are getting spoiled", "+1000", coalesce=True)
+    dispatcher.send("Thank You for choosing to donate.", "+1000")
+    caller_ms = (time.perf_counter() - start) * 1000
+    assert dispatcher.flush(timeout=10)
+    print(f"4 sends returned to the caller in {caller_ms:.2f} ms, delivered in "
+          f"{time.perf_counter() - start:.2f}s with {transport.attempts} transport calls")
+    for to, body in transport.sent:
+        print(f"-> {to}: {body!r}")
+    print(f"counters {dispatcher.counters}")
+    assert caller_ms < 50 and len(transport.sent) == 2
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
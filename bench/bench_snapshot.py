@@ -0,0 +1,168 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory_store
+
+# Compact frames and binary snapshots against the csv path. For each size it
+# writes a synthetic sample_inventory.csv and compares the memory of the
+# object frame read from csv with the compact frame (categorical name, status
+# and storage, int32 days), then the write time, load time and file size of a
+# snapshot in every format available here (feather needs pyarrow), and the
+# time a JournalStore takes to open from a csv snapshot and a binary one.
+# Fails when a snapshot does not read back to the same rows. Finally checks
+# that compaction fsyncs the snapshot and its directory before emptying the
+# journal.
+# python bench/bench_snapshot.py --sizes 100000,1000000
+
+FOODS = ["banana", "apple", "guava", "pear", "mango", "carrot", "beans", "spinach",
+         "milk", "curd", "paneer", "bread", "tomato", "potato", "onion"]
+STORAGES = ["counter", "fridge", "freezer"]
+STATUSES = ["none", "open", "flagged"]
+
+
+def write_inventory(path, rows, rng):
+    today = date.today()
+    with open(path, "w") as fl:
+        fl.write("name,expiry_dt,status,storage\n")
+        for i in range(rows):
+            expiry = today + timedelta(days=rng.randint(-20, 200))
+            # a pantry keeps buying the same things
+            fl.write(f"{rng.choice(FOODS)}-{rng.randrange(200)},{expiry:%d-%m-%Y},"
+                     f"{rng.choice(STATUSES)},{rng.choice(STORAGES)}\n")
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def megabytes(df):
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def open_journal(tmp, snapshot):
+    """ seconds until a fresh JournalStore answers count()"""
+    store = inventory_store.JournalStore(os.path.join(tmp, "bench.journal"), snapshot,
+                                         seed_csv=None)
+    start = time.perf_counter()
+    store.count()
+    return time.perf_counter() - start
+
+
+def bench_size(rows, tmp, repeat, rng):
+    import pandas as pd
+
+    csv_path = os.path.join(tmp, f"inventory_{rows}.csv")
+    write_inventory(csv_path, rows, rng)
+
+    def csv_load():
+        df = pd.read_csv(csv_path)
+        df["expiry_dt"] = inventory_store.to_day_numbers(df["expiry_dt"])
+        return df
+
+    csv_seconds, plain = best_of(csv_load, repeat)
+    compact = inventory_store.compact_frame(range(1, rows + 1), plain["name"], plain["expiry_dt"],
+                                            plain["status"], plain["storage"])
+    print(f"\n{rows} rows, {compact['name'].cat.categories.size} distinct names")
+    print(f"  frame memory: object columns {megabytes(plain):8.1f} MB, "
+          f"compact {megabytes(compact):8.1f} MB ({megabytes(plain) / megabytes(compact):.1f}x)")
+    print(f"  {'format':8s} {'write ms':>10s} {'load ms':>10s} {'size MB':>9s} {'vs csv load':>12s}")
+    print(f"  {'csv read':8s} {'':>10s} {csv_seconds * 1000:10.1f} "
+          f"{os.path.getsize(csv_path) / 2 ** 20:9.1f}")
+
+    formats = ["csv", "npz"] + (["feather"] if inventory_store._pyarrow_feather() else [])
+    meta = {"journal_seq": 7, "next_id": rows + 1}
+    load_times = {}
+    for fmt in formats:
+        # one directory per format, a JournalStore opens the newest snapshot it finds
+        os.makedirs(os.path.join(tmp, fmt), exist_ok=True)
+        path = os.path.join(tmp, fmt, f"snapshot_{rows}.{fmt}")
+        write_seconds, _ = best_of(lambda: inventory_store.write_snapshot(compact, path, meta, fmt),
+                                   repeat)
+        load_seconds, (loaded, loaded_meta) = best_of(lambda: inventory_store.read_snapshot(path),
+                                                      repeat)
+        assert loaded_meta == meta, f"{fmt}: meta {loaded_meta}"
+        for column in ["id", "name", "expiry_dt", "status", "storage"]:
+            assert loaded[column].astype(object).tolist() == compact[column].astype(object).tolist(), \
+                f"{fmt}: {column} differs after a round trip"
+        load_times[fmt] = load_seconds
+        print(f"  {fmt:8s} {write_seconds * 1000:10.1f} {load_seconds * 1000:10.1f} "
+              f"{os.path.getsize(path) / 2 ** 20:9.1f} {csv_seconds / load_seconds:11.1f}x")
+
+    # a journal restart: the whole snapshot loaded into memory
+    for fmt in formats:
+        path = os.path.join(tmp, fmt, f"snapshot_{rows}.{fmt}")
+        seconds = open_journal(os.path.dirname(path), path)
+        print(f"  journal open from {fmt:8s} {seconds * 1000:10.1f} ms")
+    return load_times
+
+
+def check_compact_durability(tmp):
+    """ the order of fsyncs, the rename and the journal truncation during a
+        compaction, recorded by wrapping os.fsync and os.replace"""
+    import pandas as pd
+
+    journal = os.path.join(tmp, "durable.journal")
+    store = inventory_store.JournalStore(journal, os.path.join(tmp, "durable_snapshot.csv"),
+                                         seed_csv=None)
+    store.add_items(pd.DataFrame({"name": ["jam", "milk"], "expiry_dt": ["01-01-2099"] * 2,
+                                  "status": "open", "storage": "fridge"}))
+    events = []
+    fsync, replace = os.fsync, os.replace
+
+    def traced_fsync(fd):
+        fsync(fd)
+        events.append(("fsync", os.readlink(f"/proc/self/fd/{fd}"), os.path.getsize(journal)))
+
+    def traced_replace(src, dst):
+        replace(src, dst)
+        events.append(("replace", dst, os.path.getsize(journal)))
+
+    os.fsync, os.replace = traced_fsync, traced_replace
+    try:
+        store.compact()
+    finally:
+        os.fsync, os.replace = fsync, replace
+    kinds = [(kind, os.path.basename(target)) for kind, target, _ in events]
+    renamed = next(i for i, (kind, _) in enumerate(kinds) if kind == "replace")
+    snapshot = kinds[renamed][1]
+    assert any(kind == "fsync" and name.endswith(snapshot.rsplit(".", 1)[-1])
+               for kind, name in kinds[:renamed]), f"snapshot not fsynced before the rename: {kinds}"
+    assert ("fsync", os.path.basename(tmp)) in kinds[renamed:], f"directory not fsynced: {kinds}"
+    assert all(size > 0 for _, _, size in events), "journal emptied before the snapshot was durable"
+    assert os.path.getsize(journal) == 0, "journal not emptied"
+    print(f"\ncompaction: {' -> '.join(kind + ' ' + name for kind, name in kinds)}, then the journal truncated")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot format benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    rng = random.Random(7)
+    if not inventory_store._pyarrow_feather():
+        print("pyarrow is not installed, feather snapshots are skipped")
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stderr(io.StringIO()):
+        for rows in (int(size) for size in args.sizes.split(",")):
+            load_times = bench_size(rows, tmp, args.repeat, rng)
+            binary = min(seconds for fmt, seconds in load_times.items() if fmt != "csv")
+            assert binary < load_times["csv"], "binary snapshot loads slower than csv"
+        check_compact_durability(tmp)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
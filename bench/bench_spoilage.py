@@ -0,0 +1,191 @@
+import argparse
+import contextlib
+import io
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import inventory_store
+import mytools
+import spoilage
+from fakes import forecast_payload
+
+# Forecast driven spoilage engine. Times SpoilageEngine.apply over synthetic
+# inventories of --sizes rows, then checks on smaller ones that a run is
+# idempotent (the same forecast again changes nothing), incremental (today's
+# forecast then tomorrow's overlapping one equals applying every slot once),
+# safe to repeat after a crash between the ledger save and the inventory
+# write, keeps an expiry edited by hand as the new base, and matches a plain
+# Python loop over the items. Finally runs spoilage.refresh twice on both
+# store backends.
+# python bench/bench_spoilage.py --sizes 10000,100000,1000000
+
+FOODS = ["banana", "apple", "guava", "pear", "mango", "leafy green", "milk", "carrot",
+         "french bean", "beet", "okra", "cauliflower", "cabbage", "bread", "paneer"]
+STORAGES = ["counter", "fridge", "freezer"]
+
+
+def inventory(rows, rng, today):
+    return inventory_store.compact_frame(
+        np.arange(1, rows + 1),
+        rng.choice(FOODS, rows),
+        today + rng.integers(-5, 40, rows),
+        rng.choice(["none", "open", "flagged"], rows, p=[0.6, 0.3, 0.1]),
+        rng.choice(STORAGES, rows))
+
+
+def forecast(rng, slots=40, offset=0):
+    """ a 5 day forecast, `offset` slots after the one of the first call"""
+    temps = 24 + 10 * np.sin(np.arange(offset, offset + slots) * 2 * np.pi / 8) \
+        + rng.normal(0, 2, slots)
+    payload = forecast_payload(temps.round(1).tolist())
+    for point in payload["list"]:
+        point["dt"] += offset * 10800
+    return payload
+
+
+def written(df, expiry, flagged):
+    """ the frame as the store holds it once the run's rows are written"""
+    df = df.copy()
+    df["expiry_dt"] = expiry.astype(np.int32)
+    df["status"] = pd.Categorical(np.where(flagged, "flagged", df["status"].astype(object)))
+    return df
+
+
+def reference(df, w_data, engine, today):
+    """ the same model one item and one forecast slot at a time"""
+    slots = []
+    for point in sorted(w_data["list"], key=lambda item: item["dt"]):
+        slots.append(max(point["main"]["temp_max"] - 273.15 - engine.base_temp, 0) * 3)
+    expiry, flagged = [], []
+    for name, day, state, storage in zip(df["name"], df["expiry_dt"], df["status"], df["storage"]):
+        if storage in spoilage.EXPOSED_STORAGES:
+            loss = sum(engine.food_index.sensitivity(name) * dh / engine.degree_hours_per_day
+                       for dh in slots)
+            day -= math.floor(loss)
+        expiry.append(day)
+        flagged.append(state == "flagged" or day <= today + spoilage.FLAG_DAYS)
+    return np.array(expiry), np.array(flagged)
+
+
+def on_boundary(df, ledger):
+    """ rows whose loss is a float rounding away from a whole day, where the
+        vectorized sums and the loop may floor differently"""
+    mask = np.zeros(len(df), dtype=bool)
+    ids = df["id"].to_numpy()
+    known = np.isin(ids, ledger.ids)
+    loss = ledger.loss[np.searchsorted(ledger.ids, ids[known])]
+    mask[known] = np.abs(loss - np.round(loss)) < 1e-9
+    return mask
+
+
+def check_model(engine, rng, today, rows):
+    df = inventory(rows, rng, today)
+    today_forecast = forecast(rng)
+    expiry, flagged, changed, ledger = engine.apply(df, spoilage.Ledger(), today_forecast, today)
+    ref_expiry, ref_flagged = reference(df, today_forecast, engine, today)
+    boundary = on_boundary(df, ledger)
+    assert np.array_equal(expiry[~boundary], ref_expiry[~boundary]), "differs from the python loop"
+    assert np.array_equal(flagged[~boundary], ref_flagged[~boundary]), "flags differ from the python loop"
+    assert (df["expiry_dt"].to_numpy()[df["storage"].to_numpy() != "counter"]
+            == expiry[df["storage"].to_numpy() != "counter"]).all(), "fridge items were shifted"
+    assert ledger.loss.max() > 1, "forecast too cool to test anything"
+
+    # the same forecast again, a second routine run on the same day
+    after = written(df, expiry, flagged)
+    _, _, changed_again, ledger_again = engine.apply(after, ledger, today_forecast, today)
+    assert not changed_again.any(), f"second run changed {changed_again.sum()} rows"
+    assert np.array_equal(ledger_again.loss, ledger.loss), "second run added loss"
+
+    # ledger saved but the inventory never written: the rerun writes it
+    expiry_crash, _, changed_crash, ledger_crash = engine.apply(
+        df, ledger, today_forecast, today)
+    assert np.array_equal(expiry_crash, expiry), "rerun after a crash gave another expiry"
+    assert np.array_equal(changed_crash, changed), "rerun after a crash wrote other rows"
+    assert np.array_equal(ledger_crash.base_day, ledger.base_day), "crash rerun moved the base"
+
+    # tomorrow's forecast overlaps today's by four days and revises them,
+    # slots already applied stay as they were
+    tomorrow_forecast = forecast(rng, offset=8)
+    expiry2, flagged2, _, ledger2 = engine.apply(after, ledger, tomorrow_forecast, today)
+    merged = dict(today_forecast, list=today_forecast["list"] + tomorrow_forecast["list"][-8:])
+    one_shot, _, _, ledger_once = engine.apply(df, spoilage.Ledger(), merged, today)
+    assert np.allclose(ledger2.loss, ledger_once.loss), "incremental loss differs from one shot"
+    settled = ~on_boundary(df, ledger_once)
+    assert np.array_equal(expiry2[settled], one_shot[settled]), "incremental expiry differs"
+
+    # an expiry edited by hand keeps later losses on top of the new date
+    edited = written(df, expiry2, flagged2)
+    row = int(np.flatnonzero(df["storage"].to_numpy() == "counter")[0])
+    edited.loc[row, "expiry_dt"] = expiry2[row] + 10
+    later = forecast(rng, offset=16)
+    expiry3, _, _, ledger3 = engine.apply(edited, ledger2, later, today)
+    pos = np.searchsorted(ledger3.ids, df["id"][row])
+    lost_since = math.floor(ledger3.loss[pos]) - math.floor(ledger2.loss[pos])
+    assert expiry3[row] == expiry2[row] + 10 - lost_since, "hand edit was overwritten"
+
+
+def check_stores(engine, rng, today, tmp):
+    df = inventory(3000, rng, today)
+    df["expiry_dt"] = inventory_store.from_day_numbers(df["expiry_dt"].to_numpy())
+    w_data = forecast(rng)
+    spoilage._engine = engine
+    for backend in ["sqlite", "journal"]:
+        path = os.path.join(tmp, backend)
+        if backend == "journal":
+            store = inventory_store.JournalStore(path + ".journal", path + ".snapshot", seed_csv=None)
+        else:
+            store = inventory_store.InventoryStore(path + ".db", seed_csv=None)
+        store.add_items(df.drop(columns="id"))
+        first = spoilage.refresh(store, w_data, today)
+        before = store.day_frame()
+        second = spoilage.refresh(store, w_data, today)
+        assert sorted(first) == sorted(second), f"{backend}: flagged items changed"
+        assert before.equals(store.day_frame()), f"{backend}: second refresh changed the inventory"
+        assert os.path.exists(spoilage.ledger_path(store)), f"{backend}: no ledger written"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spoilage engine benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--check-rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    today = inventory_store.today_number()
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = spoilage.SpoilageEngine(mytools.ShelfLifeIndex(os.path.join(ROOT, "raw_food_db.csv")))
+        engine.food_index.table()
+
+    w_data = forecast(rng)
+    print(f"{'rows':>9s} {'first run ms':>13s} {'next run ms':>12s} {'changed':>9s}")
+    for rows in (int(size) for size in args.sizes.split(",")):
+        df = inventory(rows, rng, today)
+        first, second = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            expiry, flagged, changed, ledger = engine.apply(df, spoilage.Ledger(), w_data, today)
+            first.append(time.perf_counter() - start)
+            after = written(df, expiry, flagged)
+            start = time.perf_counter()
+            engine.apply(after, ledger, w_data, today)
+            second.append(time.perf_counter() - start)
+        print(f"{rows:9d} {min(first) * 1000:13.1f} {min(second) * 1000:12.1f} {changed.sum():9d}")
+
+    check_model(engine, rng, today, args.check_rows)
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        check_stores(engine, rng, today, tmp)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent_image
+from fakes import DEFAULT_EXTRACTION, FakeGenAI, FakeGeminiModel
+from PIL import Image
+
+# Tokens and latency of the image extraction call with the free text prompt,
+# with a response schema, and with a response schema plus the prompt held in
+# a context cache. The fake model charges per_token_latency for every prompt
+# token it has not cached and reports usage_metadata like the API, so the
+# numbers come from GeminiReceiptProcessor.usage. The API refuses caches below
+# a minimum size, 1024 tokens for Flash models, and the fake does the same
+# by default. The extraction prompt is smaller, so schema+cache shows the
+# refused path; --min-cache-tokens 0 shows what a cache would save.
+# Also checks that a reply with unusable items still yields the good ones.
+# python bench/bench_structured_output.py --images 40
+
+
+MODES = [
+    ("free text", dict(structured=False)),
+    ("schema", dict(structured=True, prompt_cache_ttl=0)),
+    ("schema+cache", dict(structured=True, prompt_cache_ttl=3600)),
+    ]
+
+
+def run_mode(options, min_cache_tokens, images, args):
+    genai = FakeGenAI(min_cache_tokens=min_cache_tokens, latency=args.latency,
+                      per_token_latency=args.per_token_ms / 1000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        processor = agent_image.GeminiReceiptProcessor(genai=genai, cache=False, **options)
+        start = time.perf_counter()
+        results = asyncio.run(processor.process_images(images, args.concurrency))
+        wall = time.perf_counter() - start
+    for result in results:
+        assert result["success"] and result["extracted_data"]["items"] == DEFAULT_EXTRACTION["items"], \
+            f"extraction differs: {result}"
+    return processor, wall
+
+
+def check_malformed():
+    """ prose around the JSON and an item without a name, the rest still loads"""
+    extraction = dict(DEFAULT_EXTRACTION, items=DEFAULT_EXTRACTION["items"] + [{"type": "grocery"}])
+    processor = agent_image.GeminiReceiptProcessor(
+        model=FakeGeminiModel(latency=0, extraction=extraction), cache=False, structured=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        parsed = processor._parse_gemini_response("Sure! Here it is:\n"
+                                                  + agent_image.json.dumps(extraction) + "\nThanks")
+        broken = processor._parse_gemini_response('{"success": true, "items": [{"name": null}]}')
+    assert parsed["items"] == DEFAULT_EXTRACTION["items"], parsed
+    assert broken["success"] is False, broken
+
+
+def check_cache_renewal(image):
+    genai = FakeGenAI(min_cache_tokens=0, latency=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        processor = agent_image.GeminiReceiptProcessor(genai=genai, cache=False, prompt_cache_ttl=3600)
+        processor._prompt_cache_expires = time.monotonic()
+        asyncio.run(processor.process_receipt_image(image))
+    assert processor._prompt_cache.updates == 1, "prompt cache was not renewed"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Structured output and prompt cache benchmark")
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="fixed seconds per call")
+    parser.add_argument("--per-token-ms", type=float, default=0.1,
+                        help="milliseconds per uncached prompt token")
+    parser.add_argument("--min-cache-tokens", type=int, default=1024,
+                        help="smallest prompt the fake accepts for a context cache, "
+                             "the API's minimum for Flash by default")
+    args = parser.parse_args()
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 120, 40)).save(buffer, "JPEG")
+    images = [buffer.getvalue()] * args.images
+
+    print(f"{'mode':14s} {'prompt tok':>11s} {'cached':>8s} {'output':>8s} "
+          f"{'ms/call':>9s} {'wall s':>8s}")
+    baseline = None
+    for name, options in MODES:
+        processor, wall = run_mode(options, args.min_cache_tokens, images, args)
+        usage = processor.usage
+        calls = usage["calls"]
+        billed = (usage["prompt_tokens"] - usage["cached_tokens"]) / calls
+        if baseline is None:
+            baseline = billed
+        cache_note = "" if processor._prompt_cache or not options.get("prompt_cache_ttl") \
+            else "  (cache refused, prompt sent as system instruction)"
+        print(f"{name:14s} {usage['prompt_tokens'] / calls:11.0f} {usage['cached_tokens'] / calls:8.0f} "
+              f"{usage['output_tokens'] / calls:8.0f} {usage['seconds'] / calls * 1000:9.1f} "
+              f"{wall:8.2f}  uncached prompt {billed / baseline:.0%} of free text{cache_note}")
+
+    check_malformed()
+    check_cache_renewal(images[0])
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
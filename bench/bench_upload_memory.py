@@ -0,0 +1,174 @@
+import argparse
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchutil import export_revision
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+
+# Server memory under concurrent large uploads. Runs the app from a source
+# tree in a child process behind a real HTTP server, with the fake Gemini
+# model, and streams --uploads concurrent multipart uploads of a --mb MB JPEG
+# to /upload from this process. The child reports its resident memory before
+# the uploads and its peak, so the client side is not counted.
+# --compare REV runs the same uploads against that git revision.
+# python bench/bench_upload_memory.py --uploads 8 --mb 20 --compare HEAD~1
+
+SERVER = r"""
+import os, resource, sys, threading
+sys.path[:0] = [sys.argv[1], sys.argv[2]]
+# the app prints as it works, answers to the parent go to the real stdout
+out, sys.stdout = sys.stdout, sys.stderr
+import agent_image
+import app as webapp
+from fakes import FakeGeminiModel
+from werkzeug.serving import make_server
+
+def rss():
+    with open("/proc/self/statm") as fl:
+        return int(fl.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+agent_image.set_processor(agent_image.GeminiReceiptProcessor(
+    model=FakeGeminiModel(latency=float(sys.argv[3])), cache=False))
+server = make_server("127.0.0.1", 0, webapp.app, threaded=True)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+print(server.server_port, file=out, flush=True)
+for line in sys.stdin:
+    if line.strip() == "baseline":
+        print(rss(), file=out, flush=True)
+    elif line.strip() == "peak":
+        print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, file=out, flush=True)
+"""
+
+
+def make_jpeg(path, megabytes):
+    """ a real JPEG of roughly the given size: noise compresses badly"""
+    import numpy as np
+    from PIL import Image
+    # about 1.9 bytes per pixel at quality 100
+    pixels = int(megabytes * 2 ** 20 / 1.9)
+    width = int((pixels * 4 / 3) ** 0.5)
+    height = pixels // width
+    noise = np.random.default_rng(1).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    Image.fromarray(noise).save(path, "JPEG", quality=100)
+    return os.path.getsize(path)
+
+
+def post_upload(port, image_path, results, index):
+    boundary = "benchboundary"
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"big.jpg\"\r\n"
+            "Content-Type: image/jpeg\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    size = len(head) + os.path.getsize(image_path) + len(tail)
+
+    def body():
+        yield head
+        with open(image_path, "rb") as fl:
+            for chunk in iter(lambda: fl.read(1 << 20), b""):
+                yield chunk
+        yield tail
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    conn.request("POST", "/upload", body=body(), headers={
+        "Content-Type": f"multipart/form-data; boundary={boundary}", "Content-Length": str(size)})
+    response = conn.getresponse()
+    reply = json.loads(response.read())
+    status = "failed"
+    if response.status == 202:
+        while True:
+            conn.request("GET", reply["status_url"])
+            job = json.loads(conn.getresponse().read())
+            if job["status"] in ("done", "failed"):
+                status = job["status"]
+                break
+            time.sleep(0.05)
+    conn.close()
+    results[index] = status
+
+
+def measure(tree, image_path, args):
+    """ (baseline bytes, peak bytes, seconds, statuses) for one source tree"""
+    with tempfile.TemporaryDirectory() as work:
+        for name in os.listdir(tree):
+            if name.endswith(".csv"):
+                shutil.copy(os.path.join(tree, name), work)
+        env = dict(os.environ, RUN_SCHEDULER="0", API_KEY="x", WEATHER_API_KEY="x",
+                   TWILIO_SID="ACx", TWILIO_TOKEN="x")
+        child = subprocess.Popen([sys.executable, "-c", SERVER, tree, BENCH, str(args.latency)],
+                                 cwd=work, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, text=True)
+        try:
+            port = int(child.stdout.readline())
+            # one small upload first, so imports and the stores are loaded
+            post_upload(port, args.warmup, {}, 0)
+            child.stdin.write("baseline\n")
+            child.stdin.flush()
+            baseline = int(child.stdout.readline())
+            results = {}
+            threads = [threading.Thread(target=post_upload, args=(port, image_path, results, i))
+                       for i in range(args.uploads)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.perf_counter() - start
+            child.stdin.write("peak\n")
+            child.stdin.flush()
+            peak = int(child.stdout.readline())
+        finally:
+            child.kill()
+            child.wait()
+    return baseline, peak, seconds, [results[i] for i in range(args.uploads)]
+
+
+def report(label, result, args):
+    baseline, peak, seconds, statuses = result
+    growth = (peak - baseline) / 2 ** 20
+    print(f"{label:18s} baseline {baseline / 2 ** 20:7.1f} MB  peak {peak / 2 ** 20:7.1f} MB  "
+          f"growth {growth:7.1f} MB ({growth / args.uploads:5.1f} MB per upload)  "
+          f"{seconds:5.2f}s  {statuses.count('done')}/{len(statuses)} done")
+    return growth
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload memory benchmark")
+    parser.add_argument("--uploads", type=int, default=8, help="concurrent uploads")
+    parser.add_argument("--mb", type=float, default=20, help="size of each upload")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per model call")
+    parser.add_argument("--compare", help="git revision to measure as well")
+    parser.add_argument("--budget-mb", type=float, default=0,
+                        help="fail when the peak grows by more than this, 0 for no limit")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_path = os.path.join(tmp, "big.jpg")
+        size = make_jpeg(image_path, args.mb)
+        args.warmup = os.path.join(tmp, "small.jpg")
+        make_jpeg(args.warmup, 0.05)
+        print(f"{args.uploads} concurrent uploads of {size / 2 ** 20:.1f} MB")
+        result = measure(ROOT, image_path, args)
+        growth = report("this tree", result, args)
+        if args.compare:
+            old_tree = export_revision(args.compare, tmp)
+            report(args.compare, measure(old_tree, image_path, args), args)
+
+    if result[3].count("done") != args.uploads:
+        print("FAILED: not every upload was processed")
+        sys.exit(1)
+    if args.budget_mb and growth > args.budget_mb:
+        print(f"FAILED: memory grew by {growth:.0f} MB, over the {args.budget_mb:.0f} MB budget")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
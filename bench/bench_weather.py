@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent
+from fakes import FakeWeatherServer
+
+# Checks the forecast cache against a local OpenWeather stand-in: the first
+# call downloads, repeated calls are served from memory, a stale forecast is
+# served while the API fails, and a new one is fetched once the TTL expires.
+# python bench/bench_weather.py
+
+
+def timed(cache):
+    start = time.perf_counter()
+    result = cache.get()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    with FakeWeatherServer(latency=0.05) as server:
+        cache = agent.ForecastCache(url=server.url, api_key="test", ttl=0.5)
+        result, cold_ms = timed(cache)
+        assert result["success"] and not result["stale"]
+        warm = [timed(cache)[1] for _ in range(100)]
+        print(f"cold fetch {cold_ms:.1f} ms, cached fetch {sum(warm) / len(warm):.3f} ms avg, "
+              f"{server.requests} request(s) for 101 calls")
+        assert server.requests == 1
+
+        server.fail = True
+        time.sleep(0.6)
+        result, ms = timed(cache)
+        assert result["success"] and result["stale"]
+        print(f"API down: stale forecast served in {ms:.1f} ms")
+
+        server.fail = False
+        server.temps = [10.0] * 40
+        result, ms = timed(cache)
+        assert not result["stale"] and round(agent.get_avg(result["w_data"])) == 10
+        print(f"TTL expired: fresh forecast fetched in {ms:.1f} ms, {server.requests} requests total")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["RUN_SCHEDULER"] = "0"
+# seen MessageSids are kept on disk, a rerun must not find the last run's
+os.environ["JOBS_DB"] = os.path.join(tempfile.mkdtemp(), "jobs.db")
+
+import agent3
+import app as webapp
+import mytools
+import send_msg
+
+# Latency of the /message webhook with a donation agent that takes --latency
+# seconds. The webhook must answer in milliseconds, a redelivery of the same
+# MessageSid must not start a second search, and the reply must still be sent.
+# python bench/bench_webhook.py --latency 3
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Webhook latency check")
+    parser.add_argument("--latency", type=float, default=3.0)
+    parser.add_argument("--budget-ms", type=float, default=100.0)
+    args = parser.parse_args()
+
+    searches, sent = [], []
+    done = threading.Event()
+
+    def slow_agent(checklist, location=agent3.location):
+        searches.append(checklist)
+        time.sleep(args.latency)
+        return "1. Food Bank, Some Street, 0000"
+
+    def fake_send(body_text, *args, **kwargs):
+        sent.append(body_text)
+        done.set()
+
+    agent3.find_donation_centers_cached = slow_agent
+    send_msg.send_message = fake_send
+    mytools.fetch_list = lambda store=None: {"success": True, "checklist": "banana,yogurt"}
+
+    client = webapp.app.test_client()
+    form = {"From": "whatsapp:+10000000000", "Body": "Donate", "MessageSid": "SM-bench-1"}
+    latencies = []
+    for _ in range(3):
+        # the first delivery plus two Twilio retries of the same message
+        start = time.perf_counter()
+        response = client.post("/message", data=form)
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200
+
+    print("webhook latency: " + ", ".join(f"{ms:.1f} ms" for ms in latencies))
+    assert max(latencies) < args.budget_ms, f"webhook slower than {args.budget_ms} ms"
+    assert done.wait(args.latency + 5), "reply was never sent"
+    time.sleep(0.2)
+    print(f"{len(searches)} search started for 3 deliveries, {len(sent)} reply sent")
+    assert len(searches) == 1 and len(sent) == 1
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
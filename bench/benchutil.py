@@ -0,0 +1,25 @@
+import os
+import subprocess
+import tarfile
+
+# Helpers shared by the scripts in bench/.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def export_revision(rev, dest):
+    """ the tree of a git revision extracted under dest, for --compare runs"""
+    archive = os.path.join(dest, "tree.tar")
+    subprocess.run(["git", "archive", "--format=tar", "-o", archive, rev], cwd=ROOT, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(os.path.join(dest, "tree"))
+    return os.path.join(dest, "tree")
+
+
+def open_store(backend, path):
+    """ an empty store of either backend at path, pandas is only imported
+        by the benches that use one"""
+    import inventory_store
+    if backend == "journal":
+        return inventory_store.JournalStore(path + ".journal", path + ".snapshot", seed_csv=None)
+    return inventory_store.InventoryStore(path, seed_csv=None)
@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jobs
+
+# Behaviour check for jobs.JobQueue across server processes. Two queues on
+# the same jobs file stand in for two workers of one WSGI server:
+# - a job queued by one is seen queued, running and done by the other
+# - a job that raises is failed with its message for both
+# - a job rejected with QueueFull leaves no record
+# - finished jobs older than keep_seconds are forgotten
+# - a MessageSid accepted by one is a duplicate for the other until forgotten
+# python bench/check_jobs.py
+
+
+def check(condition, message):
+    if not condition:
+        print(f"FAILED: {message}")
+        sys.exit(1)
+
+
+def wait_for(job_queue, job_id, statuses, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = job_queue.get(job_id)
+        if job and job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    return job_queue.get(job_id)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "jobs.db")
+        first = jobs.JobQueue(workers=1, max_pending=1, name="upload", path=path)
+        second = jobs.JobQueue(workers=1, max_pending=1, name="upload", path=path)
+
+        release = threading.Event()
+        def slow(item):
+            release.wait(5)
+            return {"success": True, "items": [item], "count": 1}
+
+        job_id = first.submit(slow, "banana")
+        job = wait_for(second, job_id, ("running",))
+        check(job is not None and job["status"] == "running", f"other worker sees {job}")
+        print(f"other worker sees the job {job['status']}")
+
+        # one job running, one waiting, the third is rejected
+        waiting = first.submit(lambda: {"success": True})
+        try:
+            first.submit(lambda: {"success": True})
+            check(False, "a full queue accepted a job")
+        except jobs.QueueFull:
+            pass
+        rows = first._db().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        check(rows == 2, f"{rows} job records after a rejected submit")
+
+        release.set()
+        job = wait_for(second, job_id, ("done", "failed"))
+        check(job["status"] == "done" and job["result"] == {"success": True, "items": ["banana"], "count": 1},
+              f"other worker sees {job}")
+        check(wait_for(second, waiting, ("done",))["status"] == "done", "waiting job never ran")
+        print(f"other worker sees the result {job['result']}")
+
+        def broken():
+            raise ValueError("no receipt in the image")
+        failed = first.submit(broken)
+        job = wait_for(second, failed, ("done", "failed"))
+        check(job["status"] == "failed" and job["result"]["message"] == "no receipt in the image",
+              f"failed job recorded as {job}")
+        check(second.get(failed) == first.get(failed), "workers disagree on a job")
+        check(jobs.JobQueue(name="message", path=path).get(failed) is None,
+              "a job is visible from another queue")
+
+        # finished jobs are forgotten once older than keep_seconds
+        pruning = jobs.JobQueue(workers=1, keep_seconds=0, name="upload", path=path)
+        time.sleep(0.01)
+        last = pruning.submit(lambda: {"success": True})
+        check(second.get(job_id) is None and second.get(failed) is None, "old jobs were kept")
+        check(wait_for(second, last, ("done",))["status"] == "done", "job after the prune never ran")
+        print("failed jobs, rejected submits and pruning OK")
+
+        seen = jobs.SeenMessages(path=path)
+        other = jobs.SeenMessages(path=path)
+        check(seen.first("SM1"), "first delivery refused")
+        check(not other.first("SM1"), "retry through the other worker accepted")
+        check(other.first("SM2"), "another message refused")
+        other.forget("SM1")
+        check(seen.first("SM1"), "forgotten delivery still refused")
+        expiring = jobs.SeenMessages(keep_seconds=0, path=path)
+        time.sleep(0.01)
+        check(expiring.first("SM3"), "new delivery refused")
+        count = expiring._db().execute("SELECT COUNT(*) FROM seen_messages").fetchone()[0]
+        check(count == 1, f"{count} MessageSids kept past keep_seconds")
+        print("duplicate deliveries OK")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+import agent
+import inventory_store
+import reference_routine
+from benchutil import open_store
+from fakes import forecast_payload
+
+# Regression check for the fused daily routine: agent.run_routine must leave
+# the inventory and send the alert exactly like the old sequence of
+# check_spoilage (update_expiry, check_stocks) followed by routine_msg, kept
+# in reference_routine.py, on
+# random inventories, in hot and cool weather and for both store backends.
+# The old sequence is the one day decrement, so this runs the legacy
+# spoilage model; bench/bench_spoilage.py covers the forecast one.
+# python bench/check_routine_regression.py --rows 5000 --rounds 5
+
+
+def random_inventory(rows, rng):
+    today = inventory_store.today_number()
+    return pd.DataFrame({
+        "name": [f"item{i}" for i in range(rows)],
+        "expiry_dt": inventory_store.from_day_numbers(today + rng.integers(-10, 20, rows)),
+        "status": rng.choice(["open", "flagged"], rows, p=[0.8, 0.2]),
+        "storage": rng.choice(["counter", "fridge"], rows),
+        })
+
+
+def run(backend, tmp, name, df, temp, fused):
+    store = open_store(backend, os.path.join(tmp, name))
+    store.add_items(df)
+    alerts = []
+    agent.alert_user = lambda checklist, condition=False, to=None: alerts.append(checklist)
+    agent.fetch_weather = lambda *args: {"success": True, "w_data": forecast_payload([temp] * 40)}
+    inventory_store._store = store
+    agent.SPOILAGE_MODEL = "legacy"
+    if fused:
+        result = agent.run_routine(store)
+    else:
+        cond = reference_routine.check_spoilage()
+        result = reference_routine.routine_msg() if cond["success"] else cond
+    return store.frame(), alerts, result
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Fused routine regression check")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ["sqlite", "journal"]:
+            for round_no in range(args.rounds):
+                df = random_inventory(args.rows, rng)
+                temp = 35.0 if round_no % 2 == 0 else 10.0
+                old = run(backend, tmp, f"{backend}-old-{round_no}", df, temp, fused=False)
+                new = run(backend, tmp, f"{backend}-new-{round_no}", df, temp, fused=True)
+                pd.testing.assert_frame_equal(old[0], new[0])
+                assert old[1] == new[1] and old[2] == new[2], (old[1:], new[1:])
+                print(f"{backend} round {round_no} ({temp:.0f} C): {args.rows} rows identical, "
+                      f"{int((new[0]['status'] == 'flagged').sum())} flagged")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
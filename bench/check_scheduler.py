@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scheduler
+
+# Behaviour check for scheduler.Scheduler with short intervals:
+# - the thread sleeps until a job is due, no polling
+# - a slow job is never run twice at once, the overlapping run is skipped
+# - durations and outcomes are recorded in the state file
+# - a daily job whose time passed while nothing was running runs on start
+# - two schedulers on the same state file run a due daily job once
+# python bench/check_scheduler.py
+
+
+def check(condition, message):
+    if not condition:
+        print(f"FAILED: {message}")
+        sys.exit(1)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.json")
+
+        runs = []
+        def slow():
+            runs.append(time.monotonic())
+            time.sleep(0.35)
+            return {"success": True}
+
+        sched = scheduler.Scheduler(path)
+        sched.add("slow", slow, every=0.1)
+        sched.start()
+        time.sleep(1.0)
+        sched.stop()
+        time.sleep(0.4)
+        state = sched._load()["slow"]
+        check(2 <= len(runs) <= 4, f"{len(runs)} runs of a 0.35s job in 1s")
+        check(all(b - a >= 0.3 for a, b in zip(runs, runs[1:])), "runs overlapped")
+        check(state["skipped"] >= 3, "overlapping runs were not skipped")
+        check(state["runs"] == len(runs) and len(state["durations"]) == len(runs),
+              "durations not recorded")
+        print(f"overlap: {len(runs)} runs, {state['skipped']} skipped, "
+              f"durations {state['durations']}")
+
+        # a daily job that last ran two days ago, its time today has passed
+        at = (datetime.now() - timedelta(minutes=1)).strftime("%H:%M")
+        sched._update_state("daily", last_due=(datetime.now() - timedelta(days=2)).timestamp())
+        daily = []
+        first = scheduler.Scheduler(path)
+        second = scheduler.Scheduler(path)
+        for sch in (first, second):
+            sch.add("daily", lambda: daily.append(1) or time.sleep(0.2), at=at)
+        first.start()
+        second.start()
+        time.sleep(0.8)
+        first.stop()
+        second.stop()
+        stats = first.stats()["daily"]
+        check(len(daily) == 1, f"missed daily run ran {len(daily)} times")
+        check(stats["last_status"] == "done", "daily outcome not recorded")
+        check(datetime.fromisoformat(stats["next_run"]) > datetime.now(), "next run not in the future")
+        print(f"catch up: missed daily run ran once, next run {stats['next_run']}")
+
+        # a fresh job is not caught up, it waits for its time
+        fresh = []
+        sch = scheduler.Scheduler(path)
+        sch.add("fresh", lambda: fresh.append(1), at=at)
+        sch.start()
+        time.sleep(0.2)
+        sch.stop()
+        check(not fresh, "a job that never ran was caught up")
+
+        # the sleeping thread wakes up for a job added later
+        woke = threading.Event()
+        sch = scheduler.Scheduler(path)
+        sch.add("idle", lambda: None, every=3600, catch_up=False)
+        sch.start()
+        start = time.monotonic()
+        sch.add("soon", woke.set, every=0.2, catch_up=False)
+        check(woke.wait(2), "scheduler did not wake for a new job")
+        sch.stop()
+        print(f"wake up: new job ran after {time.monotonic() - start:.2f}s")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
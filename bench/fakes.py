@@ -0,0 +1,198 @@
+import asyncio
+import json
+import threading
+import time
+import types
+
+# Local stand-ins for the external services, used by the scripts in bench/.
+# None of them open a network connection to Google, OpenWeather or Twilio.
+
+DEFAULT_EXTRACTION = {
+    "success": True,
+    "items": [
+        {"type": "grocery", "name": "banana", "expiry_date": None, "mfg_date": None,
+         "time_remaining": None, "time_denom": None},
+        {"type": "packaged", "name": "curd", "expiry_date": None, "mfg_date": "12-10-2025",
+         "time_remaining": 180, "time_denom": "d"},
+        ],
+    "confidence_score": 0.95,
+    }
+
+
+class FakeResponse:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+def count_tokens(part):
+    """ rough Gemini token count: 4 characters per token, 258 per image"""
+    return len(part) // 4 if isinstance(part, str) else 258
+
+
+class FakeGeminiModel:
+    """ Stand-in for genai.GenerativeModel that answers after a fixed latency
+        plus per_token_latency for every prompt token that is not cached.
+        Replies with bare JSON when asked for application/json, in a fenced
+        block otherwise, and reports usage_metadata like the API"""
+    def __init__(self, latency=0.2, extraction=None, system_instruction=None,
+                 generation_config=None, cached_content=None, per_token_latency=0.0):
+        self.latency = latency
+        self.extraction = extraction or DEFAULT_EXTRACTION
+        self.system_instruction = system_instruction
+        self.generation_config = generation_config
+        self.cached_content = cached_content
+        self.per_token_latency = per_token_latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self, contents, generation_config):
+        config = generation_config or self.generation_config or {}
+        cached = count_tokens(self.cached_content.system_instruction) if self.cached_content else 0
+        prompt = cached + sum(count_tokens(part) for part in contents)
+        if self.system_instruction:
+            prompt += count_tokens(self.system_instruction)
+        with self._lock:
+            self.calls += 1
+        if config.get("response_mime_type") == "application/json":
+            text = json.dumps(self.extraction)
+        else:
+            text = "```json\n" + json.dumps(self.extraction, indent=4) + "\n```"
+        usage = types.SimpleNamespace(prompt_token_count=prompt, cached_content_token_count=cached,
+                                      candidates_token_count=count_tokens(text),
+                                      total_token_count=prompt + count_tokens(text))
+        delay = self.latency + self.per_token_latency * (prompt - cached)
+        return delay, FakeResponse(text, usage)
+
+    def generate_content(self, contents, generation_config=None):
+        delay, response = self._call(contents, generation_config)
+        time.sleep(delay)
+        return response
+
+    async def generate_content_async(self, contents, generation_config=None):
+        delay, response = self._call(contents, generation_config)
+        await asyncio.sleep(delay)
+        return response
+
+
+class FakeCachedContent:
+    def __init__(self, model, system_instruction, ttl):
+        self.model = model
+        self.system_instruction = system_instruction
+        self.ttl = ttl
+        self.updates = 0
+
+    def update(self, ttl):
+        self.ttl = ttl
+        self.updates += 1
+
+
+class FakeGenAI:
+    """ Stand-in for the google.generativeai module, for
+        GeminiReceiptProcessor(genai=...). Context caches are refused below
+        min_cache_tokens like the API does. Model options go to every model"""
+    def __init__(self, min_cache_tokens=1024, **model_options):
+        fake = self
+        self.min_cache_tokens = min_cache_tokens
+        self.models = []
+
+        class CachedContent:
+            @staticmethod
+            def create(model, system_instruction, ttl):
+                if count_tokens(system_instruction) < fake.min_cache_tokens:
+                    raise ValueError(f"cached content must be at least {fake.min_cache_tokens} tokens")
+                return FakeCachedContent(model, system_instruction, ttl)
+
+        class GenerativeModel:
+            def __new__(cls, model_name, system_instruction=None, generation_config=None):
+                return fake._model(system_instruction=system_instruction,
+                                   generation_config=generation_config)
+
+            @staticmethod
+            def from_cached_content(cached_content, generation_config=None):
+                return fake._model(cached_content=cached_content, generation_config=generation_config)
+
+        self.caching = types.SimpleNamespace(CachedContent=CachedContent)
+        self.GenerativeModel = GenerativeModel
+        self._model_options = model_options
+
+    def _model(self, **kwargs):
+        model = FakeGeminiModel(**self._model_options, **kwargs)
+        self.models.append(model)
+        return model
+
+
+def forecast_payload(temps_celsius):
+    """ OpenWeather 5 day / 3 hour forecast body with the given max temperatures"""
+    start = int(time.time()) // 10800 * 10800 + 10800
+    return {"cod": "200", "cnt": len(temps_celsius), "list": [
+        {"dt": start + i * 10800,
+         "main": {"temp": temp + 273.15 - 1, "temp_max": temp + 273.15}}
+        for i, temp in enumerate(temps_celsius)
+        ]}
+
+
+class FakeWeatherServer:
+    """ Local OpenWeather stand-in on 127.0.0.1. Set .temps to change the
+        forecast, .fail = True to answer 503, .latency to slow it down"""
+    def __init__(self, temps=None, latency=0.0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.temps = temps or [30.0] * 40
+        self.latency = latency
+        self.fail = False
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out in separate writes, without this every
+            # keep-alive request waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.latency)
+                if server.fail:
+                    body, status = b'{"cod": 503}', 503
+                else:
+                    body, status = json.dumps(forecast_payload(server.temps)).encode(), 200
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/data/2.5/forecast"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class FakeTransport:
+    """ Stand-in for send_msg.TwilioTransport that records what it sends.
+        The first `failures` sends raise, every send takes `latency` seconds"""
+    def __init__(self, latency=0.0, failures=0):
+        self.latency = latency
+        self.failures = failures
+        self.attempts = 0
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to, body_text):
+        time.sleep(self.latency)
+        with self._lock:
+            self.attempts += 1
+            if self.attempts <= self.failures:
+                raise ConnectionError("fake Twilio unavailable")
+            self.sent.append((to, body_text))
+        return body_text
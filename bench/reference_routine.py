@@ -0,0 +1,107 @@
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import agent
+import inventory_store
+
+# Reference copies of code the library no longer runs, kept for the benches.
+# The old daily routine, check_spoilage (update_expiry, check_stocks) followed
+# by routine_msg on the default store, was replaced by agent.run_routine;
+# check_routine_regression.py checks the two still agree. clear_old_optimized
+# dropped expired flagged rows from a csv frame before compaction took that
+# over; suite.py keeps timing all of them against its baseline.
+# The agent functions are looked up at call time, so a bench can replace
+# agent.fetch_weather or agent.alert_user.
+
+
+def update_expiry():
+    """ decreases the expiry date by one day. Called when a certain condition
+        is met """
+    try:
+        inventory_store.shift_expiry("counter", -1)
+        return {"success":True, "msg": "Expiry dates updated"}
+    except Exception as e:
+        return {"success":False, "error":e}
+
+
+def check_stocks():
+    """ gets the list of items expiring by next 2 days"""
+    try:
+        # fewer than 3 whole days left from now, i.e. expiring up to today + 3
+        until_day = inventory_store.today_number() + 3
+        check_food_list = inventory_store.flag_expiring(until_day)
+        if check_food_list:
+            check_food = ",".join(check_food_list)
+            return {"success":True, "inventory_update":True, "check_list":check_food}
+        else:
+            return {"success":True, "inventory_update":False}
+    except Exception as e:
+        return {"success":False, "error":e}
+
+
+def check_spoilage():
+    """ calls appropriate sub routines to analyze stock info based on weather"""
+    get_weather = agent.fetch_weather()
+    if get_weather["success"]:
+        avg_temp = agent.get_avg(get_weather["w_data"])
+        if avg_temp>agent.threshold_temp:
+            update_expiry()
+            stock_check = check_stocks()
+            if stock_check["success"] and stock_check["inventory_update"]:
+                return {"success":True, "inventory_update":True, "msg": "Inventory updated"}
+            else:
+                return {"success":True, "inventory_update":False, "msg": "No Inventory update needed"}
+        else:
+            return {"success":True, "inventory_update":False, "msg": "No Inventory update needed"}
+    else:
+        return get_weather
+
+
+def routine_msg():
+    """ finds the items flagged and calls function to send user whatsapp msg"""
+    try:
+        mylist = inventory_store.flagged_names()
+        check_food_list = ",".join(mylist)
+        agent.alert_user(check_food_list)
+        return {"success":True, "msg": "Inventory refreshed successfully"}
+    except Exception as e:
+        print(f"Cannot be alerted for condition {e}")
+        return {"success":False, "error": e}
+
+
+def clear_old_optimized(df):
+    print("Clearing old items (Optimized)")
+    if "Unnamed: 0.1" in df.columns:
+        df.drop("Unnamed: 0", axis=1, inplace=True)
+    # Convert 'expiry_dt' to datetime objects for comparison
+    if pd.api.types.is_integer_dtype(df['expiry_dt']):
+        # a store day_frame already holds day numbers, nothing to parse
+        df['expiry_dt_dt'] = df['expiry_dt']
+        # dates parse to midnight, so an item expiring today is already past
+        curr_date = inventory_store.today_number() + 1
+    else:
+        df['expiry_dt_dt'] = pd.to_datetime(df['expiry_dt'], format='%d-%m-%Y')
+        curr_date = datetime.today()
+
+    # Define the condition for ROWS TO KEEP:
+    # KEEP if status is NOT 'flagged'
+    condition_keep_1 = (df['status'] != 'flagged')
+    
+    # OR KEEP if status IS 'flagged' AND the expiry date is NOT in the past
+    condition_keep_2 = (df['status'] == 'flagged') & (df['expiry_dt_dt'] >= curr_date)
+
+    # Combine the conditions using '|' (OR)
+    rows_to_keep = condition_keep_1 | condition_keep_2
+
+    # Return a new DataFrame containing only the rows to keep
+    # The original DataFrame is NOT modified (inplace=False by default)
+    df_cleaned = df[rows_to_keep].drop(columns=['expiry_dt_dt'])
+
+    print(f"Original shape: {df.shape}, Cleaned shape: {df_cleaned.shape}")
+    print(df_cleaned.head())
+    return df_cleaned
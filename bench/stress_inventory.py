@@ -0,0 +1,113 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory_store
+import mytools
+from benchutil import open_store
+
+# Stress test for concurrent inventory writes.
+# Several processes each run many threads that behave like /upload requests:
+# a slow OCR step outside any lock followed by mytools.update_stock. At the
+# same time a routine thread keeps shifting expiry dates and flagging items,
+# like agent.routine_agent does. At the end every uploaded row must be there.
+# python bench/stress_inventory.py --processes 2 --threads 16 --uploads 25
+# python bench/stress_inventory.py --backend journal
+
+
+def _payload(worker, upload):
+    return {"success": True, "items": [
+        {"name": f"banana-{worker}-{upload}", "type": "grocery"},
+        {"name": f"jam-{worker}-{upload}", "type": "packaged", "expiry_date": "01-01-2099",
+         "mfg_date": None, "time_remaining": None, "time_denom": None},
+        ]}
+
+
+def _uploader(worker, uploads, ocr_delay, failures):
+    for upload in range(uploads):
+        # the model call is not serialized behind the inventory lock
+        time.sleep(ocr_delay)
+        result = mytools.update_stock(_payload(worker, upload))
+        if not result["success"]:
+            failures.append(result["error"])
+
+
+def _routine(stop):
+    while not stop.is_set():
+        inventory_store.shift_expiry("counter", 0)
+        inventory_store.flag_expiring(inventory_store.today_number() - 36500)
+        inventory_store.frame()
+
+
+def run_process(backend, db_path, process_id, threads, uploads, ocr_delay):
+    inventory_store._store = open_store(backend, db_path)
+    failures = []
+    stop = threading.Event()
+    routine = threading.Thread(target=_routine, args=(stop,))
+    routine.start()
+    workers = [
+        threading.Thread(target=_uploader,
+                         args=(f"{process_id}.{i}", uploads, ocr_delay, failures))
+        for i in range(threads)
+        ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stop.set()
+    routine.join()
+    return len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent inventory write stress test")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--uploads", type=int, default=25)
+    parser.add_argument("--ocr-delay", type=float, default=0.005)
+    parser.add_argument("--backend", choices=["sqlite", "journal"], default="sqlite")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "stress.db")
+        open_store(args.backend, db_path)
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            failures = pool.starmap(run_process, [
+                (args.backend, db_path, p, args.threads, args.uploads, args.ocr_delay)
+                for p in range(args.processes)
+                ])
+        elapsed = time.perf_counter() - start
+
+        store = open_store(args.backend, db_path)
+        # compaction must not lose rows either
+        store.compact()
+        store = open_store(args.backend, db_path)
+        df = store.frame()
+        expected = args.processes * args.threads * args.uploads * 2
+        names = set(df["name"])
+        missing = [
+            name for p in range(args.processes) for i in range(args.threads)
+            for u in range(args.uploads) for name in (f"banana-{p}.{i}-{u}", f"jam-{p}.{i}-{u}")
+            if name not in names
+            ]
+        export_path = os.path.join(tmp, "export.csv")
+        exported = store.export_csv(export_path)
+
+    uploads = args.processes * args.threads * args.uploads
+    print(f"{uploads} uploads in {elapsed:.2f}s ({uploads / elapsed:.0f}/s), "
+          f"{len(df)} rows stored, {expected} expected, {sum(failures)} failed calls")
+    if missing or len(df) != expected or exported != expected or sum(failures):
+        print(f"FAILED: {len(missing)} rows lost")
+        sys.exit(1)
+    print("OK: no rows lost")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeGeminiModel, FakeTransport, FakeWeatherServer
+
+# Benchmark suite for the inventory tools and the HTTP endpoints at
+# production sizes. For every size it writes a synthetic sample_inventory.csv
+# and raw_food_db.csv of that many rows into a scratch directory, loads the
+# inventory store from them and times update_stock, fresh_stocks_format and
+# fetch_list, the reference clear_old_optimized, check_stocks and
+# update_expiry (reference_routine.py), then the /upload, /message and
+# /update-inventory endpoints against local stand-ins
+# for Gemini, OpenWeather and Twilio. Reported per benchmark: latency
+# percentiles, throughput and the peak memory of one run under tracemalloc.
+# --save writes the results as a baseline, --compare checks against one.
+# python bench/suite.py --sizes 100,1000,10000 --save bench/baseline.json
+# python bench/suite.py --sizes 100,1000,10000 --compare bench/baseline.json
+
+FOODS = ["banana", "apple", "guava", "pear", "mango", "carrot", "beans", "spinach",
+         "milk", "curd", "paneer", "bread", "tomato", "potato", "onion"]
+STORAGES = ["counter", "fridge", "freezer"]
+STATUSES = ["none", "open", "flagged"]
+
+
+def write_synthetic(tmp, rows, rng):
+    """ sample_inventory.csv and raw_food_db.csv with `rows` rows each"""
+    inventory_csv = os.path.join(tmp, f"inventory_{rows}.csv")
+    food_db_csv = os.path.join(tmp, f"raw_food_db_{rows}.csv")
+    today = date.today()
+    with open(inventory_csv, "w") as fl:
+        fl.write("name,expiry_dt,status,storage\n")
+        for i in range(rows):
+            expiry = today + timedelta(days=rng.randint(-20, 200))
+            fl.write(f"{rng.choice(FOODS)}-{i},{expiry:%d-%m-%Y},"
+                     f"{rng.choice(STATUSES)},{rng.choice(STORAGES)}\n")
+    food_names = FOODS + [f"food-{i}" for i in range(max(rows - len(FOODS), 0))]
+    with open(food_db_csv, "w") as fl:
+        fl.write("name,shelf_life,storage\n")
+        for name in food_names[:rows]:
+            fl.write(f"{name},{rng.randint(2, 60)},{rng.choice(STORAGES)}\n")
+    return inventory_csv, food_db_csv, food_names[:rows]
+
+
+def ocr_items(count, food_names, rng):
+    """ an OCR payload: mostly loose groceries, some packaged items"""
+    items = []
+    for i in range(count):
+        kind = i % 5
+        if kind < 3:
+            items.append({"type": "grocery", "name": rng.choice(food_names)})
+        elif kind == 3:
+            items.append({"type": "packaged", "name": f"jam-{i}", "mfg_date": None,
+                          "expiry_date": f"{rng.randint(1, 28):02d}-{rng.randint(1, 12):02d}-2027",
+                          "time_remaining": None, "time_denom": None})
+        else:
+            items.append({"type": "packaged", "name": f"pasta-{i}", "expiry_date": None,
+                          "mfg_date": "01-06-2026", "time_remaining": rng.choice([6, 180]),
+                          "time_denom": rng.choice(["m", "d"])})
+    return {"success": True, "items": items}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_bench(name, fn, setup=None, units=1, repeat=5, max_seconds=10.0):
+    """ times fn(*setup()) up to `repeat` times, setup is not timed"""
+    latencies = []
+    started = time.perf_counter()
+    sink = io.StringIO()
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        with contextlib.redirect_stdout(sink):
+            start = time.perf_counter()
+            fn(*args)
+            latencies.append(time.perf_counter() - start)
+        sink.seek(0)
+        sink.truncate()
+        if time.perf_counter() - started > max_seconds:
+            break
+    # one more run with allocations traced, tracemalloc slows it down
+    args = setup() if setup else ()
+    with contextlib.redirect_stdout(sink):
+        tracemalloc.start()
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    p50 = percentile(latencies, 50)
+    result = {
+        "runs": len(latencies),
+        "p50_ms": p50 * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "throughput": units / p50 if p50 else float("inf"),
+        "peak_mb": peak / 2 ** 20,
+        }
+    print(f"{name:34s} {result['runs']:4d} {result['p50_ms']:10.2f} {result['p95_ms']:10.2f} "
+          f"{result['p99_ms']:10.2f} {result['throughput']:14.1f} {result['peak_mb']:9.1f}")
+    return result
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("benchmark request did not finish")
+        time.sleep(0.0005)
+
+
+def suite_for_size(rows, tmp, args, services, rng):
+    import app as webapp
+    import households
+    import inventory_store
+    import jobs
+    import mytools
+    import reference_routine
+
+    inventory_csv, food_db_csv, food_names = write_synthetic(tmp, rows, rng)
+    mytools.shelf_index = mytools.ShelfLifeIndex(food_db_csv)
+    path = os.path.join(tmp, f"inventory_{rows}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.backend == "journal":
+            store = inventory_store.JournalStore(path + ".journal", path + ".snapshot",
+                                                 seed_csv=None)
+            store.import_csv(inventory_csv)
+        else:
+            store = inventory_store.InventoryStore(path + ".db", seed_csv=inventory_csv)
+    inventory_store._store = store
+    households._stores.clear()
+    results = {}
+    bench = lambda name, *a, **k: results.__setitem__(
+        name, run_bench(f"{name} @{rows}", *a, repeat=args.repeat, max_seconds=args.max_seconds, **k))
+
+    batch = min(rows, args.max_items)
+    upload = ocr_items(args.upload_items, food_names, rng)
+    payload = ocr_items(batch, food_names, rng)
+    bench("fresh_stocks_format", mytools.fresh_stocks_format, lambda: (payload,), units=batch)
+    bench("update_stock", mytools.update_stock, lambda: (upload,), units=args.upload_items)
+    bench("clear_old_optimized", reference_routine.clear_old_optimized,
+          lambda: (store.frame().drop(columns="id"),), units=rows)
+    bench("check_stocks", reference_routine.check_stocks, units=rows)
+    bench("update_expiry", reference_routine.update_expiry, units=rows)
+    bench("fetch_list", mytools.fetch_list, units=rows)
+
+    if args.skip_endpoints:
+        return results
+    client = webapp.app.test_client()
+    image = services["image"]
+
+    def post_upload():
+        response = client.post("/upload", data={"file": (io.BytesIO(image), "shelf.jpg")})
+        job_id = response.get_json()["job_id"]
+        wait_for(lambda: jobs.upload_jobs.get(job_id)["status"] in ("done", "failed"))
+
+    transport = services["transport"]
+
+    def post_message():
+        sent = len(transport.sent)
+        form = {"From": "whatsapp:+10000000000", "Body": "Donate",
+                "MessageSid": f"SM-suite-{next(services['sids'])}"}
+        client.post("/message", data=form)
+        wait_for(lambda: len(transport.sent) > sent)
+
+    def post_update():
+        response = client.post("/update-inventory")
+        assert response.status_code == 200, response.get_json()
+
+    bench("POST /upload", post_upload)
+    bench("POST /message", post_message)
+    bench("POST /update-inventory", post_update)
+    return results
+
+
+def compare(results, baseline_path, tolerance, min_delta_ms):
+    with open(baseline_path) as fl:
+        baseline = json.load(fl)["results"]
+    regressions = []
+    print(f"\n{'benchmark':40s} {'baseline':>10s} {'now':>10s} {'change':>8s}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before, now = baseline[key]["p50_ms"], result["p50_ms"]
+        change = (now - before) / before if before else 0.0
+        flag = ""
+        # sub millisecond timings are mostly noise
+        if change > tolerance and now - before > min_delta_ms:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:40s} {before:10.2f} {now:10.2f} {change:+8.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pantry benchmark suite")
+    parser.add_argument("--sizes", default="100,1000,10000,100000,1000000",
+                        help="comma separated row counts")
+    parser.add_argument("--backend", choices=["sqlite", "journal"], default="sqlite")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=10.0,
+                        help="stop repeating a benchmark after this long")
+    parser.add_argument("--max-items", type=int, default=100000,
+                        help="largest OCR payload for fresh_stocks_format")
+    parser.add_argument("--upload-items", type=int, default=20)
+    parser.add_argument("--gemini-latency", type=float, default=0.0)
+    parser.add_argument("--weather-latency", type=float, default=0.0)
+    parser.add_argument("--skip-endpoints", action="store_true")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="baseline file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown of p50 counted as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="smaller slowdowns are never a regression")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    rng = random.Random(2024)
+    with tempfile.TemporaryDirectory() as tmp, \
+            FakeWeatherServer(latency=args.weather_latency) as weather:
+        # every store, cache and state file the app opens lands in tmp
+        os.chdir(tmp)
+        os.environ["RUN_SCHEDULER"] = "0"
+        logging.getLogger("send_msg").setLevel(logging.WARNING)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import agent
+            import agent3
+            import agent_image
+            import send_msg
+            from PIL import Image
+
+        transport = FakeTransport()
+        send_msg.set_transport(transport)
+        send_msg.get_dispatcher().coalesce_window = 0
+        agent.forecast_cache = agent.ForecastCache(url=weather.url, api_key="bench", ttl=0)
+        agent_image.set_processor(agent_image.GeminiReceiptProcessor(
+            model=FakeGeminiModel(latency=args.gemini_latency), cache=False))
+        agent3._donation_cache = agent3.DonationCache(
+            path=os.path.join(tmp, "donation_cache.json"),
+            search=lambda checklist, place: "1. Food Bank, Some Street, 0000")
+        shelf = io.BytesIO()
+        Image.new("RGB", (1200, 900), (180, 140, 90)).save(shelf, "JPEG")
+        # MessageSids must stay unique across sizes, repeats are dropped as redeliveries
+        services = {"transport": transport, "image": shelf.getvalue(), "sids": itertools.count()}
+
+        print(f"{'benchmark':34s} {'runs':>4s} {'p50 ms':>10s} {'p95 ms':>10s} "
+              f"{'p99 ms':>10s} {'per second':>14s} {'peak MB':>9s}")
+        results = {}
+        for rows in sizes:
+            for name, result in suite_for_size(rows, tmp, args, services, rng).items():
+                results[f"{name}@{rows}"] = result
+        send_msg.flush()
+
+    if save:
+        with open(save, "w") as fl:
+            json.dump({"meta": {"created": datetime.now().isoformat(timespec="seconds"),
+                                "python": platform.python_version(),
+                                "platform": platform.platform(),
+                                "backend": args.backend},
+                       "results": results}, fl, indent=1)
+        print(f"Baseline written to {save}")
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"FAILED: {len(regressions)} benchmark(s) slower than the baseline")
+            sys.exit(1)
+        print("OK: no regressions")
+
+
+if __name__ == "__main__":
+    main()
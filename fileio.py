@@ -0,0 +1,74 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, only threads of one process are coordinated
+    fcntl = None
+
+# Atomic file replacement for the inventory snapshots, the scheduler state,
+# the donation cache and the spoilage ledgers. The content goes to a temp
+# file next to the target and is renamed over it once fully written, so
+# readers see either the old or the new file. A write that fails leaves the
+# old file and removes the temp file. The temp file is fsynced before the
+# rename and the directory after it, so once atomic_write returns the new
+# file survives a crash and whatever it replaces (the journal folded into a
+# snapshot) can be discarded.
+# flock() is the cross-process lock used around those files, the inventory
+# journal, the scheduler state and the donation cache. It locks a side file that is never
+# replaced, and does nothing where flock does not exist.
+
+# False on Windows, callers coordinate their own threads there
+HAVE_FLOCK = fcntl is not None
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w", prefix: str = ".tmp-", suffix: str = "",
+                 **open_kwargs):
+    """ yields a temp file next to path, renamed onto path when the block
+        completes and deleted when it raises"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=directory)
+    try:
+        with os.fdopen(fd, mode, **open_kwargs) as fl:
+            yield fl
+            fl.flush()
+            os.fsync(fl.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    fsync_directory(directory)
+
+
+@contextmanager
+def flock(path: str, shared: bool = False, blocking: bool = True):
+    """ flock on path, created if missing. Yields False when blocking is off
+        and another process holds it"""
+    if fcntl is None:
+        yield True
+        return
+    operation = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+    with open(path, "a") as lock_fl:
+        try:
+            fcntl.flock(lock_fl, operation)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_fl, fcntl.LOCK_UN)
+
+
+def fsync_directory(directory: str):
+    """ makes a rename or a new file in directory durable, a no-op where
+        directories cannot be opened (Windows)"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
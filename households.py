@@ -0,0 +1,167 @@
+import csv
+import os
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# Households served by one deployment.
+# Each household has a phone number, a location and its own inventory
+# partition, a store under HOUSEHOLD_DIR/<id>/ with the backend picked by
+# INVENTORY_BACKEND. The registry is households.csv (id,phone,lat,lon,location)
+# and is reloaded when the file changes. Without a registry there is only the
+# "default" household: TO_NUMBER, the home location and the original
+# pantry.db / journal files, so a single household install runs as before.
+# Households close to each other share a grid cell and with it one forecast.
+# inventory_store (pandas) is imported when the first store is opened.
+
+households_file = os.getenv("HOUSEHOLDS_FILE", "households.csv")
+household_dir = os.getenv("HOUSEHOLD_DIR", "households")
+DEFAULT_ID = "default"
+# Have used my home location.
+HOME_LAT, HOME_LON = 22.5744, 88.3629
+HOME_LOCATION = "Dhakuria area of Kolkata in India"
+# forecast grid in degrees, 0.1 is about 11 km
+GRID_DEGREES = float(os.getenv("FORECAST_GRID_DEGREES", "0.1"))
+# open stores kept per process, the least recently used ones are dropped
+MAX_OPEN_STORES = int(os.getenv("MAX_OPEN_STORES", "256"))
+
+
+def normalize_phone(phone: str) -> str:
+    """ +919800000000 for "whatsapp:+91 98000 00000" and similar"""
+    phone = (phone or "").strip().split("whatsapp:")[-1]
+    return "".join(ch for ch in phone if ch.isdigit() or ch == "+")
+
+
+@dataclass(frozen=True)
+class Household:
+    id: str
+    phone: str
+    lat: float = HOME_LAT
+    lon: float = HOME_LON
+    location: str = HOME_LOCATION
+
+    def grid_cell(self, degrees: float = GRID_DEGREES) -> Tuple[float, float]:
+        """ center of the forecast grid cell the household is in"""
+        return (round(round(self.lat / degrees) * degrees, 4),
+                round(round(self.lon / degrees) * degrees, 4))
+
+
+def default_household() -> Household:
+    return Household(DEFAULT_ID, normalize_phone(os.getenv("TO_NUMBER", "")))
+
+
+class HouseholdRegistry:
+    """ households.csv indexed by id and phone number, reloaded on change"""
+    def __init__(self, path: str = households_file):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._by_id = {}
+        self._by_phone = {}
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime == self._mtime and (self._by_id or mtime is not None):
+                return
+            if mtime is None:
+                members = [default_household()]
+            else:
+                with open(self.path, newline="") as fl:
+                    members = [
+                        Household(row["id"].strip(), normalize_phone(row["phone"]),
+                                  float(row["lat"]), float(row["lon"]),
+                                  row.get("location") or HOME_LOCATION)
+                        for row in csv.DictReader(fl) if row.get("id")
+                        ]
+            self._by_id = {member.id: member for member in members}
+            self._by_phone = {member.phone: member for member in members if member.phone}
+            self._mtime = mtime
+
+    @property
+    def single(self) -> bool:
+        """ True when no registry exists and everything is the default household"""
+        self._refresh()
+        return self._mtime is None
+
+    def all(self) -> List[Household]:
+        self._refresh()
+        return list(self._by_id.values())
+
+    def get(self, household_id: Optional[str]) -> Optional[Household]:
+        self._refresh()
+        return self._by_id.get(household_id or DEFAULT_ID)
+
+    def by_phone(self, phone: str) -> Optional[Household]:
+        """ household of a WhatsApp sender, None if the number is unknown"""
+        if self.single:
+            # single household install, every sender is the owner
+            return self._by_id[DEFAULT_ID]
+        return self._by_phone.get(normalize_phone(phone))
+
+
+_registry = None
+_stores = OrderedDict()
+_stores_lock = threading.Lock()
+
+
+def get_registry() -> HouseholdRegistry:
+    global _registry
+    if _registry is None:
+        _registry = HouseholdRegistry()
+    return _registry
+
+
+def _open_store(household_id: str):
+    import inventory_store
+    if household_id == DEFAULT_ID:
+        return inventory_store.get_store()
+    # the id names a directory
+    if not household_id.replace("-", "").replace("_", "").isalnum():
+        raise ValueError(f"Invalid household id {household_id!r}")
+    base = os.path.join(household_dir, household_id)
+    os.makedirs(base, exist_ok=True)
+    if inventory_store.backend == "journal":
+        return inventory_store.JournalStore(os.path.join(base, "inventory.journal"),
+                                            os.path.join(base, "inventory_snapshot.csv"),
+                                            seed_csv=None)
+    return inventory_store.InventoryStore(os.path.join(base, "pantry.db"), seed_csv=None)
+
+
+def store_for(household: Optional[Household] = None):
+    """ inventory partition of a household, the default one when None"""
+    household_id = household.id if household else DEFAULT_ID
+    with _stores_lock:
+        store = _stores.get(household_id)
+        if store is not None:
+            _stores.move_to_end(household_id)
+            return store
+    store = _open_store(household_id)
+    with _stores_lock:
+        store = _stores.setdefault(household_id, store)
+        while len(_stores) > MAX_OPEN_STORES:
+            _stores.popitem(last=False)
+    return store
+
+
+def open_stores() -> Dict[str, object]:
+    """ stores this process has opened by household id, none is opened here"""
+    with _stores_lock:
+        stores = dict(_stores)
+    # the default store may have been opened through inventory_store directly
+    inventory_store = sys.modules.get("inventory_store")
+    if DEFAULT_ID not in stores and inventory_store is not None and inventory_store._store is not None:
+        stores[DEFAULT_ID] = inventory_store._store
+    return stores
+
+
+def by_grid_cell(members: List[Household]) -> Dict[Tuple[float, float], List[Household]]:
+    cells = {}
+    for member in members:
+        cells.setdefault(member.grid_cell(), []).append(member)
+    return cells
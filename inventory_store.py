@@ -0,0 +1,1016 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from fileio import HAVE_FLOCK, atomic_write, flock
+
+# Storage backend for the pantry inventory.
+# The inventory used to live only in sample_inventory.csv and every tool read
+# and rewrote the whole file. It is now kept in SQLite with the expiry date
+# stored as an integer day number (days since 1970-01-01) and indexes on
+# expiry_dt, status and storage, so adding an item, flagging items or finding
+# the ones expiring soon only touches the affected rows.
+# The csv format is still supported through import_csv / export_csv.
+# Writes from Flask request threads, the scheduler and other worker processes
+# are coordinated here: the database runs in WAL mode so reads never wait on a
+# writer, writers in one process queue on a lock and take the SQLite write lock
+# with BEGIN IMMEDIATE, and csv exports are written to a temp file and renamed
+# into place so a reader never sees a half written file.
+# INVENTORY_BACKEND=journal switches to an append-only journal instead: every
+# add, flag or expiry shift is one small record appended to a log, so the cost
+# of an upload depends only on the upload. compact() folds the log into a
+# snapshot and drops expired flagged items; the scheduler calls it regularly.
+# Both backends answer "expiring by day D", "flagged" and "expired flagged"
+# without scanning the whole inventory: SQLite through its indexes and the
+# journal through ExpiryIndex, sorted numpy arrays of day and id kept in
+# memory next to the rows, which are numpy arrays too.
+# Frames handed out are columnar: name, status and storage are categoricals
+# and expiry_dt is int32, a fraction of the memory of object columns. The
+# journal snapshot is binary: Arrow/Feather when pyarrow is installed, memory
+# mapped on load, otherwise a numpy .npz of the same columns. Either loads
+# without parsing a single date. INVENTORY_SNAPSHOT_FORMAT=csv keeps the old
+# text snapshot; csv stays the import/export format in any case.
+
+backend = os.getenv("INVENTORY_BACKEND", "sqlite")
+db_file = os.getenv("INVENTORY_DB", "pantry.db")
+journal_file = os.getenv("INVENTORY_JOURNAL", "inventory.journal")
+snapshot_file = os.getenv("INVENTORY_SNAPSHOT", "inventory_snapshot.csv")
+# auto, feather, npz or csv. auto is feather when pyarrow imports, npz if not
+SNAPSHOT_FORMAT = os.getenv("INVENTORY_SNAPSHOT_FORMAT", "auto")
+BUSY_TIMEOUT = float(os.getenv("INVENTORY_BUSY_TIMEOUT", "30"))
+csv_file = "sample_inventory.csv"
+DATE_FORMAT = "%d-%m-%Y"
+COLUMNS = ["name", "expiry_dt", "status", "storage"]
+CATEGORICAL = ["name", "status", "storage"]
+SNAPSHOT_SUFFIXES = {"feather": ".arrow", "npz": ".npz"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS inventory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    expiry_dt INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    storage TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_inventory_expiry ON inventory(expiry_dt);
+CREATE INDEX IF NOT EXISTS idx_inventory_status ON inventory(status, expiry_dt);
+CREATE INDEX IF NOT EXISTS idx_inventory_storage ON inventory(storage);
+"""
+
+
+def day_number(day: date) -> int:
+    """ date to days since 1970-01-01"""
+    return int(np.datetime64(day, "D").astype(np.int64))
+
+
+def today_number() -> int:
+    return day_number(date.today())
+
+
+def to_day_numbers(values) -> np.ndarray:
+    """ DD-MM-YYYY strings to an int64 array of day numbers"""
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), format=DATE_FORMAT)
+    return parsed.values.astype("datetime64[D]").astype(np.int64)
+
+
+def from_day_numbers(values) -> pd.Series:
+    """ day numbers back to DD-MM-YYYY strings"""
+    days = np.asarray(values, dtype=np.int64).astype("datetime64[D]")
+    return pd.Series(days).dt.strftime(DATE_FORMAT)
+
+
+def _write_csv_atomic(df: pd.DataFrame, path: str, header: Optional[str] = None):
+    """ writes to a temp file next to path and renames it into place, so
+        readers see either the old or the new file"""
+    with atomic_write(path, "w", prefix=".inventory-", suffix=".csv", newline="") as fl:
+        if header:
+            fl.write(header + "\n")
+        df.to_csv(fl, index=False)
+
+
+def compact_frame(ids, names, days, statuses, storages) -> pd.DataFrame:
+    """ inventory columns as a DataFrame with categorical name, status and
+        storage and expiry_dt as int32 day numbers"""
+    return pd.DataFrame({
+        "id": np.asarray(ids, dtype=np.int64),
+        "name": pd.Categorical(names),
+        "expiry_dt": np.asarray(days, dtype=np.int32),
+        "status": pd.Categorical(statuses),
+        "storage": pd.Categorical(storages),
+        })
+
+
+def _frame_from_rows(rows) -> pd.DataFrame:
+    """ compact_frame from (id, name, day, status, storage) tuples"""
+    columns = list(zip(*rows)) if rows else [[], [], [], [], []]
+    return compact_frame(*columns)
+
+
+_feather = None
+
+
+def _pyarrow_feather():
+    """ pyarrow.feather, imported on first use, None when not installed"""
+    global _feather
+    if _feather is None:
+        try:
+            import pyarrow.feather as feather
+        except ImportError:
+            feather = False
+        _feather = feather
+    return _feather or None
+
+
+def snapshot_format() -> str:
+    if SNAPSHOT_FORMAT != "auto":
+        return SNAPSHOT_FORMAT
+    return "feather" if _pyarrow_feather() else "npz"
+
+
+def write_snapshot(df: pd.DataFrame, path: str, meta: Dict[str, int], fmt: str):
+    """ writes a compact_frame to path in fmt, atomically like the csv files.
+        meta holds small integers (journal_seq, next_id) stored with it"""
+    if fmt == "csv":
+        out = df.copy()
+        out["expiry_dt"] = from_day_numbers(df["expiry_dt"].to_numpy())
+        header = "# " + " ".join(f"{key}={value}" for key, value in meta.items())
+        _write_csv_atomic(out, path, header=header)
+        return
+    with atomic_write(path, "wb", prefix=".inventory-", suffix=SNAPSHOT_SUFFIXES[fmt]) as fl:
+        if fmt == "feather":
+            feather = _pyarrow_feather()
+            if feather is None:
+                raise RuntimeError("feather snapshots need pyarrow installed")
+            import pyarrow as pa
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.replace_schema_metadata(dict(
+                table.schema.metadata or {}, **{key: str(value) for key, value in meta.items()}))
+            # uncompressed so the columns can be memory mapped on load
+            feather.write_feather(table, fl, compression="uncompressed")
+        else:
+            arrays = {"id": df["id"].to_numpy(np.int64),
+                      "expiry_dt": df["expiry_dt"].to_numpy(np.int32),
+                      "meta": np.array(json.dumps(meta))}
+            for column in CATEGORICAL:
+                values = df[column].astype("category")
+                arrays[column + "_codes"] = values.cat.codes.to_numpy()
+                arrays[column + "_categories"] = np.asarray(values.cat.categories, dtype=str)
+            np.savez(fl, **arrays)
+
+
+def read_snapshot(path: str):
+    """ (compact_frame, meta) from a snapshot in any of the formats"""
+    with open(path, "rb") as fl:
+        magic = fl.read(6)
+    if magic == b"ARROW1":
+        feather = _pyarrow_feather()
+        if feather is None:
+            raise RuntimeError(f"{path} is a feather snapshot, install pyarrow to load it")
+        table = feather.read_table(path, memory_map=True)
+        meta = {key.decode(): int(value) for key, value in (table.schema.metadata or {}).items()
+                if key != b"pandas"}
+        return table.to_pandas(), meta
+    if magic.startswith(b"PK"):
+        with np.load(path, allow_pickle=False) as data:
+            columns = {column: pd.Categorical.from_codes(data[column + "_codes"],
+                                                         data[column + "_categories"].tolist())
+                       for column in CATEGORICAL}
+            df = pd.DataFrame({"id": data["id"], "name": columns["name"],
+                               "expiry_dt": data["expiry_dt"], "status": columns["status"],
+                               "storage": columns["storage"]})
+            return df, json.loads(str(data["meta"]))
+    with open(path) as fl:
+        meta = {key: int(value) for key, value in
+                (field.split("=") for field in fl.readline()[1:].split())}
+        df = pd.read_csv(fl)
+    return compact_frame(df["id"], df["name"], to_day_numbers(df["expiry_dt"]),
+                         df["status"], df["storage"]), meta
+
+
+class InventoryStore:
+    """ SQLite inventory with the same columns as sample_inventory.csv"""
+    def __init__(self, path: str = db_file, seed_csv: Optional[str] = csv_file):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        is_new = not os.path.exists(path)
+        with self._write_lock:
+            # journal mode and schema changes cannot run inside BEGIN
+            conn = self._connection()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        # first run on an existing installation, carry the csv over
+        if is_new and seed_csv and os.path.exists(seed_csv):
+            count = self.import_csv(seed_csv)
+            print(f"Inventory store created from {seed_csv} with {count} items")
+
+    def _connection(self) -> sqlite3.Connection:
+        """ one connection per thread, opened again after a fork"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _read(self):
+        """ reads run in autocommit mode and see the last committed state"""
+        with metrics.track("inventory_read"):
+            yield self._connection()
+
+    @contextmanager
+    def _write(self):
+        """ one writer per process at a time, one transaction per block"""
+        conn = self._connection()
+        with metrics.track("inventory_write"), self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def day_frame(self) -> pd.DataFrame:
+        """ whole inventory in insertion order, expiry_dt as day numbers"""
+        with self._read() as conn:
+            rows = conn.execute(
+                "SELECT id, name, expiry_dt, status, storage FROM inventory ORDER BY id"
+                ).fetchall()
+        return _frame_from_rows(rows)
+
+    def frame(self) -> pd.DataFrame:
+        """ whole inventory as a DataFrame in insertion order"""
+        df = self.day_frame()
+        df["expiry_dt"] = from_day_numbers(df["expiry_dt"].to_numpy())
+        return df
+
+    def update_rows(self, ids, expiry_days, statuses) -> int:
+        """ sets expiry day and status of the given rows in one transaction"""
+        rows = list(zip(np.asarray(expiry_days).tolist(), list(statuses), np.asarray(ids).tolist()))
+        if not rows:
+            return 0
+        with self._write() as conn:
+            conn.executemany("UPDATE inventory SET expiry_dt = ?, status = ? WHERE id = ?", rows)
+        return len(rows)
+
+    def count(self) -> int:
+        with self._read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM inventory").fetchone()[0]
+
+    def count_status(self, status: str) -> int:
+        with self._read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM inventory WHERE status = ?",
+                                (status,)).fetchone()[0]
+
+    def add_items(self, df: pd.DataFrame) -> int:
+        """ inserts new rows with expiry_dt as DD-MM-YYYY strings"""
+        if df.empty:
+            return 0
+        rows = zip(df["name"].tolist(), to_day_numbers(df["expiry_dt"]).tolist(),
+                   df["status"].tolist(), df["storage"].tolist())
+        with self._write() as conn:
+            conn.executemany(
+                "INSERT INTO inventory (name, expiry_dt, status, storage) VALUES (?, ?, ?, ?)",
+                rows)
+        return len(df)
+
+    def shift_expiry(self, storage: str, days: int) -> int:
+        """ moves the expiry date of every item kept in storage by days"""
+        with self._write() as conn:
+            cur = conn.execute(
+                "UPDATE inventory SET expiry_dt = expiry_dt + ? WHERE storage = ?",
+                (days, storage))
+            return cur.rowcount
+
+    def flag_expiring(self, until_day: int) -> List[str]:
+        """ flags items expiring on or before until_day and returns their names"""
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE inventory SET status = 'flagged' WHERE expiry_dt <= ? AND status != 'flagged'",
+                (until_day,))
+            rows = conn.execute(
+                "SELECT name FROM inventory WHERE expiry_dt <= ? ORDER BY id",
+                (until_day,)).fetchall()
+        return [row[0] for row in rows]
+
+    def purge_expired_flagged(self, until_day: int) -> int:
+        """ deletes flagged items that expired on or before until_day"""
+        with self._write() as conn:
+            cur = conn.execute(
+                "DELETE FROM inventory WHERE status = 'flagged' AND expiry_dt <= ?",
+                (until_day,))
+            return cur.rowcount
+
+    def names_with_status(self, status: str) -> List[str]:
+        with self._read() as conn:
+            rows = conn.execute(
+                "SELECT name FROM inventory WHERE status = ? ORDER BY id",
+                (status,)).fetchall()
+        return [row[0] for row in rows]
+
+    def _query_frame(self, where: str, params) -> pd.DataFrame:
+        with self._read() as conn:
+            rows = conn.execute(
+                "SELECT id, name, expiry_dt, status, storage FROM inventory WHERE "
+                + where + " ORDER BY id", params).fetchall()
+        return _frame_from_rows(rows)
+
+    def expiring_until(self, until_day: int) -> pd.DataFrame:
+        """ rows expiring on or before until_day, expiry_dt as day numbers"""
+        return self._query_frame("expiry_dt <= ?", (until_day,))
+
+    def flagged_names(self) -> List[str]:
+        return self.names_with_status("flagged")
+
+    def expired_flagged(self, until_day: int) -> pd.DataFrame:
+        """ flagged rows that expired on or before until_day"""
+        return self._query_frame("status = 'flagged' AND expiry_dt <= ?", (until_day,))
+
+    def import_csv(self, path: str = csv_file, replace: bool = True) -> int:
+        """ loads a sample_inventory style csv, replacing the current rows by default"""
+        df = pd.read_csv(path, usecols=COLUMNS)
+        rows = zip(df["name"].tolist(), to_day_numbers(df["expiry_dt"]).tolist(),
+                   df["status"].tolist(), df["storage"].tolist())
+        with self._write() as conn:
+            if replace:
+                conn.execute("DELETE FROM inventory")
+            conn.executemany(
+                "INSERT INTO inventory (name, expiry_dt, status, storage) VALUES (?, ?, ?, ?)",
+                rows)
+        return len(df)
+
+    def export_csv(self, path: str = csv_file) -> int:
+        """ writes the inventory in the sample_inventory.csv format"""
+        df = self.frame()
+        _write_csv_atomic(df[COLUMNS], path)
+        return len(df)
+
+    def compact(self, until_day: Optional[int] = None) -> int:
+        """ drops expired flagged items and folds the WAL back into the db"""
+        if until_day is None:
+            until_day = today_number()
+        removed = self.purge_expired_flagged(until_day)
+        self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+
+def _grown(array: np.ndarray, used: int, capacity: int) -> np.ndarray:
+    """ array with room for capacity items, the first used copied over"""
+    grown = np.empty(capacity, dtype=array.dtype)
+    grown[:used] = array[:used]
+    return grown
+
+
+class ExpiryIndex:
+    """
+        Rows ordered by expiry day, one sorted int64 array of keys per storage
+        and status (open or flagged), a key being base day << 32 | id. Range
+        queries are a searchsorted plus the matching slice, O(log n + k).
+        Shifting every item of one storage is O(1): the keys hold base days
+        and the storage keeps an offset. Callers pass base days, the day less
+        offset(storage).
+    """
+    def __init__(self):
+        self._open = {}
+        self._flagged = {}
+        self._offset = {}
+
+    @staticmethod
+    def _keys(ids, base_days) -> np.ndarray:
+        return (np.asarray(base_days, dtype=np.int64) << 32) | np.asarray(ids, dtype=np.int64)
+
+    @staticmethod
+    def _ids(keys) -> np.ndarray:
+        return keys & 0xFFFFFFFF
+
+    def build(self, ids, base_days, storage_codes, storage_labels, flagged):
+        """ bulk load, one sort per storage and status"""
+        self.__init__()
+        keys = self._keys(ids, base_days)
+        for code, storage in enumerate(storage_labels):
+            in_storage = storage_codes == code
+            for lists, wanted in ((self._open, False), (self._flagged, True)):
+                picked = keys[in_storage & (flagged == wanted)]
+                if len(picked):
+                    lists[storage] = np.sort(picked)
+
+    def __len__(self):
+        return sum(len(keys) for lists in (self._open, self._flagged) for keys in lists.values())
+
+    def offset(self, storage: str) -> int:
+        return self._offset.get(storage, 0)
+
+    def add(self, storage: str, ids, base_days, flagged: bool = False):
+        lists = self._flagged if flagged else self._open
+        new = np.sort(self._keys(ids, base_days))
+        keys = lists.get(storage)
+        if keys is None:
+            lists[storage] = new
+        else:
+            lists[storage] = np.insert(keys, np.searchsorted(keys, new), new)
+
+    def remove(self, storage: str, ids, base_days, flagged: bool = False):
+        lists = self._flagged if flagged else self._open
+        keys = lists[storage]
+        lists[storage] = np.delete(keys, np.searchsorted(keys, self._keys(ids, base_days)))
+
+    def shift(self, storage: str, days: int):
+        self._offset[storage] = self.offset(storage) + days
+
+    def count(self, storage: str) -> int:
+        return len(self._open.get(storage, ())) + len(self._flagged.get(storage, ()))
+
+    def count_flagged(self) -> int:
+        return sum(len(keys) for keys in self._flagged.values())
+
+    def _until(self, keys: np.ndarray, storage: str, until_day: int) -> int:
+        """ number of leading keys with a day on or before until_day"""
+        return int(np.searchsorted(keys, (until_day - self.offset(storage) + 1) << 32))
+
+    def flag_until(self, until_day: int) -> np.ndarray:
+        """ moves open rows expiring on or before until_day to flagged"""
+        newly = []
+        for storage, keys in self._open.items():
+            end = self._until(keys, storage, until_day)
+            if not end:
+                continue
+            moved = keys[:end]
+            self._open[storage] = keys[end:]
+            flagged = self._flagged.get(storage)
+            self._flagged[storage] = moved if flagged is None else \
+                np.insert(flagged, np.searchsorted(flagged, moved), moved)
+            newly.append(self._ids(moved))
+        return np.concatenate(newly) if newly else np.empty(0, dtype=np.int64)
+
+    def _prefixes(self, lists, until_day: Optional[int]) -> np.ndarray:
+        parts = [self._ids(keys if until_day is None else keys[:self._until(keys, storage, until_day)])
+                 for storage, keys in lists.items()]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def expiring_until(self, until_day: int) -> np.ndarray:
+        """ ids of open and flagged rows expiring on or before until_day"""
+        return np.concatenate([self._prefixes(self._open, until_day),
+                               self._prefixes(self._flagged, until_day)])
+
+    def flagged(self) -> np.ndarray:
+        return self._prefixes(self._flagged, None)
+
+    def expired_flagged(self, until_day: int) -> np.ndarray:
+        return self._prefixes(self._flagged, until_day)
+
+
+class JournalStore:
+    """
+        Append-only inventory. The current state is the snapshot plus the
+        records in the journal, replayed into memory. Writes append one json
+        line under a file lock; other processes pick up new lines on their
+        next call by reading from where they stopped.
+        Reads never wait for a write: a reader takes the file lock shared
+        without blocking and, while a write holds it, answers from the rows
+        this process has already applied. The in-memory rows are guarded by
+        a short state lock that a writer does not hold across its fsync.
+        Records carry a sequence number and the snapshot header stores the
+        last one it contains, so a crash between writing the snapshot and
+        truncating the journal never applies a record twice.
+        Rows are numpy arrays sorted by id: the day, and codes into label
+        lists for name, status and storage, the layout of the snapshot, so
+        loading one copies a few arrays. Days are held less the shifts of
+        their storage since the snapshot (the ExpiryIndex offsets), so
+        replaying a shift record is O(1).
+    """
+    def __init__(self, journal_path: str = journal_file, snapshot_path: str = snapshot_file,
+                 seed_csv: Optional[str] = csv_file, fsync: bool = True):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.fsync = fsync
+        # writers, one at a time per process
+        self._lock = threading.RLock()
+        # the in-memory rows, index and journal offset
+        self._state_lock = threading.RLock()
+        self._loaded = False
+        self._reset_rows()
+        self._next_id = 1
+        self._offset = 0
+        self._seq = 0
+        self._snapshot_seq = 0
+        self._snapshot_state = None
+        if seed_csv and os.path.exists(seed_csv) and self._current_snapshot() is None \
+                and not os.path.exists(journal_path):
+            df = self._csv_frame(seed_csv, 1)
+            self._write_snapshot(df, 0, len(df) + 1)
+            print(f"Inventory journal created from {seed_csv} with {len(df)} items")
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """ writers: thread lock plus exclusive flock on a side file that
+            compaction never replaces. Readers: shared flock, taken without
+            waiting once the rows are loaded. Yields False when a write holds it"""
+        if exclusive:
+            with metrics.track("inventory_write"), self._lock, self._flock():
+                yield True
+            return
+        with metrics.track("inventory_read"):
+            if not HAVE_FLOCK:
+                # threads only, a writer of this process is the one to wait for
+                got = self._lock.acquire(blocking=not self._loaded)
+                try:
+                    yield got
+                finally:
+                    if got:
+                        self._lock.release()
+                return
+            with self._flock(shared=True, blocking=not self._loaded) as got:
+                yield got
+
+    def _flock(self, shared: bool = False, blocking: bool = True):
+        return flock(self.journal_path + ".lock", shared, blocking)
+
+    @contextmanager
+    def _reading(self):
+        """ state lock held, caught up with the journal unless a write is
+            going on, then the rows already applied are the answer"""
+        with self._file_lock(exclusive=False) as current:
+            if current:
+                self._catch_up()
+        with self._state_lock:
+            yield
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _snapshot_paths(self) -> Dict[str, str]:
+        """ snapshot_path for csv, the same name with .arrow or .npz otherwise"""
+        base = os.path.splitext(self.snapshot_path)[0]
+        paths = {fmt: base + suffix for fmt, suffix in SNAPSHOT_SUFFIXES.items()}
+        paths["csv"] = self.snapshot_path
+        return paths
+
+    def _current_snapshot(self):
+        """ (path, stat) of the newest snapshot file, None when there is none.
+            Only one is left after a write, unless it crashed before the cleanup"""
+        current = None
+        for path in set(self._snapshot_paths().values()):
+            stat = self._stat(path)
+            if stat is not None and (current is None or stat[1] > current[1][1]):
+                current = (path, stat)
+        return current
+
+    def _csv_frame(self, path: str, first_id: int) -> pd.DataFrame:
+        df = pd.read_csv(path, usecols=COLUMNS)
+        return compact_frame(range(first_id, first_id + len(df)), df["name"],
+                             to_day_numbers(df["expiry_dt"]), df["status"], df["storage"])
+
+    def _write_snapshot(self, df: pd.DataFrame, seq: int, next_id: int):
+        """ df is a compact_frame, older snapshots in other formats are removed"""
+        fmt = snapshot_format()
+        paths = self._snapshot_paths()
+        write_snapshot(df, paths[fmt], {"journal_seq": seq, "next_id": next_id}, fmt)
+        for path in set(paths.values()) - {paths[fmt]}:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _reset_rows(self):
+        self._size = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._days = np.empty(0, dtype=np.int32)
+        self._codes = {column: np.empty(0, dtype=np.int32) for column in CATEGORICAL}
+        self._labels = {column: [] for column in CATEGORICAL}
+        # label -> code, built when first needed
+        self._label_codes = {column: {} for column in CATEGORICAL}
+        # labels known to be in sorted order, frames then skip sorting them
+        self._sorted = dict.fromkeys(CATEGORICAL, True)
+        self._index = ExpiryIndex()
+
+    def _load_snapshot(self):
+        self._reset_rows()
+        self._next_id = 1
+        self._offset = 0
+        self._seq = self._snapshot_seq = 0
+        self._snapshot_state = self._current_snapshot()
+        if self._snapshot_state is None:
+            return
+        df, meta = read_snapshot(self._snapshot_state[0])
+        self._seq = self._snapshot_seq = meta["journal_seq"]
+        self._next_id = meta["next_id"]
+        if df.empty:
+            return
+        self._size = len(df)
+        self._ids = df["id"].to_numpy(dtype=np.int64, copy=True)
+        self._days = df["expiry_dt"].to_numpy(dtype=np.int32, copy=True)
+        for column in CATEGORICAL:
+            values = df[column].astype("category")
+            self._codes[column] = values.cat.codes.to_numpy().astype(np.int32)
+            self._labels[column] = values.cat.categories.tolist()
+            self._label_codes[column] = None
+            self._sorted[column] = values.cat.categories.is_monotonic_increasing
+        self._sort_rows()
+        self._next_id = max(self._next_id, int(self._ids[-1]) + 1)
+        self._index.build(self._ids, self._days, self._codes["storage"], self._labels["storage"],
+                          self._flagged(self._codes["status"]))
+
+    def _sort_rows(self):
+        """ restores id order, snapshots and journals written here are in it already"""
+        ids = self._ids[:self._size]
+        if np.all(ids[1:] > ids[:-1]):
+            return
+        order = np.argsort(ids, kind="stable")
+        self._ids = ids[order]
+        self._days = self._days[:self._size][order]
+        for column in CATEGORICAL:
+            self._codes[column] = self._codes[column][:self._size][order]
+
+    def _label_map(self, column: str) -> Dict:
+        mapping = self._label_codes[column]
+        if mapping is None:
+            mapping = {label: code for code, label in enumerate(self._labels[column])}
+            self._label_codes[column] = mapping
+        return mapping
+
+    def _code(self, column: str, label) -> int:
+        """ code of label in column, -1 when no row ever had it"""
+        return self._label_map(column).get(label, -1)
+
+    def _flagged(self, status_codes) -> np.ndarray:
+        code = self._code("status", "flagged")
+        return status_codes == code if code >= 0 else np.zeros(len(status_codes), dtype=bool)
+
+    def _encode(self, column: str, values) -> np.ndarray:
+        """ codes of values in column, new labels are appended, missing values are -1"""
+        mapping = self._label_map(column)
+        labels = self._labels[column]
+        codes = []
+        for value in values:
+            if value is None or value != value:
+                codes.append(-1)
+                continue
+            code = mapping.get(value)
+            if code is None:
+                try:
+                    in_order = not labels or value > labels[-1]
+                except TypeError:
+                    in_order = False
+                self._sorted[column] = self._sorted[column] and in_order
+                code = mapping[value] = len(labels)
+                labels.append(value)
+            codes.append(code)
+        return np.asarray(codes, dtype=np.int32)
+
+    def _positions(self, ids):
+        """ positions of ids in the row arrays and a mask of the ones found"""
+        ids = np.asarray(ids, dtype=np.int64)
+        table = self._ids[:self._size]
+        pos = np.searchsorted(table, ids)
+        found = pos < self._size
+        found[found] = table[pos[found]] == ids[found]
+        return pos, found
+
+    def _storage_offsets(self, storage_codes) -> np.ndarray:
+        """ shift of each row's storage since the snapshot, 0 for a missing storage"""
+        offsets = [self._index.offset(storage) for storage in self._labels["storage"]]
+        return np.asarray(offsets + [0], dtype=np.int64)[storage_codes]
+
+    def _storage_label(self, code: int):
+        return self._labels["storage"][code] if code >= 0 else None
+
+    def _index_rows(self, pos, add: bool):
+        """ adds the rows at pos to the ExpiryIndex, or removes them"""
+        storages = self._codes["storage"][pos]
+        flagged = self._flagged(self._codes["status"][pos])
+        for code in np.unique(storages).tolist():
+            for wanted in (False, True):
+                picked = pos[(storages == code) & (flagged == wanted)]
+                if len(picked):
+                    method = self._index.add if add else self._index.remove
+                    method(self._storage_label(code), self._ids[picked], self._days[picked], wanted)
+
+    def _append_rows(self, ids, names, days, statuses, storages):
+        """ new rows at the end, the arrays grow by doubling"""
+        end = self._size + len(ids)
+        if end > len(self._ids):
+            capacity = max(end, 2 * len(self._ids))
+            self._ids = _grown(self._ids, self._size, capacity)
+            self._days = _grown(self._days, self._size, capacity)
+            for column in CATEGORICAL:
+                self._codes[column] = _grown(self._codes[column], self._size, capacity)
+        new = slice(self._size, end)
+        storage_codes = self._encode("storage", storages)
+        self._ids[new] = ids
+        self._days[new] = np.asarray(days, dtype=np.int64) - self._storage_offsets(storage_codes)
+        self._codes["name"][new] = self._encode("name", names)
+        self._codes["status"][new] = self._encode("status", statuses)
+        self._codes["storage"][new] = storage_codes
+        self._size = end
+        self._sort_rows()
+        self._index_rows(self._positions(ids)[0], add=True)
+
+    def _keep_rows(self, keep: np.ndarray):
+        """ drops the rows where keep is False"""
+        self._ids = self._ids[:self._size][keep]
+        self._days = self._days[:self._size][keep]
+        for column in CATEGORICAL:
+            self._codes[column] = self._codes[column][:self._size][keep]
+        self._size = len(self._ids)
+
+    def _apply(self, record):
+        if record["seq"] <= self._snapshot_seq:
+            return
+        self._seq = record["seq"]
+        op = record["op"]
+        if op == "add" and record["rows"]:
+            ids, names, days, statuses, storages = zip(*record["rows"])
+            self._append_rows(np.asarray(ids, dtype=np.int64), names, days, statuses, storages)
+            self._next_id = max(self._next_id, max(ids) + 1)
+        elif op == "shift":
+            self._index.shift(record["storage"], record["days"])
+        elif op == "flag":
+            pos = self._positions(self._index.flag_until(record["until_day"]))[0]
+            self._codes["status"][pos] = self._encode("status", ["flagged"])[0]
+        elif op == "update" and record["rows"]:
+            ids, days, statuses = zip(*record["rows"])
+            # the last update of a row wins
+            ids, last = np.unique(np.asarray(ids, dtype=np.int64)[::-1], return_index=True)
+            picked = len(days) - 1 - last
+            pos, found = self._positions(ids)
+            # the row may have been compacted away since it was read
+            pos, picked = pos[found], picked[found]
+            self._index_rows(pos, add=False)
+            days = np.asarray(days, dtype=np.int64)[picked]
+            self._days[pos] = days - self._storage_offsets(self._codes["storage"][pos])
+            self._codes["status"][pos] = self._encode("status", [statuses[i] for i in picked.tolist()])
+            self._index_rows(pos, add=True)
+
+    def _catch_up(self):
+        """ replays journal lines written since the last call, by any process.
+            Caller holds the file lock, shared or exclusive"""
+        with self._state_lock:
+            if self._current_snapshot() != self._snapshot_state:
+                self._load_snapshot()
+            self._loaded = True
+            try:
+                with open(self.journal_path, "rb") as fl:
+                    fl.seek(self._offset)
+                    data = fl.read()
+            except FileNotFoundError:
+                return
+            # a line without its newline is still being written
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                if line.strip():
+                    self._apply(json.loads(line))
+            self._offset += end
+
+    def _append(self, record):
+        """ appends and applies one record, caller holds the exclusive lock.
+            Readers keep the state lock during the write and fsync"""
+        record["seq"] = self._seq + 1
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with open(self.journal_path, "ab") as fl:
+            fl.write(line.encode())
+            fl.flush()
+            if self.fsync:
+                os.fsync(fl.fileno())
+        with self._state_lock:
+            self._apply(record)
+            self._offset += len(line.encode())
+
+    def _categorical(self, column: str, pos) -> pd.Categorical:
+        """ the column at pos with the labels in use, sorted like compact_frame"""
+        values = pd.Categorical.from_codes(self._codes[column][pos], self._labels[column])
+        values = values.remove_unused_categories()
+        if not self._sorted[column]:
+            values = values.reorder_categories(values.categories.sort_values())
+        return values
+
+    def _frame(self, pos) -> pd.DataFrame:
+        """ compact_frame of the rows at pos in id order, storage shifts applied"""
+        pos = np.sort(np.asarray(pos, dtype=np.int64))
+        days = self._days[pos] + self._storage_offsets(self._codes["storage"][pos])
+        return pd.DataFrame({
+            "id": self._ids[pos],
+            "name": self._categorical("name", pos),
+            "expiry_dt": days.astype(np.int32),
+            "status": self._categorical("status", pos),
+            "storage": self._categorical("storage", pos),
+            })
+
+    def _frame_of(self, ids) -> pd.DataFrame:
+        return self._frame(self._positions(ids)[0])
+
+    def _names(self, pos) -> List[str]:
+        """ names of the rows at pos in id order"""
+        labels = self._labels["name"]
+        return [labels[code] if code >= 0 else np.nan
+                for code in self._codes["name"][np.sort(pos)].tolist()]
+
+    def day_frame(self) -> pd.DataFrame:
+        with self._reading():
+            return self._frame(np.arange(self._size))
+
+    def frame(self) -> pd.DataFrame:
+        df = self.day_frame()
+        df["expiry_dt"] = from_day_numbers(df["expiry_dt"].to_numpy())
+        return df
+
+    def update_rows(self, ids, expiry_days, statuses) -> int:
+        rows = [list(row) for row in zip(np.asarray(ids).tolist(),
+                                         np.asarray(expiry_days).tolist(), list(statuses))]
+        if not rows:
+            return 0
+        with self._file_lock(exclusive=True):
+            self._catch_up()
+            self._append({"op": "update", "rows": rows})
+        return len(rows)
+
+    def count(self) -> int:
+        with self._reading():
+            return self._size
+
+    def count_status(self, status: str) -> int:
+        with self._reading():
+            if status == "flagged":
+                return self._index.count_flagged()
+            return int(np.count_nonzero(self._codes["status"][:self._size] == self._code("status", status)))
+
+    def add_items(self, df: pd.DataFrame) -> int:
+        if df.empty:
+            return 0
+        days = to_day_numbers(df["expiry_dt"]).tolist()
+        with self._file_lock(exclusive=True):
+            self._catch_up()
+            first = self._next_id
+            rows = [
+                [first + i, name, day, status, storage]
+                for i, (name, day, status, storage) in enumerate(zip(
+                    df["name"].tolist(), days, df["status"].tolist(), df["storage"].tolist()))
+                ]
+            self._append({"op": "add", "rows": rows})
+        return len(rows)
+
+    def shift_expiry(self, storage: str, days: int) -> int:
+        with self._file_lock(exclusive=True):
+            self._catch_up()
+            affected = self._index.count(storage)
+            self._append({"op": "shift", "storage": storage, "days": days})
+        return affected
+
+    def flag_expiring(self, until_day: int) -> List[str]:
+        with self._file_lock(exclusive=True):
+            self._catch_up()
+            self._append({"op": "flag", "until_day": until_day})
+            return self._names(self._positions(self._index.expiring_until(until_day))[0])
+
+    def purge_expired_flagged(self, until_day: int) -> int:
+        """ expired flagged items are dropped by compact(), not on every upload"""
+        return 0
+
+    def names_with_status(self, status: str) -> List[str]:
+        if status == "flagged":
+            return self.flagged_names()
+        with self._reading():
+            code = self._code("status", status)
+            if code < 0:
+                return []
+            return self._names(np.flatnonzero(self._codes["status"][:self._size] == code))
+
+    def expiring_until(self, until_day: int) -> pd.DataFrame:
+        with self._reading():
+            return self._frame_of(self._index.expiring_until(until_day))
+
+    def flagged_names(self) -> List[str]:
+        with self._reading():
+            return self._names(self._positions(self._index.flagged())[0])
+
+    def expired_flagged(self, until_day: int) -> pd.DataFrame:
+        with self._reading():
+            return self._frame_of(self._index.expired_flagged(until_day))
+
+    def import_csv(self, path: str = csv_file, replace: bool = True) -> int:
+        if not replace:
+            return self.add_items(pd.read_csv(path, usecols=COLUMNS))
+        with self._file_lock(exclusive=True):
+            self._catch_up()
+            df = self._csv_frame(path, self._next_id)
+            # the snapshot is fsynced with its directory before the journal goes
+            self._write_snapshot(df, self._seq, self._next_id + len(df))
+            open(self.journal_path, "wb").close()
+            with self._state_lock:
+                self._load_snapshot()
+        return len(df)
+
+    def export_csv(self, path: str = csv_file) -> int:
+        df = self.frame()
+        _write_csv_atomic(df[COLUMNS], path)
+        return len(df)
+
+    def compact(self, until_day: Optional[int] = None) -> int:
+        """ folds the journal into a new snapshot without expired flagged items"""
+        if until_day is None:
+            until_day = today_number()
+        with self._file_lock(exclusive=True):
+            self._catch_up()
+            with self._state_lock:
+                expired = self._positions(self._index.expired_flagged(until_day))[0]
+                self._index_rows(expired, add=False)
+                keep = np.ones(self._size, dtype=bool)
+                keep[expired] = False
+                self._keep_rows(keep)
+                df = self._frame(np.arange(self._size))
+            # the snapshot is fsynced with its directory before the journal goes
+            self._write_snapshot(df, self._seq, self._next_id)
+            open(self.journal_path, "wb").close()
+            with self._state_lock:
+                self._snapshot_seq = self._seq
+                self._snapshot_state = self._current_snapshot()
+                self._offset = 0
+        print(f"Inventory journal compacted, {len(df)} items kept, {len(expired)} removed")
+        return len(expired)
+
+
+_store = None
+
+
+def get_store():
+    """ the process wide store for INVENTORY_BACKEND, opened on first use"""
+    global _store
+    if _store is None:
+        _store = JournalStore() if backend == "journal" else InventoryStore()
+    return _store
+
+
+# module level API used by mytools and agent
+def frame() -> pd.DataFrame:
+    return get_store().frame()
+
+def day_frame() -> pd.DataFrame:
+    return get_store().day_frame()
+
+def count() -> int:
+    return get_store().count()
+
+def count_status(status: str) -> int:
+    return get_store().count_status(status)
+
+def add_items(df: pd.DataFrame) -> int:
+    return get_store().add_items(df)
+
+def shift_expiry(storage: str, days: int) -> int:
+    return get_store().shift_expiry(storage, days)
+
+def update_rows(ids, expiry_days, statuses) -> int:
+    return get_store().update_rows(ids, expiry_days, statuses)
+
+def flag_expiring(until_day: int) -> List[str]:
+    return get_store().flag_expiring(until_day)
+
+def purge_expired_flagged(until_day: int) -> int:
+    return get_store().purge_expired_flagged(until_day)
+
+def names_with_status(status: str) -> List[str]:
+    return get_store().names_with_status(status)
+
+# expiry ordered queries, answered without a full scan by either backend
+def expiring_until(until_day: int) -> pd.DataFrame:
+    return get_store().expiring_until(until_day)
+
+def flagged_names() -> List[str]:
+    return get_store().flagged_names()
+
+def expired_flagged(until_day: int) -> pd.DataFrame:
+    return get_store().expired_flagged(until_day)
+
+def import_csv(path: str = csv_file, replace: bool = True) -> int:
+    return get_store().import_csv(path, replace)
+
+def export_csv(path: str = csv_file) -> int:
+    return get_store().export_csv(path)
+
+def compact(until_day: Optional[int] = None) -> int:
+    return get_store().compact(until_day)
+
+
+# python inventory_store.py import|export|compact [csv path]
+if __name__ == "__main__":
+    action = sys.argv[1] if len(sys.argv) > 1 else "export"
+    path = sys.argv[2] if len(sys.argv) > 2 else csv_file
+    if action == "import":
+        print(f"Imported {import_csv(path)} items from {path}")
+    elif action == "compact":
+        print(f"Compacted inventory, {compact()} expired flagged items removed")
+    else:
+        print(f"Exported {export_csv(path)} items to {path}")
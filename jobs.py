@@ -0,0 +1,198 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+
+# Background job queue for slow requests such as /upload and /message.
+# The request handler submits a job and returns straight away with its id;
+# a fixed pool of worker threads runs the jobs and the client polls
+# /jobs/<id> for the status: queued, running, done or failed.
+# The queue is bounded, when it is full submit raises QueueFull so the
+# handler can answer 503 instead of piling up work it cannot finish.
+# Job records live in a SQLite file (JOBS_DB) shared by all server processes,
+# so a poll answered by another worker than the one running the job still
+# finds it. The job itself runs on the threads of the process that queued it;
+# if that process dies its unfinished jobs stay queued or running until they
+# are STALE_JOB_SECONDS old and pruned.
+# The same file remembers the MessageSids of accepted webhook deliveries for
+# SEEN_MESSAGES_KEEP seconds, so a Twilio retry that reaches another process
+# is still recognised as a duplicate.
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", "32"))
+JOB_KEEP_SECONDS = float(os.getenv("JOB_KEEP_SECONDS", "3600"))
+STALE_JOB_SECONDS = float(os.getenv("STALE_JOB_SECONDS", str(24 * 3600)))
+jobs_file = os.getenv("JOBS_DB", "jobs.db")
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", "2"))
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "64"))
+SEEN_MESSAGES_KEEP = float(os.getenv("SEEN_MESSAGES_KEEP", str(24 * 3600)))
+BUSY_TIMEOUT = 30.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    queue TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished);
+CREATE TABLE IF NOT EXISTS seen_messages (
+    sid TEXT PRIMARY KEY,
+    received REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_seen_messages_received ON seen_messages(received);
+"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """ autocommit connection shared by the threads of one process"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                           isolation_level=None)
+    # polls read while a worker writes, and a lost job record is not worth an fsync
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+class QueueFull(Exception):
+    """ raised by submit when max_pending jobs are already waiting"""
+
+
+class JobQueue:
+    """ Bounded queue of jobs run by a pool of daemon worker threads"""
+    def __init__(self, workers: int = UPLOAD_WORKERS, max_pending: int = UPLOAD_QUEUE_SIZE,
+                 keep_seconds: float = JOB_KEEP_SECONDS, name: str = "job", path: Optional[str] = None):
+        self.workers = workers
+        self.keep_seconds = keep_seconds
+        self.name = name
+        self.path = path
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _db(self) -> sqlite3.Connection:
+        """ opened on first use so importing the app creates no file, caller
+            holds the lock"""
+        if self._conn is None:
+            self._conn = _connect(self.path or jobs_file)
+        return self._conn
+
+    def _start(self):
+        """ worker threads are started with the first job"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"{self.name}-worker-{i}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _prune(self, now: float):
+        """ forgets finished jobs older than keep_seconds and unfinished ones
+            a dead process left behind, caller holds the lock"""
+        self._db().execute("DELETE FROM jobs WHERE finished < ? OR (finished IS NULL AND created < ?)",
+                           (now - self.keep_seconds, now - STALE_JOB_SECONDS))
+
+    def submit(self, fn: Callable[..., Dict], *args: Any) -> str:
+        """ queues fn(*args) and returns the job id. fn returns a json safe dict,
+            the job counts as failed if it raises or returns success False"""
+        self._start()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._prune(now)
+            self._db().execute("INSERT INTO jobs (id, queue, status, created) VALUES (?, ?, 'queued', ?)",
+                               (job_id, self.name, now))
+        try:
+            self._queue.put_nowait((job_id, fn, args))
+        except queue.Full:
+            with self._lock:
+                self._db().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            raise QueueFull(f"{self._queue.maxsize} {self.name} jobs already waiting")
+        return job_id
+
+    def _work(self):
+        while True:
+            job_id, fn, args = self._queue.get()
+            with self._lock:
+                self._db().execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                                   (time.time(), job_id))
+            try:
+                result = fn(*args)
+                status = "done" if result.get("success", True) else "failed"
+            except Exception as e:
+                print(f"{self.name} job {job_id} failed: {e}")
+                result = {"success": False, "message": str(e)}
+                status = "failed"
+            with self._lock:
+                self._db().execute("UPDATE jobs SET status = ?, finished = ?, result = ? WHERE id = ?",
+                                   (status, time.time(), json.dumps(result, default=str), job_id))
+            self._queue.task_done()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """ the job record, None if unknown or already forgotten"""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT id, status, created, started, finished, result FROM jobs "
+                "WHERE id = ? AND queue = ?", (job_id, self.name)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(("id", "status", "created", "started", "finished", "result"), row))
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+
+class SeenMessages:
+    """ MessageSids of webhook deliveries already accepted by any process"""
+    def __init__(self, keep_seconds: float = SEEN_MESSAGES_KEEP, path: Optional[str] = None):
+        self.keep_seconds = keep_seconds
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        """ opened on first use, caller holds the lock"""
+        if self._conn is None:
+            self._conn = _connect(self.path or jobs_file)
+        return self._conn
+
+    def first(self, message_sid: str) -> bool:
+        """ records message_sid, False if it was already recorded"""
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            conn.execute("DELETE FROM seen_messages WHERE received < ?", (now - self.keep_seconds,))
+            return conn.execute("INSERT OR IGNORE INTO seen_messages (sid, received) VALUES (?, ?)",
+                                (message_sid, now)).rowcount == 1
+
+    def forget(self, message_sid: str):
+        """ lets a later delivery of message_sid through again"""
+        with self._lock:
+            self._db().execute("DELETE FROM seen_messages WHERE sid = ?", (message_sid,))
+
+
+upload_jobs = JobQueue(name="upload")
+# WhatsApp webhook work, Twilio gives up on a webhook after about 15 s
+message_jobs = JobQueue(workers=MESSAGE_WORKERS, max_pending=MESSAGE_QUEUE_SIZE, name="message")
+seen_messages = SeenMessages()
+
+
+@metrics.register_collector
+def _queue_metrics():
+    yield ("pantry_jobs_pending", "gauge", "Jobs waiting for a worker",
+           [({"queue": job_queue.name}, job_queue.pending()) for job_queue in (upload_jobs, message_jobs)])
@@ -0,0 +1,217 @@
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Process wide metrics published on GET /metrics in the Prometheus text format.
+# Stages of the request path (OCR, inventory updates, weather, donation search,
+# outbound messages) are wrapped with timed(), which records the duration in
+# a histogram and counts failures: an exception or a {"success": False} result.
+# Modules that keep their own counters (caches, outbox, job queues) register a
+# collector that is only called on a scrape. An observation is a clock read,
+# a bisect and a few additions under a lock, cheap enough to leave on.
+# METRICS=0 turns the timers off.
+
+METRICS_ENABLED = os.getenv("METRICS", "1") != "0"
+# seconds, from a cached lookup to a slow model call
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Sample = Tuple[Dict[str, str], float]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    """ monotonically increasing count per label values"""
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(self.labels, key)} {value:g}" for key, value in items)
+        return lines
+
+
+class Histogram:
+    """ cumulative bucket counts, sum and count per label values"""
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # per bucket (not cumulative) counts, then sum and count
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return series[2] if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(series[0]), series[1], series[2]))
+                           for key, series in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect: Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]):
+        """ collect() yields (name, type, help, [(labels, value)]) on every scrape"""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                # a broken collector must not take the whole endpoint down
+                print(f"Metrics collector {getattr(collect, '__name__', collect)} failed: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.histogram(
+    "pantry_stage_duration_seconds", "Time spent in each stage of the request path", ["stage"])
+stage_errors = registry.counter(
+    "pantry_stage_errors_total", "Stage calls that raised or returned success False", ["stage"])
+http_seconds = registry.histogram(
+    "pantry_http_request_duration_seconds", "Time to answer an HTTP request",
+    ["endpoint", "method", "status"])
+
+
+def _failed(result) -> bool:
+    return isinstance(result, dict) and result.get("success") is False
+
+
+def record(stage: str, seconds: float, failed: bool = False):
+    stage_seconds.observe(seconds, stage)
+    if failed:
+        stage_errors.inc(stage)
+
+
+@contextmanager
+def track(stage: str):
+    """ times a block as one call of stage, an exception counts as an error"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        record(stage, time.perf_counter() - start, True)
+        raise
+    record(stage, time.perf_counter() - start)
+
+
+def timed(stage: str, failed: Optional[Callable[[object], bool]] = None):
+    """ decorator recording duration and errors of every call, sync or async"""
+    failed = failed or _failed
+
+    def decorate(fn):
+        if not METRICS_ENABLED:
+            return fn
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await fn(*args, **kwargs)
+                except BaseException:
+                    record(stage, time.perf_counter() - start, True)
+                    raise
+                record(stage, time.perf_counter() - start, failed(result))
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException:
+                record(stage, time.perf_counter() - start, True)
+                raise
+            record(stage, time.perf_counter() - start, failed(result))
+            return result
+        return wrapper
+    return decorate
+
+
+def register_collector(collect):
+    registry.register_collector(collect)
+    return collect
+
+
+def render() -> str:
+    return registry.render()
@@ -1,17 +1,179 @@
 import pandas as pd
 import numpy as np
 import os
-import math
-import json
-from datetime import datetime, timedelta, date
+from datetime import date
 import csv
-from typing import Dict
-from dateutil.relativedelta import relativedelta
+import threading
+from typing import Dict, Optional, Tuple
+import inventory_store
+import metrics
 
 # the user specific tools the image agent needs
 
 csv_file = "sample_inventory.csv"
+food_db_file = "raw_food_db.csv"
 
+
+class ShelfLifeIndex:
+    """
+        Process wide lookup of shelf life and storage from raw_food_db.
+        The csv is parsed once and parsed again only when its mtime changes,
+        so every upload request shares the same dictionary.
+        The optional temp_sensitivity column scales how fast a food spoils
+        in the heat, see spoilage.py. Foods without one count as 1.0.
+    """
+    def __init__(self, path: str = food_db_file):
+        self.path = path
+        self._mtime = None
+        self._table = {}
+        self._sensitivity = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(name) -> str:
+        """lower case and collapse whitespace"""
+        return " ".join(str(name).lower().split())
+
+    @staticmethod
+    def variants(name: str):
+        """the name itself followed by its likely singular forms"""
+        variants = [name]
+        if name.endswith("ies") and len(name) > 4:
+            variants.append(name[:-3] + "y")
+        if name.endswith("es") and len(name) > 3:
+            variants.append(name[:-2])
+        if name.endswith("s") and not name.endswith("ss") and len(name) > 2:
+            variants.append(name[:-1])
+        return variants
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return self._table
+        with self._lock:
+            if mtime == self._mtime:
+                return self._table
+            table = {}
+            sensitivity = {}
+            if mtime is not None:
+                with open(self.path, newline="") as fl:
+                    for row in csv.DictReader(fl):
+                        key = self.normalize(row["name"])
+                        table[key] = (int(row["shelf_life"]), row["storage"])
+                        if row.get("temp_sensitivity"):
+                            sensitivity[key] = float(row["temp_sensitivity"])
+            # swap the reference so readers never see a half built table
+            self._sensitivity = sensitivity
+            self._table = table
+            self._mtime = mtime
+            print(f"Shelf life index loaded with {len(table)} items")
+        return self._table
+
+    def table(self) -> Dict[str, Tuple[int, str]]:
+        """the current table, reloaded first if the csv has changed"""
+        return self._refresh()
+
+    def lookup(self, name, table: Optional[Dict] = None) -> Optional[Tuple[int, str]]:
+        """(shelf_life, storage) for a food name or None if not in the db"""
+        if table is None:
+            table = self.table()
+        for key in self.variants(self.normalize(name)):
+            if key in table:
+                return table[key]
+        return None
+
+    def sensitivity(self, name) -> float:
+        """temperature sensitivity of a food, 1.0 if not in the db"""
+        self._refresh()
+        sensitivity = self._sensitivity
+        for key in self.variants(self.normalize(name)):
+            if key in sensitivity:
+                return sensitivity[key]
+        return 1.0
+
+
+shelf_index = ShelfLifeIndex()
+
+def _add_months(dates: np.ndarray, months: np.ndarray) -> np.ndarray:
+    """ datetime64[D] plus whole months, clipped to the month end like relativedelta"""
+    month_start = dates.astype("datetime64[M]")
+    day_of_month = (dates - month_start.astype("datetime64[D]")).astype(np.int64)
+    target = month_start + months.astype("timedelta64[M]")
+    month_len = ((target + 1).astype("datetime64[D]") - target.astype("datetime64[D]")).astype(np.int64)
+    return target.astype("datetime64[D]") + np.minimum(day_of_month, month_len - 1).astype("timedelta64[D]")
+
+
+def _parse_dates(values) -> np.ndarray:
+    """ DD-MM-YYYY strings to datetime64[D] in one call"""
+    return pd.to_datetime(pd.Series(values, dtype=object), format='%d-%m-%Y').values.astype("datetime64[D]")
+
+
+def stock_rows_batch(item_list) -> pd.DataFrame:
+    """
+        Builds the new stock rows for a whole OCR payload in one pass.
+        Items are split into columns first and the expiry dates for grocery,
+        explicit expiry and mfg plus duration items are computed with
+        vectorized date arithmetic instead of one datetime call per item.
+    """
+    food_table = shelf_index.table()
+    count = len(item_list)
+    names = [None] * count
+    storage = ["fridge"] * count
+    expiry = np.full(count, np.datetime64("NaT"), dtype="datetime64[D]")
+    grocery_idx, grocery_days = [], []
+    exp_idx, exp_dates = [], []
+    mfg_idx, mfg_dates, mfg_amount, mfg_months = [], [], [], []
+    for i, item in enumerate(item_list):
+        names[i] = item["name"]
+        if item["type"] == "grocery":
+            match = shelf_index.lookup(item["name"], food_table)
+            if match is not None:
+                days_to_add, storage[i] = match
+            else:
+                # Add three days as expiry by default if item not found in database
+                print(f"Item not found, adding default day 3 and counter storage for grocery {item['name']}")
+                days_to_add, storage[i] = 3, "counter"
+            grocery_idx.append(i)
+            grocery_days.append(days_to_add)
+        elif item.get("expiry_date"):
+            exp_idx.append(i)
+            exp_dates.append(item["expiry_date"])
+        elif item.get("mfg_date"):
+            mfg_idx.append(i)
+            mfg_dates.append(item["mfg_date"])
+            mfg_amount.append(int(item["time_remaining"]))
+            mfg_months.append(item.get("time_denom") != "d")
+        else:
+            print(f"No expiry or mfg date found for packaged item {item['name']}, skipping")
+
+    if grocery_idx:
+        today = np.datetime64(date.today(), "D")
+        expiry[grocery_idx] = today + np.array(grocery_days, dtype="timedelta64[D]")
+    if exp_idx:
+        expiry[exp_idx] = _parse_dates(exp_dates)
+    if mfg_idx:
+        mfg = _parse_dates(mfg_dates)
+        amount = np.array(mfg_amount, dtype=np.int64)
+        in_months = np.array(mfg_months, dtype=bool)
+        mfg_exp = mfg + amount.astype("timedelta64[D]")
+        if in_months.any():
+            mfg_exp[in_months] = _add_months(mfg[in_months], amount[in_months])
+        expiry[mfg_idx] = mfg_exp
+
+    nu_stock = pd.DataFrame({
+        "name": names,
+        "expiry_dt": pd.Series(expiry).dt.strftime("%d-%m-%Y"),
+        "status": "open",
+        "storage": storage,
+        })
+    # packaged items with no date information cannot be stored
+    return nu_stock[~np.isnat(expiry)].reset_index(drop=True)
+
+
+@metrics.timed("fresh_stocks_format")
 def fresh_stocks_format(json_data :Dict):
     """
         checks the items identified by OCR, looks for expiry date in raw_food_db
@@ -21,81 +183,17 @@ def fresh_stocks_format(json_data :Dict):
     """
     try:
         item_list = json_data["items"]
-        nu_stock = pd.DataFrame(columns=["name", "expiry_dt", "status","storage"])
-        for item in item_list:
-            if item["type"] == "grocery":
-                print("Grocery found")
-                match_items = pd.read_csv("raw_food_db.csv")
-                name_list = list(match_items["name"])
-                print("Opened sample db csv")
-                current_date = datetime.today()
-                if item["name"] in name_list:
-                    df_row = match_items[match_items["name"]==item["name"]]
-                    days_to_add = int(df_row["shelf_life"])
-                    exp = current_date + timedelta(days = days_to_add)
-                    storage = df_row["storage"].item()
-                    print(f"Storage of {item['name']} is {storage}")
-                else:
-                    # Add three days as expiry by default if item not found in database
-                    print(f"Item not found, adding default day 3 and counter storage for grocery {item['name']}")
-                    exp = current_date + timedelta(days = 3)
-                    storage = "counter"
-                nu_stock.loc[len(nu_stock)] = [item["name"], pd.to_datetime(exp).strftime("%d-%m-%Y"), "open", storage]
-                print("New grocery item added while preparing sheet")
-                
-            else:
-                print("Packaged item found")
-                if item["expiry_date"]:
-                    exp = pd.to_datetime(item["expiry_date"], format='%d-%m-%Y')
-                elif item["mfg_date"] and not item["expiry_date"]:
-                    if item["time_denom"] == "d":
-                        exp = pd.to_datetime(item["mfg_date"], format = '%d-%m-%Y') + timedelta(days = int(item["time_remaining"]))
-                         
-                    else:
-                        exp = exp = pd.to_datetime(item["mfg_date"], format = '%d-%m-%Y') + relativedelta(months = int(item["time_remaining"]))
-                else:
-                    pass
-                nu_stock.loc[len(nu_stock)] = [item["name"], pd.to_datetime(exp).strftime("%d-%m-%Y"), "open", "fridge"]
-                print("New packaged item added while preparing sheet")
+        nu_stock = stock_rows_batch(item_list)
+        print(f"{len(nu_stock)} new items added while preparing sheet")
         return {"success": True, "data" : nu_stock}
     except Exception as e:
         return {"success": False, "error" : e}
 
 
-def clear_old_optimized(df):
-    print("Clearing old items (Optimized)")
-    if "Unnamed: 0.1" in df.columns:
-        df.drop("Unnamed: 0", axis=1, inplace=True)
-    # Convert 'expiry_dt' to datetime objects for comparison
-    df['expiry_dt_dt'] = pd.to_datetime(df['expiry_dt'], format='%d-%m-%Y')
-    curr_date = datetime.today()
-
-    # Define the condition for ROWS TO KEEP:
-    # KEEP if status is NOT 'flagged'
-    condition_keep_1 = (df['status'] != 'flagged')
-    
-    # OR KEEP if status IS 'flagged' AND the expiry date is NOT in the past
-    condition_keep_2 = (df['status'] == 'flagged') & (df['expiry_dt_dt'] >= curr_date)
-
-    # Combine the conditions using '|' (OR)
-    rows_to_keep = condition_keep_1 | condition_keep_2
-
-    # Return a new DataFrame containing only the rows to keep
-    # The original DataFrame is NOT modified (inplace=False by default)
-    df_cleaned = df[rows_to_keep].drop(columns=['expiry_dt_dt'])
-
-    print(f"Original shape: {df.shape}, Cleaned shape: {df_cleaned.shape}")
-    print(df_cleaned.head())
-    return df_cleaned
-
-
-def update_stock(json_data:Dict):
+@metrics.timed("update_stock")
+def update_stock(json_data:Dict, store=None):
     print("Request recieved to update stock")
     try:
-        stock_df = pd.read_csv("sample_inventory.csv")
-        print("Finished fetching existing inventory")
-        #stock_df = clear_old(stock_df)
-        stock_df = clear_old_optimized(stock_df)
         print("Now let us get the new stock info")
         get_data = fresh_stocks_format(json_data)
         if get_data["success"]:
@@ -105,23 +203,36 @@ def update_stock(json_data:Dict):
         else:
             print('Stock data formatting unsuccessful')
             return {"success": False, "error": get_data["error"]}
-        updated_stock = pd.concat([stock_df, nu_stock], ignore_index=True)
-        if "Unnamed: 0.1" in updated_stock.columns:
-            print("Deleting unwanted column")
-            updated_stock.drop("Unnamed: 0.1", axis=1, inplace=True)
-        print('Concatenating the new stock with remaining')
-        updated_stock.to_csv("sample_inventory.csv", index=False)
-        print('Writing the new stock successful')
-        return {"success" : True, "msg": "New Stock Updated"}
+        return _add_stock(nu_stock, store)
+    except Exception as e:
+        return {"success": False, "error" : e}
+
+
+@metrics.timed("update_stock")
+def add_stock_rows(frames, store=None):
+    """ stock rows already built by fresh_stocks_format, one frame per image,
+        added with one write"""
+    print("Request recieved to add stock rows")
+    try:
+        return _add_stock(pd.concat(frames, ignore_index=True), store)
     except Exception as e:
         return {"success": False, "error" : e}
+
+
+def _add_stock(nu_stock, store=None):
+    # the household's inventory partition, the default one when not given
+    store = store or inventory_store.get_store()
+    # flagged items that have already expired are dropped before adding
+    removed = store.purge_expired_flagged(inventory_store.today_number())
+    print(f"Cleared {removed} old flagged items from inventory")
+    store.add_items(nu_stock)
+    print('Writing the new stock successful')
+    return {"success" : True, "msg": "New Stock Updated"}
 # this tool is used by Agent 3, the donation agent that needs item types for
 #searching appropriate organizations for donating those
-def fetch_list():
+def fetch_list(store=None):
     try:
-        df = pd.read_csv(csv_file)
-        condition = (df["status"] == "flagged")
-        mylist = df.loc[condition, "name"].tolist()
+        mylist = (store or inventory_store.get_store()).flagged_names()
         check_food_list = ",".join(mylist)
         return {"success":True, "checklist":check_food_list}
     except Exception as e:
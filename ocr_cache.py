@@ -0,0 +1,191 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+import metrics
+
+# Cache of OCR extraction results in front of GeminiReceiptProcessor.
+# Entries are keyed by the sha256 of the uploaded image bytes, so the same
+# photo uploaded twice costs one model call. With OCR_CACHE_PHASH_DISTANCE > 0
+# a 64 bit difference hash of the image is also stored and a near duplicate
+# shot of the same shelf (within that many differing bits) is served from the
+# cache as well. The cache lives in a small SQLite file, is bounded by entry
+# count (least recently used entries go first) and entries expire after a TTL.
+
+cache_file = os.getenv("OCR_CACHE_DB", "ocr_cache.db")
+CACHE_ENABLED = os.getenv("OCR_CACHE", "1") != "0"
+MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "1000"))
+TTL_SECONDS = float(os.getenv("OCR_CACHE_TTL", str(7 * 24 * 3600)))
+PHASH_DISTANCE = int(os.getenv("OCR_CACHE_PHASH_DISTANCE", "0"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_cache (
+    key TEXT PRIMARY KEY,
+    phash INTEGER,
+    value TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ocr_cache_accessed ON ocr_cache(accessed);
+"""
+
+
+def content_key(image_data: Any) -> str:
+    """ sha256 of the image bytes, for a path the file contents"""
+    if isinstance(image_data, str):
+        digest = hashlib.sha256()
+        with open(image_data, "rb") as fl:
+            for chunk in iter(lambda: fl.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image_data).hexdigest()
+    # an already decoded PIL image
+    return hashlib.sha256(image_data.tobytes()).hexdigest()
+
+
+def perceptual_hash(image_data: Any) -> int:
+    """ 64 bit difference hash, stable across re-encoding and small changes"""
+    if isinstance(image_data, dict):
+        image_data = image_data["data"]
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        image_data = Image.open(io.BytesIO(image_data))
+    elif isinstance(image_data, str):
+        image_data = Image.open(image_data)
+    small = image_data.convert("L").resize((9, 8), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    # SQLite integers are signed 64 bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _distance(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << 64) - 1)).count("1")
+
+
+class OcrCache:
+    """ Bounded, persistent LRU cache of extracted_data dictionaries"""
+    def __init__(self, path: str = cache_file, max_entries: int = MAX_ENTRIES,
+                 ttl: float = TTL_SECONDS, phash_distance: int = PHASH_DISTANCE):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.phash_distance = phash_distance
+        self.counters = {"hits": 0, "near_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.executescript(_SCHEMA)
+
+    @property
+    def near_duplicates(self) -> bool:
+        return self.phash_distance > 0
+
+    def _count(self, counter: str):
+        self.counters[counter] += 1
+
+    def get(self, key: str) -> Optional[Dict]:
+        """ exact lookup by content key"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM ocr_cache WHERE key = ? AND created > ?",
+                (key, now - self.ttl)).fetchone()
+            if row is None:
+                if not self.near_duplicates:
+                    self._count("misses")
+                return None
+            self._conn.execute("UPDATE ocr_cache SET accessed = ? WHERE key = ?", (now, key))
+            self._count("hits")
+        return json.loads(row[0])
+
+    def get_near(self, phash: int) -> Optional[Dict]:
+        """ closest entry within phash_distance bits, called after get() missed"""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, phash FROM ocr_cache WHERE phash IS NOT NULL AND created > ?",
+                (now - self.ttl,)).fetchall()
+            best = min(rows, key=lambda row: _distance(row[1], phash), default=None)
+            if best is None or _distance(best[1], phash) > self.phash_distance:
+                self._count("misses")
+                return None
+            value = self._conn.execute(
+                "SELECT value FROM ocr_cache WHERE key = ?", (best[0],)).fetchone()[0]
+            self._conn.execute("UPDATE ocr_cache SET accessed = ? WHERE key = ?", (now, best[0]))
+            self._count("near_hits")
+        return json.loads(value)
+
+    def put(self, key: str, extracted_data: Dict, phash: Optional[int] = None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO ocr_cache (key, phash, value, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, phash, json.dumps(extracted_data), now, now))
+                expired = self._conn.execute(
+                    "DELETE FROM ocr_cache WHERE created <= ?", (now - self.ttl,)).rowcount
+                overflow = self._conn.execute(
+                    "DELETE FROM ocr_cache WHERE key IN (SELECT key FROM ocr_cache "
+                    "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+                self._conn.execute("COMMIT")
+            except BaseException:
+                # the connection is shared, never leave it inside a transaction
+                self._conn.execute("ROLLBACK")
+                raise
+            self._count("stores")
+            self.counters["evictions"] += expired + overflow
+
+    def stats(self) -> Dict:
+        """ counters plus the number of entries and the hit ratio"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+            counters = dict(self.counters)
+        lookups = counters["hits"] + counters["near_hits"] + counters["misses"]
+        counters["entries"] = entries
+        counters["hit_ratio"] = (counters["hits"] + counters["near_hits"]) / lookups if lookups else 0.0
+        return counters
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM ocr_cache")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[OcrCache]:
+    """ the process wide cache, None when OCR_CACHE=0"""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = OcrCache()
+    return _cache
+
+
+@metrics.register_collector
+def _cache_metrics():
+    if _cache is None:
+        return
+    stats = _cache.stats()
+    yield ("pantry_ocr_cache_lookups_total", "counter", "OCR cache lookups by outcome",
+           [({"outcome": outcome}, stats[outcome]) for outcome in ("hits", "near_hits", "misses")])
+    yield ("pantry_ocr_cache_entries", "gauge", "Extractions held in the OCR cache",
+           [({}, stats["entries"])])
@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+from fileio import atomic_write, flock
+
+# Scheduler for the daily routine and the inventory compaction.
+# The old loop woke up every second to ask the schedule library whether a job
+# was due. This one sleeps until the next job is due and is woken early only
+# when jobs are added or it is stopped. It runs as a background thread inside
+# the Flask process or standalone in the foreground (python agent.py).
+# A job never runs twice at once: a run that is still going when the job is
+# due again is skipped, and across processes a lock file per job plus the
+# shared state file make sure every due run happens once even if the app and
+# a standalone scheduler are both up. The state file keeps the last run,
+# its duration and outcome per job, and after a restart a job whose run was
+# missed while nothing was running is started once right away.
+
+state_file = os.getenv("SCHEDULER_STATE", "scheduler_state.json")
+# the wall clock can jump (NTP, suspend), so never sleep longer than this
+MAX_SLEEP = 600
+KEEP_DURATIONS = 20
+
+
+class Job:
+    """ a function run daily at HH:MM local time or every N seconds"""
+    def __init__(self, name: str, fn: Callable[[], Any], at: Optional[str] = None,
+                 every: Optional[float] = None, catch_up: bool = True):
+        if (at is None) == (every is None):
+            raise ValueError("a job needs either at or every")
+        self.name = name
+        self.fn = fn
+        self.at = datetime.strptime(at, "%H:%M").time() if at else None
+        self.every = every
+        self.catch_up = catch_up
+        self.next_due = None
+        self.lock = threading.Lock()
+
+    def previous_due(self, now: datetime, last_due: Optional[float]) -> Optional[datetime]:
+        """ latest scheduled time on or before now, None if nothing was due"""
+        if self.at is not None:
+            due = datetime.combine(now.date(), self.at)
+            return due if due <= now else due - timedelta(days=1)
+        if last_due is None:
+            return None
+        due = datetime.fromtimestamp(last_due) + timedelta(seconds=self.every)
+        return due if due <= now else None
+
+    def following_due(self, now: datetime) -> datetime:
+        """ first scheduled time after now"""
+        if self.at is not None:
+            due = datetime.combine(now.date(), self.at)
+            return due if due > now else due + timedelta(days=1)
+        return now + timedelta(seconds=self.every)
+
+
+class Scheduler:
+    """ Runs jobs when they are due, from one sleeping thread"""
+    def __init__(self, path: str = state_file):
+        self.path = path
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def add(self, name: str, fn: Callable[[], Any], at: Optional[str] = None,
+            every: Optional[float] = None, catch_up: bool = True) -> Job:
+        """ registers a job, at="HH:MM" for daily jobs or every=seconds"""
+        job = Job(name, fn, at, every, catch_up)
+        job.next_due = self._first_due(job, datetime.now())
+        with self._cond:
+            self._jobs[name] = job
+            self._cond.notify_all()
+        return job
+
+    def _first_due(self, job: Job, now: datetime) -> datetime:
+        last = self._load().get(job.name, {})
+        missed = job.previous_due(now, last.get("last_due"))
+        # only a job that ran before can have missed a run, a fresh install waits
+        if job.catch_up and missed is not None and last and \
+                last.get("last_due", 0) < missed.timestamp():
+            print(f"Scheduler: {job.name} missed its run at {missed:%Y-%m-%d %H:%M}, running now")
+            return missed
+        if job.every is not None and last.get("last_due"):
+            return max(now, datetime.fromtimestamp(last["last_due"]) + timedelta(seconds=job.every))
+        return job.following_due(now)
+
+    # state file shared by every process running a scheduler
+    def _file_lock(self, suffix: str, blocking: bool = True):
+        """ yields False when blocking is off and another process holds the lock"""
+        return flock(f"{self.path}.{suffix}.lock", blocking=blocking)
+
+    def _load(self) -> Dict:
+        try:
+            with open(self.path) as fl:
+                return json.load(fl)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _update_state(self, name: str, **fields) -> Dict:
+        with self._file_lock("state"):
+            state = self._load()
+            entry = state.setdefault(name, {"runs": 0, "skipped": 0, "failures": 0,
+                                            "durations": []})
+            for key, value in fields.items():
+                if key in ("runs", "skipped", "failures"):
+                    entry[key] = entry.get(key, 0) + value
+                elif key == "duration":
+                    entry["last_duration"] = value
+                    entry["durations"] = (entry.get("durations", []) + [round(value, 3)])[-KEEP_DURATIONS:]
+                else:
+                    entry[key] = value
+            with atomic_write(self.path, prefix=".scheduler-", suffix=".json") as fl:
+                json.dump(state, fl, indent=1)
+        return entry
+
+    @contextmanager
+    def exclusive(self, name: str):
+        """ holds the locks of a job while the block runs, yields False when
+            the job is running in this or another process"""
+        job = self._jobs[name]
+        if not job.lock.acquire(blocking=False):
+            yield False
+            return
+        try:
+            with self._file_lock(name, blocking=False) as locked:
+                yield locked
+        finally:
+            job.lock.release()
+
+    def run_job(self, name: str, due: Optional[datetime] = None) -> Dict:
+        """ runs a job now unless it is already running, returns the outcome.
+            due is the scheduled time, a run for a time already handled by
+            another process is skipped """
+        job = self._jobs[name]
+        with self.exclusive(name) as free:
+            if not free:
+                self._update_state(name, skipped=1)
+                print(f"Scheduler: {name} is still running, this run is skipped")
+                return {"success": False, "error": f"{name} is already running"}
+            if due is not None and self._load().get(name, {}).get("last_due", 0) >= due.timestamp():
+                return {"success": True, "msg": f"{name} already ran for {due:%Y-%m-%d %H:%M}"}
+            started = time.time()
+            self._update_state(name, last_start=started,
+                               last_due=due.timestamp() if due else started)
+            try:
+                result = job.fn()
+                status = "done"
+            except Exception as e:
+                print(f"Scheduler: {name} failed: {e}")
+                result = {"success": False, "error": str(e)}
+                status = "failed"
+            duration = time.time() - started
+            if isinstance(result, dict) and result.get("success") is False:
+                status = "failed"
+            self._update_state(name, runs=1, failures=int(status == "failed"),
+                               duration=duration, last_status=status)
+            print(f"Scheduler: {name} {status} in {duration:.2f}s")
+            return result
+
+    def _start_run(self, job: Job, due: datetime):
+        threading.Thread(target=self.run_job, args=(job.name, due),
+                         name=f"scheduler-{job.name}", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = datetime.now()
+                due_jobs = [job for job in self._jobs.values() if job.next_due <= now]
+                for job in due_jobs:
+                    due = job.next_due
+                    job.next_due = job.following_due(max(now, due))
+                    # each job on its own thread, a long routine does not hold up the others
+                    self._start_run(job, due)
+                if due_jobs:
+                    continue
+                wait = min((job.next_due - now).total_seconds() for job in self._jobs.values()) \
+                    if self._jobs else MAX_SLEEP
+                self._cond.wait(min(max(wait, 0), MAX_SLEEP))
+
+    def start(self) -> "Scheduler":
+        """ runs the scheduler in a daemon thread, e.g. inside the Flask process"""
+        with self._cond:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+                self._thread.start()
+        return self
+
+    def run_forever(self):
+        """ runs the scheduler in the foreground until interrupted"""
+        try:
+            self._loop()
+        except KeyboardInterrupt:
+            print("Scheduler stopped")
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> Dict:
+        """ next run plus the recorded history of every job"""
+        state = self._load()
+        with self._cond:
+            jobs = list(self._jobs.values())
+        return {job.name: dict(state.get(job.name, {}), next_run=job.next_due.isoformat(),
+                               running=job.lock.locked())
+                for job in jobs}
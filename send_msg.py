@@ -1,26 +1,202 @@
 import os
-from twilio.rest import Client
 import logging
+import atexit
+import queue
+import threading
+import time
 from dotenv import load_dotenv
+import metrics
+
+# Outbound WhatsApp messages. send_message only puts the message on a bounded
+# queue, a worker thread talks to Twilio, retries failures with backoff and
+# merges alerts for the same recipient that arrive within a short window into
+# one digest. The transport is pluggable so a local fake can stand in for
+# Twilio. The Twilio client is only imported and built for the first real
+# send, so importing this module needs neither the library nor credentials.
 
 load_dotenv()
 account_sid = os.getenv("TWILIO_SID")
 auth_token = os.getenv("TWILIO_TOKEN")
 twilio_number = os.getenv("TWILIO_NUMBER")
 to_number = os.getenv("TO_NUMBER")
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE", "100"))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "3"))
+SEND_BACKOFF = float(os.getenv("SEND_BACKOFF", "1.0"))
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "5.0"))
+ALERT_PREFIX = "Attention from your Pantry! "
 logging.basicConfig(level = logging.INFO)
 logger = logging.getLogger(__name__)
-client = Client(account_sid, auth_token)
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ the Twilio REST client, built on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from twilio.rest import Client
+                _client = Client(account_sid, auth_token)
+    return _client
+
 
-		
-def send_message(body_text):
-    try:
-        msg = client.messages.create(
-            from_ = f"whatsapp:{twilio_number}",
+class TwilioTransport:
+    """ sends one WhatsApp message, raises on failure"""
+    def __init__(self, twilio_client=None, from_number=None):
+        self._client = twilio_client
+        self.from_number = from_number or twilio_number
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_client()
+        return self._client
+
+    def send(self, to, body_text):
+        msg = self.client.messages.create(
+            from_ = f"whatsapp:{self.from_number}",
             body = body_text,
-            to = f"whatsapp:{to_number}"
+            to = f"whatsapp:{to}"
             )
-        logger.info(f"Message sent to {to_number} : {msg.body}")
-    except Exception as e:
-        logger.error(f"Error sending message to {to_number} for the error {e}")
-        
+        return msg.body
+
+
+class MessageDispatcher:
+    """ Bounded outbound queue drained by one worker thread"""
+    def __init__(self, transport, max_queue=OUTBOX_SIZE, retries=SEND_RETRIES,
+                 backoff=SEND_BACKOFF, coalesce_window=COALESCE_WINDOW):
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+        self.coalesce_window = coalesce_window
+        self.counters = {"queued": 0, "sent": 0, "failed": 0, "dropped": 0, "coalesced": 0}
+        self._queue = queue.Queue(maxsize=max_queue)
+        # recipient -> (deadline, [bodies]) for alerts waiting to be merged
+        self._digests = {}
+        self._busy = 0
+        self._idle = threading.Condition()
+        self._thread = threading.Thread(target=self._work, name="outbox", daemon=True)
+        self._thread.start()
+
+    def send(self, body_text, to=None, coalesce=False, block=False):
+        """ queues a message and returns at once, False if the queue is full.
+            With block=True waits for room instead, for batch senders """
+        to = to or to_number
+        with self._idle:
+            self._busy += 1
+        try:
+            self._queue.put((to, body_text, coalesce), block=block)
+        except queue.Full:
+            with self._idle:
+                self._busy -= 1
+                self._idle.notify_all()
+            self.counters["dropped"] += 1
+            logger.error(f"Outbox full, message to {to} dropped")
+            return False
+        self.counters["queued"] += 1
+        return True
+
+    def _deliver(self, to, body_text):
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.track("twilio_send"):
+                    sent = self.transport.send(to, body_text)
+                self.counters["sent"] += 1
+                logger.info(f"Message sent to {to} : {sent}")
+                return True
+            except Exception as e:
+                logger.error(f"Error sending message to {to} for the error {e}")
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+        self.counters["failed"] += 1
+        return False
+
+    @staticmethod
+    def _digest(bodies):
+        if len(bodies) == 1:
+            return bodies[0]
+        return f"{ALERT_PREFIX}{len(bodies)} alerts:\n" + \
+            "\n".join(f"- {body.replace(ALERT_PREFIX, '', 1)}" for body in bodies)
+
+    def _flush_due(self, now):
+        for to, (deadline, bodies) in list(self._digests.items()):
+            if deadline <= now:
+                del self._digests[to]
+                self._deliver(to, self._digest(bodies))
+                self._done(len(bodies))
+
+    def _done(self, count):
+        with self._idle:
+            self._busy -= count
+            self._idle.notify_all()
+
+    def _work(self):
+        while True:
+            if self._digests:
+                timeout = max(min(d for d, _ in self._digests.values()) - time.monotonic(), 0)
+            else:
+                timeout = None
+            try:
+                to, body_text, coalesce = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush_due(time.monotonic())
+                continue
+            if coalesce and self.coalesce_window > 0:
+                if to in self._digests:
+                    self._digests[to][1].append(body_text)
+                    self.counters["coalesced"] += 1
+                else:
+                    self._digests[to] = (time.monotonic() + self.coalesce_window, [body_text])
+            else:
+                self._deliver(to, body_text)
+                self._done(1)
+            self._flush_due(time.monotonic())
+
+    def flush(self, timeout=None):
+        """ waits until every queued message was sent or given up on"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._busy == 0, timeout)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = MessageDispatcher(TwilioTransport())
+    return _dispatcher
+
+
+def set_transport(transport):
+    """ swaps the transport, e.g. for a local fake"""
+    get_dispatcher().transport = transport
+
+
+def flush(timeout=30):
+    if _dispatcher is not None:
+        _dispatcher.flush(timeout)
+
+
+# queued messages still go out when a script such as agent.py exits
+atexit.register(flush)
+
+
+@metrics.register_collector
+def _outbox_metrics():
+    if _dispatcher is None:
+        return
+    yield ("pantry_outbox_messages_total", "counter", "Outbound messages by outcome",
+           [({"outcome": outcome}, count) for outcome, count in _dispatcher.counters.items()])
+    yield ("pantry_outbox_pending", "gauge", "Messages waiting in the outbox",
+           [({}, _dispatcher._queue.qsize())])
+
+
+@metrics.timed("send_message", failed=lambda queued: queued is False)
+def send_message(body_text, to=None, coalesce=False, block=False):
+    """ queues a WhatsApp message, alerts pass coalesce=True to be merged"""
+    return get_dispatcher().send(body_text, to, coalesce, block)
@@ -0,0 +1,180 @@
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import mytools
+from fileio import atomic_write
+
+# Forecast driven spoilage of counter items. Every 3 hour forecast point above
+# BASE_TEMP adds (temp - BASE_TEMP) * hours degree-hours; an item loses one
+# day of life per DEGREE_HOURS_PER_DAY degree-hours, scaled by the
+# temp_sensitivity of the food in raw_food_db.csv. 25 C all day costs a day
+# at sensitivity 1.0, 35 C three days.
+# A ledger per store keeps, for every counter item, its expiry before any
+# adjustment (base), the life lost so far in days (fractions carried over),
+# the end of the last forecast slot applied and the expiry the item had
+# before the last run (prior_day). A run only applies slots after that and
+# sets expiry to base - floor(loss), so running the routine twice a day
+# gives the same expiry. The ledger is saved before the inventory is
+# written: an item still at its prior_day is a run that never reached the
+# inventory and is applied again, any other expiry than the ledger's is a
+# hand edit and becomes the new base. The whole inventory is adjusted in
+# one pass of numpy array operations.
+
+BASE_TEMP = float(os.getenv("SPOILAGE_BASE_TEMP", "20"))
+DEGREE_HOURS_PER_DAY = float(os.getenv("SPOILAGE_DEGREE_HOURS", "120"))
+# fridge and freezer keep their own temperature
+EXPOSED_STORAGES = ["counter"]
+# items expiring up to today + FLAG_DAYS are flagged, as the legacy routine does
+FLAG_DAYS = 3
+SLOT_SECONDS = 3 * 3600
+
+
+def temperature_hours(w_data, base_temp: float = BASE_TEMP) -> Tuple[np.ndarray, np.ndarray]:
+    """ end of every forecast slot (unix seconds) and its degree-hours above
+        base_temp, in time order"""
+    points = sorted(w_data["list"], key=lambda item: item["dt"])
+    starts = np.array([item["dt"] for item in points], dtype=np.int64)
+    temps = np.array([item["main"]["temp_max"] for item in points], dtype=np.float64) - 273.15
+    if not len(starts):
+        return starts, temps
+    ends = np.append(starts[1:], starts[-1] + SLOT_SECONDS)
+    hours = (ends - starts) / 3600
+    return ends, np.maximum(temps - base_temp, 0.0) * hours
+
+
+class Ledger:
+    """ Applied adjustments per item id, arrays sorted by id"""
+    def __init__(self, ids=(), base_day=(), loss=(), applied_until=(), prior_day=()):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.base_day = np.asarray(base_day, dtype=np.int64)
+        self.loss = np.asarray(loss, dtype=np.float64)
+        self.applied_until = np.asarray(applied_until, dtype=np.int64)
+        self.prior_day = np.asarray(prior_day, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path: str) -> "Ledger":
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["ids"], data["base_day"], data["loss"], data["applied_until"],
+                       data["prior_day"])
+
+    def save(self, path: str):
+        """ written to a temp file and renamed, like the inventory snapshots"""
+        with atomic_write(path, "wb", prefix=".spoilage-", suffix=".npz") as fl:
+            np.savez(fl, ids=self.ids, base_day=self.base_day, loss=self.loss,
+                     applied_until=self.applied_until, prior_day=self.prior_day)
+
+    def lookup(self, ids: np.ndarray):
+        """ positions of ids in the ledger and a mask of the ones found"""
+        pos = np.searchsorted(self.ids, ids)
+        found = pos < len(self.ids)
+        found[found] = self.ids[pos[found]] == ids[found]
+        return pos, found
+
+    @staticmethod
+    def take(values: np.ndarray, pos: np.ndarray, found: np.ndarray, default) -> np.ndarray:
+        """ values at pos where found, default for items not in the ledger"""
+        if not len(values):
+            return np.broadcast_to(np.asarray(default, dtype=values.dtype), found.shape).copy()
+        return np.where(found, values[np.minimum(pos, len(values) - 1)], default)
+
+
+def _codes(column: pd.Series):
+    """ category codes of a column and its labels, the code -1 of a missing
+        value indexes the None appended to the labels"""
+    column = column.astype("category")
+    labels = np.append(column.cat.categories.to_numpy(dtype=object), None)
+    return column.cat.codes.to_numpy(), labels
+
+
+def ledger_path(store) -> str:
+    """ next to the store's own files, so every household has its own"""
+    base = getattr(store, "journal_path", None) or store.path
+    return base + ".spoilage.npz"
+
+
+class SpoilageEngine:
+    def __init__(self, food_index: Optional[mytools.ShelfLifeIndex] = None,
+                 base_temp: float = BASE_TEMP, degree_hours_per_day: float = DEGREE_HOURS_PER_DAY):
+        self.food_index = food_index
+        self.base_temp = base_temp
+        self.degree_hours_per_day = degree_hours_per_day
+
+    def sensitivities(self, names: np.ndarray) -> np.ndarray:
+        """ temp_sensitivity per label, 1.0 for a missing name"""
+        index = self.food_index or mytools.shelf_index
+        return np.array([1.0 if name is None else index.sensitivity(name) for name in names],
+                        dtype=np.float64)
+
+    def apply(self, df: pd.DataFrame, ledger: Ledger, w_data, today: int):
+        """ one routine run on a day_frame: new expiry days, which rows are
+            flagged, which changed, and the ledger to save before the write.
+            Works on category codes, the labels are only looked up per name"""
+        expiry = df["expiry_dt"].to_numpy().astype(np.int64)
+        storage_codes, storages = _codes(df["storage"])
+        exposed = np.flatnonzero(np.isin(storages, EXPOSED_STORAGES)[storage_codes])
+        ids = df["id"].to_numpy().take(exposed)
+        current = expiry.take(exposed)
+
+        pos, found = ledger.lookup(ids)
+        base = ledger.take(ledger.base_day, pos, found, current)
+        old_loss = ledger.take(ledger.loss, pos, found, 0.0)
+        applied = ledger.take(ledger.applied_until, pos, found, 0)
+        prior = ledger.take(ledger.prior_day, pos, found, current)
+
+        ends, degree_hours = temperature_hours(w_data, self.base_temp)
+        cumulative = np.concatenate(([0.0], np.cumsum(degree_hours)))
+        # degree-hours of the slots ending after what each item already had
+        fresh = cumulative[-1] - cumulative[np.searchsorted(ends, applied, side="right")]
+        name_codes, names = _codes(df["name"])
+        sensitivity = self.sensitivities(names).take(name_codes.take(exposed))
+        loss = old_loss + sensitivity * fresh / self.degree_hours_per_day
+        if len(ends):
+            applied = np.maximum(applied, ends[-1])
+
+        # an expiry edited outside the routine becomes the new base, one
+        # still at prior_day was never written and keeps the ledger's
+        lost_days = np.floor(old_loss).astype(np.int64)
+        edited = (current != base - lost_days) & (current != prior)
+        base = np.where(edited, current + lost_days, base)
+        expiry[exposed] = base - np.floor(loss).astype(np.int64)
+
+        status_codes, statuses = _codes(df["status"])
+        was_flagged = (statuses == "flagged")[status_codes]
+        flagged = was_flagged | (expiry <= today + FLAG_DAYS)
+        changed = (expiry != df["expiry_dt"].to_numpy()) | (flagged != was_flagged)
+        order = np.argsort(ids, kind="stable")
+        new_ledger = Ledger(ids[order], base[order], loss[order], applied[order], current[order])
+        return expiry, flagged, changed, new_ledger
+
+
+_engine = None
+
+
+def get_engine() -> SpoilageEngine:
+    global _engine
+    if _engine is None:
+        _engine = SpoilageEngine()
+    return _engine
+
+
+def refresh(store, w_data, today: int):
+    """ the routine's inventory refresh: one read, the adjustment in memory,
+        the ledger, then one write of the changed rows. Returns the names of
+        the flagged items"""
+    path = ledger_path(store)
+    df = store.day_frame()
+    expiry, flagged, changed, ledger = get_engine().apply(df, Ledger.load(path), w_data, today)
+    ledger.save(path)
+    status_codes, statuses = _codes(df["status"])
+    status = np.where(flagged[changed], "flagged", statuses[status_codes[changed]])
+    store.update_rows(df["id"].to_numpy()[changed], expiry[changed], status)
+    name_codes, names = _codes(df["name"])
+    return names[name_codes[flagged]].tolist()
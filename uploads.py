@@ -0,0 +1,132 @@
+import io
+import os
+import tempfile
+from typing import Any, Optional
+
+from flask import Request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+# Upload ingestion with bounded memory. Werkzeug streams every file part of
+# a request into a SpooledUpload: small images stay in a memory buffer, any
+# part over UPLOAD_SPOOL_BYTES goes to a temp file as it arrives, and a part
+# over MAX_UPLOAD_BYTES is refused mid-stream with 413. The request handler
+# keeps the SpooledUpload (detach) and queues it; the worker hands the image
+# processor the temp file path, which PIL opens lazily and decodes scaled
+# down, so the full upload is never held in memory. MAX_CONTENT_LENGTH caps
+# a whole request, a batch included. Only the image header is checked in
+# the request, pixels are decoded by the worker.
+
+MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", str(64 * 1024 * 1024)))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+# None is the system temp dir
+UPLOAD_DIR = os.getenv("UPLOAD_DIR") or None
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "80000000"))
+
+
+class UploadTooLarge(RequestEntityTooLarge):
+    """ one file of the request is over MAX_UPLOAD_BYTES"""
+
+
+class InvalidImage(BadRequest):
+    """ the upload is not an image PIL can read, or has too many pixels"""
+
+
+class SpooledUpload:
+    """
+        Writable and readable file an upload is streamed into. Held in memory
+        up to spool_bytes, moved to a named temp file beyond that. Other file
+        methods (read, readline, seek, tell) go to whichever holds the data.
+        request.close() closes it and deletes the temp file unless the
+        handler took it over with detach(), then the worker calls discard().
+    """
+    def __init__(self, max_bytes: int = MAX_UPLOAD_BYTES, spool_bytes: int = UPLOAD_SPOOL_BYTES,
+                 directory: Optional[str] = UPLOAD_DIR):
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.directory = directory
+        self.size = 0
+        self.path = None
+        self.detached = False
+        self._file = io.BytesIO()
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            # werkzeug drops a part that failed mid-stream without closing it
+            self.discard()
+            raise UploadTooLarge(f"Files are limited to {self.max_bytes // (1024 * 1024)} MB")
+        if self.path is None and self.size > self.spool_bytes:
+            fd, path = tempfile.mkstemp(prefix="upload-", dir=self.directory)
+            spooled = os.fdopen(fd, "w+b")
+            spooled.write(self._file.getbuffer())
+            self._file, self.path = spooled, path
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def source(self) -> Any:
+        """ what the image processor takes: the temp file path or the bytes"""
+        if self.path is not None:
+            self._file.flush()
+            return self.path
+        return self._file.getvalue()
+
+    def detach(self) -> "SpooledUpload":
+        """ keeps the data past the end of the request"""
+        self.detached = True
+        return self
+
+    def close(self):
+        if not self.detached:
+            self.discard()
+
+    def discard(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadRequest(Request):
+    """ Flask request whose file parts are streamed into SpooledUploads"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return SpooledUpload()
+
+
+def accept(file_storage) -> SpooledUpload:
+    """ the SpooledUpload of a werkzeug FileStorage, header checked and
+        detached from the request. Raises InvalidImage"""
+    upload = file_storage.stream
+    if not isinstance(upload, SpooledUpload):
+        # a request class other than UploadRequest, copy in chunks
+        upload = SpooledUpload()
+        for chunk in iter(lambda: file_storage.stream.read(1 << 20), b""):
+            upload.write(chunk)
+    try:
+        verify_header(upload)
+    except InvalidImage:
+        upload.discard()
+        raise
+    return upload.detach()
+
+
+def verify_header(upload: SpooledUpload):
+    """ reads the image header only, the pixels are decoded by the worker"""
+    from PIL import Image, UnidentifiedImageError
+    upload.seek(0)
+    try:
+        with Image.open(upload) as image:
+            width, height = image.size
+    except Image.DecompressionBombError as e:
+        raise InvalidImage(str(e))
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise InvalidImage("Not a readable image")
+    finally:
+        upload.seek(0)
+    if width * height > MAX_IMAGE_PIXELS:
+        raise InvalidImage(f"Image of {width}x{height} pixels is too large")